@@ -0,0 +1,124 @@
+"""A local stand-in for the GCS JSON API, for benchmarking the data server
+without network access or credentials.
+
+Point the storage client at it by setting STORAGE_EMULATOR_HOST to
+FakeGcsServer.url before the client is created."""
+import json
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+
+class FakeGcsServer():
+    """Serves the objects in `blobs` over HTTP, the way GCS serves them to the
+    storage client. Only bucket lookups, object metadata and media downloads
+    (including byte ranges) are supported.
+
+    blobs: Dict of (bucket name, object name) to object contents.
+    latency: Seconds to wait before answering each request, to simulate the
+             round trip to GCS."""
+
+    def __init__(self, blobs: dict, latency: float = 0.0):
+        self.blobs = blobs
+        self.latency = latency
+        self.request_count = 0
+        self._count_lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                           self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self._server.server_port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def generation(self, bucket: str, name: str) -> int:
+        """Returns a generation number that changes with the contents."""
+        return zlib.crc32(self.blobs[(bucket, name)]) + 1
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                with fake._count_lock:
+                    fake.request_count += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                path = urlparse(self.path).path
+                parts = [unquote(part) for part in path.split('/')]
+                # /storage/v1/b/<bucket>
+                # /storage/v1/b/<bucket>/o/<object>
+                # /download/storage/v1/b/<bucket>/o/<object>?alt=media
+                download = parts[1] == 'download'
+                if download:
+                    parts = parts[1:]
+                if parts[1:4] != ['storage', 'v1', 'b'] or len(parts) < 5:
+                    return self._send_json(404, {'error': {'code': 404}})
+                bucket = parts[4]
+                if len(parts) == 5:
+                    return self._send_json(200, {'name': bucket})
+                name = '/'.join(parts[6:])
+                if (bucket, name) not in fake.blobs:
+                    return self._send_json(404, {'error': {'code': 404}})
+
+                data = fake.blobs[(bucket, name)]
+                generation = fake.generation(bucket, name)
+                if not download:
+                    return self._send_json(200, {
+                        'bucket': bucket, 'name': name,
+                        'generation': str(generation),
+                        'size': str(len(data))})
+                self._send_media(data, generation)
+
+            def _send_json(self, status: int, payload: dict):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_media(self, data: bytes, generation: int):
+                status, start, end = 200, 0, len(data)
+                range_header = self.headers.get('Range')
+                if range_header and range_header.startswith('bytes='):
+                    first, _, last = range_header[6:].partition('-')
+                    start = int(first)
+                    end = min(int(last) + 1, len(data)) if last else len(data)
+                    status = 206
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(end - start))
+                self.send_header('x-goog-generation', str(generation))
+                if status == 206:
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                        start, end - 1, len(data)))
+                self.end_headers()
+                self.wfile.write(data[start:end])
+
+        return Handler
@@ -0,0 +1,393 @@
+"""Load-tests the data server under concurrency, against an in-process fake of
+data_server.gcs_utils serving synthetic datasets, and reports latency
+percentiles, throughput and the server's peak memory for each workload.
+
+Each workload gets a fresh server process, so that the cache starts empty and
+peak memory isn't carried over from the previous workload:
+  hit: Requests spread over a few hot datasets, all loaded before timing.
+  miss: Every request is for a dataset that was never requested before.
+  mixed: A share of the requests (--mixed-hit-ratio) go to the hot datasets,
+         the rest are misses.
+
+The server runs either on Werkzeug's threaded server (--server flask) or on
+gunicorn configured like the Dockerfile, 1 worker with 8 threads (--server
+gunicorn). Other server settings, such as DATASET_CACHE_MAX_BYTES, are read
+from the environment as usual. Servers are forked, so this only runs on Linux
+and macOS.
+
+Usage, from the data_server directory:
+    python benchmarks/load_test.py --requests 2000 --output results.json
+    python benchmarks/load_test.py --compare results.json
+"""
+import argparse
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import exceptions
+
+# main.py is imported from the server processes.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BUCKET = 'benchmark-bucket'
+WORKLOADS = ('hit', 'miss', 'mixed')
+
+# Seconds to wait for a server to start or report its stats.
+SERVER_TIMEOUT_SECONDS = 30
+
+
+def make_dataset(size: int) -> bytes:
+    """Returns newline-delimited json rows shaped like the real datasets,
+    about size bytes long."""
+    rows: list = []
+    total = 0
+    races = ['Asian (Non-Hispanic)', 'Black or African American',
+             'Hispanic or Latino', 'White (Non-Hispanic)', 'Total']
+    while total < size:
+        row_id = len(rows)
+        row = json.dumps({
+            'state_fips': '{:02d}'.format(row_id % 56 + 1),
+            'county_fips': '{:05d}'.format(row_id % 3200 + 1000),
+            'race_and_ethnicity': races[row_id % len(races)],
+            'age': '{}-{}'.format(row_id % 8 * 10, row_id % 8 * 10 + 9),
+            'sex': ['Female', 'Male', 'Total'][row_id % 3],
+            'cases': row_id * 7 % 100000,
+            'deaths': row_id * 3 % 1000,
+            'population': row_id * 13 % 1000000}).encode()
+        rows.append(row)
+        total += len(row) + 1
+    return b'\n'.join(rows) + b'\n'
+
+
+class FakeGcs():
+    """Stands in for the GCS functions of data_server.gcs_utils. Every object
+    name holds the same synthetic dataset, and each download waits latency
+    seconds to simulate the round trip to GCS."""
+
+    def __init__(self, data: bytes, latency: float):
+        self.data = data
+        self.latency = latency
+        self.downloads = 0
+        self._lock = threading.Lock()
+
+    def install(self):
+        # pylint: disable=import-outside-toplevel
+        from data_server import gcs_utils
+        gcs_utils.download_blob = self.download_blob
+        gcs_utils.get_blob_metadata = self.get_blob_metadata
+        gcs_utils.iter_blob_chunks = self.iter_blob_chunks
+
+    def _check(self, gcs_bucket: str, filename: str):
+        if gcs_bucket != BUCKET:
+            raise exceptions.NotFound('No such bucket: ' + gcs_bucket)
+        if filename.startswith('missing'):
+            raise exceptions.NotFound('No such object: ' + filename)
+
+    def download_blob(self, gcs_bucket: str, filename: str):
+        # pylint: disable=import-outside-toplevel
+        from data_server.gcs_utils import DownloadedBlob
+        time.sleep(self.latency)
+        self._check(gcs_bucket, filename)
+        with self._lock:
+            self.downloads += 1
+        return DownloadedBlob(self.data, 1)
+
+    def get_blob_metadata(self, gcs_bucket: str, filename: str):
+        # pylint: disable=import-outside-toplevel
+        from data_server.gcs_utils import BlobMetadata
+        time.sleep(self.latency)
+        self._check(gcs_bucket, filename)
+        return BlobMetadata(1, len(self.data))
+
+    def iter_blob_chunks(self, gcs_bucket: str, filename: str, size: int,
+                         generation=None, chunk_bytes=1024 * 1024):
+        self._check(gcs_bucket, filename)
+        with self._lock:
+            self.downloads += 1
+        for start in range(0, size, chunk_bytes):
+            time.sleep(self.latency)
+            yield self.data[start:start + chunk_bytes]
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_stats(fake: FakeGcs) -> dict:
+    """Returns the stats the server process reports when it stops."""
+    return {'peak_rss_bytes': get_peak_rss_bytes(),
+            'gcs_downloads': fake.downloads}
+
+
+def get_peak_rss_bytes() -> int:
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def run_flask_server(port: int, threads: int, fake: FakeGcs, stop, results):
+    # pylint: disable=import-outside-toplevel
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    fake.install()
+    import main
+    server = make_server('127.0.0.1', port, main.app, threaded=True,
+                         request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    stop.wait()
+    server.shutdown()
+    results.put(server_stats(fake))
+
+
+def run_gunicorn_server(port: int, threads: int, fake: FakeGcs, stop,
+                        results):
+    # pylint: disable=import-outside-toplevel
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        """Runs main.app with the Dockerfile's gunicorn settings."""
+
+        def load_config(self):
+            self.cfg.set('bind', '127.0.0.1:{}'.format(port))
+            self.cfg.set('workers', 1)
+            self.cfg.set('threads', threads)
+            self.cfg.set('timeout', 0)
+            self.cfg.set('loglevel', 'warning')
+            # Runs in the worker, which is where datasets are cached.
+            self.cfg.set('worker_exit',
+                         lambda server, worker: results.put(
+                             server_stats(fake)))
+
+        def load(self):
+            import main
+            return main.app
+
+    # The worker is forked from this process, so it inherits the fake.
+    fake.install()
+
+    def stop_on_request():
+        stop.wait()
+        os.kill(os.getpid(), signal.SIGTERM)
+    threading.Thread(target=stop_on_request, daemon=True).start()
+    Application().run()
+
+
+SERVERS = {'flask': run_flask_server, 'gunicorn': run_gunicorn_server}
+
+
+def wait_until_ready(port: int):
+    deadline = time.monotonic() + SERVER_TIMEOUT_SECONDS
+    while True:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                    timeout=1)
+            connection.request('GET', '/ready')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError('Server did not start on port {}'.format(port))
+        time.sleep(0.05)
+
+
+def hot_name(index: int) -> str:
+    return 'hot_{}.json'.format(index)
+
+
+def make_request_names(workload: str, requests: int, hot_datasets: int,
+                       mixed_hit_ratio: float) -> list:
+    """Returns the dataset requested by each request of the workload. Hits
+    are spread evenly over the hot datasets, and misses each get a new
+    name."""
+    hit_ratio = {'hit': 1.0, 'miss': 0.0, 'mixed': mixed_hit_ratio}[workload]
+    names = []
+    hits = 0
+    for request_id in range(requests):
+        # Spread misses evenly over the run instead of bunching them up.
+        if hits < math.floor((request_id + 1) * hit_ratio):
+            names.append(hot_name(hits % hot_datasets))
+            hits += 1
+        else:
+            names.append('cold_{}.json'.format(request_id))
+    return names
+
+
+def percentile(values: list, percent: float) -> float:
+    """Returns the nearest-rank percentile of the sorted values."""
+    rank = max(1, math.ceil(len(values) * percent / 100))
+    return values[rank - 1]
+
+
+def run_client(port: int, names: list, concurrency: int) -> dict:
+    """Requests every dataset in names from concurrency threads, each with
+    its own keep-alive connection, and returns latency and throughput
+    stats."""
+    local = threading.local()
+    errors = []
+
+    def fetch(name: str):
+        if not hasattr(local, 'connection'):
+            local.connection = http.client.HTTPConnection(
+                '127.0.0.1', port, timeout=SERVER_TIMEOUT_SECONDS)
+        start = time.perf_counter()
+        try:
+            local.connection.request('GET', '/dataset?name=' + name)
+            response = local.connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as err:
+            local.connection.close()
+            errors.append(str(err))
+            return None
+        latency = time.perf_counter() - start
+        if response.status != 200:
+            errors.append('{} for {}'.format(response.status, name))
+            return None
+        return latency, len(body)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = [result for result in executor.map(fetch, names)
+                   if result is not None]
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency * 1000 for latency, _ in results)
+    stats = {'requests': len(names), 'errors': len(errors),
+             'seconds': elapsed,
+             'requests_per_second': len(results) / elapsed,
+             'bytes_per_second': sum(size for _, size in results) / elapsed}
+    if latencies:
+        stats.update({
+            'mean_ms': statistics.mean(latencies),
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'max_ms': latencies[-1]})
+    if errors:
+        stats['first_error'] = errors[0]
+    return stats
+
+
+def run_workload(workload: str, args, data: bytes) -> dict:
+    """Starts a fresh server, runs the workload against it and returns the
+    client's stats along with the server's."""
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    server_results = context.Queue()
+    port = get_free_port()
+    fake = FakeGcs(data, args.gcs_latency)
+    process = context.Process(
+        target=SERVERS[args.server],
+        args=(port, args.threads, fake, stop, server_results), daemon=True)
+    process.start()
+    try:
+        wait_until_ready(port)
+        names = make_request_names(workload, args.requests, args.hot_datasets,
+                                   args.mixed_hit_ratio)
+        if workload != 'miss':
+            # Load the hot datasets first, so hits are hits from the start.
+            run_client(port, [hot_name(index)
+                              for index in range(args.hot_datasets)],
+                       args.concurrency)
+        stats = run_client(port, names, args.concurrency)
+    finally:
+        stop.set()
+    stats.update(server_results.get(timeout=SERVER_TIMEOUT_SECONDS))
+    process.join(SERVER_TIMEOUT_SECONDS)
+    return stats
+
+
+def get_commit():
+    """Returns the current git commit, or None outside of a git checkout."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], check=True,
+            capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: dict, baseline=None):
+    for workload, stats in results.items():
+        line = ('{:>6}: p50 {:8.2f} ms  p95 {:8.2f} ms  p99 {:8.2f} ms  '
+                '{:8.1f} req/s  peak RSS {:7.1f} MiB  {} errors'.format(
+                    workload, stats.get('p50_ms', math.nan),
+                    stats.get('p95_ms', math.nan),
+                    stats.get('p99_ms', math.nan),
+                    stats['requests_per_second'],
+                    stats['peak_rss_bytes'] / 2 ** 20, stats['errors']))
+        print(line)
+        if baseline and workload in baseline:
+            before = baseline[workload]
+            changes = []
+            for key in ('p50_ms', 'p95_ms', 'p99_ms', 'requests_per_second',
+                        'peak_rss_bytes'):
+                if before.get(key) and key in stats:
+                    changes.append('{} {:+.1f}%'.format(
+                        key, (stats[key] / before[key] - 1) * 100))
+            print('        vs baseline: ' + '  '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--server', choices=sorted(SERVERS), default='flask')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS),
+                        help='Comma-separated workloads to run.')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='Number of timed requests per workload.')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Number of client threads.')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Number of gunicorn threads.')
+    parser.add_argument('--dataset-bytes', type=int, default=256 * 1024,
+                        help='Size of each synthetic dataset.')
+    parser.add_argument('--hot-datasets', type=int, default=10,
+                        help='Number of datasets hits are spread over.')
+    parser.add_argument('--mixed-hit-ratio', type=float, default=0.8)
+    parser.add_argument('--gcs-latency', type=float, default=0.02,
+                        help='Simulated GCS round trip time in seconds.')
+    parser.add_argument('--output', help='Optional JSON file for results.')
+    parser.add_argument('--compare',
+                        help='JSON file from an earlier run to compare to.')
+    args = parser.parse_args()
+
+    os.environ['GCS_BUCKET'] = BUCKET
+    data = make_dataset(args.dataset_bytes)
+    results = {}
+    for workload in args.workloads.split(','):
+        if workload not in WORKLOADS:
+            parser.error('Unknown workload: ' + workload)
+        results[workload] = run_workload(workload, args, data)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': get_commit(), 'args': vars(args),
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
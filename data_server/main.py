@@ -1,15 +1,222 @@
+import base64
+import hmac
+import itertools
+import json
 import logging
 import os
+import time
 
-from flask import Flask, Response, request
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
+from google.cloud import exceptions
 from werkzeug.datastructures import Headers
+from werkzeug.http import quote_etag
 
+from data_server.cached_dataset import CachedDataset
+from data_server import (cache_snapshot, cache_warmer, cached_dataset,
+                         disk_cache, gcs_utils, metrics, timing)
 from data_server.dataset_cache import DatasetCache
+from data_server.dataset_index import RowFilter, UnsupportedFilterError
+from data_server.gcs_utils import BlobMetadata
 
 app = Flask(__name__)
 CORS(app)
-cache = DatasetCache()
+cache = DatasetCache(disk_cache=disk_cache.from_env())
+snapshot_destination = cache_snapshot.get_destination_from_env()
+if snapshot_destination is not None:
+    cache_snapshot.load(cache, snapshot_destination)
+    cache_snapshot.save_on_sigterm(cache, snapshot_destination)
+warmer = cache_warmer.from_env(cache)
+if warmer is not None:
+    warmer.start()
+timing_config = timing.TimingConfig.from_env()
+
+# Content-codings the cache may hold, in order of preference when the client
+# accepts several of them equally.
+PREFERRED_ENCODINGS = ['br', 'gzip']
+
+# Max number of datasets that can be requested at once from /datasets.
+MAX_BATCH_DATASETS = 20
+
+# Size of the chunks that datasets served from disk are sent in.
+DISK_CHUNK_BYTES = 256 * 1024
+
+
+def iter_chunks(data, chunk_bytes=DISK_CHUNK_BYTES):
+    """Yields data, which may be memory-mapped, as a series of bytes chunks so
+    that the whole dataset is never copied into memory at once."""
+    for start in range(0, len(data), chunk_bytes):
+        yield bytes(data[start:start + chunk_bytes])
+
+
+def make_body_response(body, mimetype: str, headers: Headers):
+    """Returns a Response sending body with an accurate Content-Length. Bodies
+    that aren't bytes are mapped from disk and are streamed in chunks."""
+    if isinstance(body, bytes):
+        return Response(body, mimetype=mimetype, headers=headers)
+    headers.add('Content-Length', str(len(body)))
+    return Response(iter_chunks(body), mimetype=mimetype, headers=headers)
+
+
+def get_requested_range(length: int, etag: str):
+    """Returns the Range parsed from the Range header, if a single range of a
+    body of the given length should be sent. Returns None if the whole body
+    should be sent, and False if the range can't be satisfied."""
+    byte_range = request.range
+    if byte_range is None or len(byte_range.ranges) != 1:
+        return None
+    # Only send part of the body if the client still has the same version of
+    # the rest of it.
+    if_range = request.if_range
+    if if_range.date is not None or (if_range.etag is not None and
+                                     if_range.etag != etag):
+        return None
+    if byte_range.range_for_length(length) is None:
+        return False
+    return byte_range
+
+
+def make_dataset_response(dataset: CachedDataset, headers: Headers,
+                          accept_ranges=False):
+    """Returns a Response for the cached dataset, using the precompressed
+    variant that best matches the request's Accept-Encoding header, if any.
+
+    If the request's If-None-Match header matches the dataset's current
+    version, an empty 304 response is returned instead. If accept_ranges is
+    set, a single byte range of the body can be requested with the Range
+    header."""
+    best_encoding, best_quality = None, 0.0
+    for encoding in PREFERRED_ENCODINGS:
+        quality = request.accept_encodings[encoding]
+        if encoding in dataset.encodings and quality > best_quality:
+            best_encoding, best_quality = encoding, quality
+
+    etag = dataset.get_etag(best_encoding)
+    headers.add('ETag', quote_etag(etag))
+
+    # Any representation of the current version is still valid for the
+    # client, regardless of which content-coding it was sent with.
+    current_etags = [dataset.get_etag()] + [
+        dataset.get_etag(encoding) for encoding in dataset.encodings]
+    if any(request.if_none_match.contains_weak(tag) for tag in current_etags):
+        return Response(status=304, headers=headers)
+
+    body = dataset.body
+    if best_encoding is not None:
+        headers.add('Content-Encoding', best_encoding)
+        body = dataset.encodings[best_encoding]
+
+    if accept_ranges:
+        headers.add('Accept-Ranges', 'bytes')
+        byte_range = get_requested_range(len(body), etag)
+        if byte_range is False:
+            headers.add('Content-Range', 'bytes */{}'.format(len(body)))
+            return Response(status=416, headers=headers)
+        if byte_range is not None:
+            start, stop = byte_range.range_for_length(len(body))
+            headers.add('Content-Range',
+                        byte_range.to_content_range_header(len(body)))
+            # Slicing a memoryview doesn't copy the body, only the chunks
+            # that are sent are copied.
+            response = make_body_response(memoryview(body)[start:stop],
+                                          dataset.mimetype, headers)
+            response.status_code = 206
+            return response
+
+    # The cached body is already in its final form, so it is sent as-is with
+    # an accurate Content-Length.
+    return make_body_response(body, dataset.mimetype, headers)
+
+
+def open_passthrough_chunks(dataset_name: str, metadata: BlobMetadata):
+    """Returns an iterator over the chunks of a dataset streamed from GCS.
+    The first chunk is read right away, so that errors such as the file having
+    been overwritten since its metadata was read are raised before the
+    response starts, instead of truncating it."""
+    gcs_bucket = os.environ.get('GCS_BUCKET')
+    if gcs_bucket is None or metadata.size is None:
+        raise ValueError(
+            'Cannot stream {} without GCS_BUCKET and its size'.format(
+                dataset_name))
+    chunks = gcs_utils.iter_blob_chunks(gcs_bucket, dataset_name,
+                                        metadata.size, metadata.generation)
+    first = next(chunks, None)
+    if first is None:
+        return iter(())
+    return itertools.chain([first], chunks)
+
+
+def make_passthrough_response(dataset_name: str, metadata: BlobMetadata,
+                              headers: Headers):
+    """Returns a Response streaming the dataset straight from GCS in chunks,
+    for datasets too large to cache. Newline-delimited json is converted to a
+    json array on the fly, so its length isn't known up front."""
+    if metadata.generation is not None:
+        etag = cached_dataset.make_etag(b'', metadata.generation)
+        headers.add('ETag', quote_etag(etag))
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
+
+    try:
+        chunks = open_passthrough_chunks(dataset_name, metadata)
+    except exceptions.NotFound:
+        return 'Dataset {} not found'.format(dataset_name), 404
+    except Exception as err:
+        logging.error(err)
+        return 'Internal server error: {}'.format(err), 500
+    if dataset_name.endswith('.csv'):
+        headers.add('Content-Length', str(metadata.size))
+        return Response(chunks, mimetype='text/csv', headers=headers)
+    return Response(cached_dataset.iter_ndjson_to_json_array(chunks),
+                    mimetype='application/json', headers=headers)
+
+
+def count_streamed_bytes(chunks, route: str):
+    """Yields the chunks of a streamed response body, recording its size in
+    the response size metric once all of it was sent."""
+    nbytes = 0
+    for chunk in chunks:
+        nbytes += len(chunk)
+        yield chunk
+    metrics.RESPONSE_BYTES.observe(nbytes, route)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    timing.start()
+
+
+@app.after_request
+def record_request_metrics(response: Response):
+    """Records the latency and response size of every request, by route, and
+    reports where the time went as a Server-Timing header and in sampled
+    logs."""
+    route = request.url_rule.rule if request.url_rule else 'unknown'
+    elapsed = time.perf_counter() - g.request_start
+    metrics.REQUEST_SECONDS.observe(elapsed, route, response.status_code)
+    if response.content_length is not None:
+        metrics.RESPONSE_BYTES.observe(response.content_length, route)
+    elif response.is_streamed:
+        # Streamed bodies of unknown length, such as passthrough json, are
+        # recorded once they have been sent.
+        response.response = count_streamed_bytes(response.response, route)
+
+    phases = timing.stop()
+    phases['total'] = elapsed
+    if timing_config.header:
+        response.headers['Server-Timing'] = timing.format_server_timing(
+            phases)
+        # The site is served from another origin, and browsers only expose
+        # the timings of cross-origin requests that allow it.
+        if timing_config.allow_origin is not None:
+            response.headers['Timing-Allow-Origin'] = \
+                timing_config.allow_origin
+    if timing_config.should_log(elapsed):
+        timing.log_timings({'route': route,
+                            'status': response.status_code,
+                            'dataset': request.args.get('name')}, phases)
+    return response
 
 
 @app.route('/', methods=['GET'])
@@ -17,6 +224,27 @@ def get_program_name():
     return 'Running data server.'
 
 
+@app.route('/ready', methods=['GET'])
+def get_ready():
+    """Reports whether the server is done warming up its cache. Always ready
+    when cache warmup is disabled."""
+    if warmer is not None and not warmer.ready.is_set():
+        return 'Warming up cache.', 503
+    return 'Ready.'
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Returns the server's metrics in the Prometheus text format."""
+    stats = cache.stats()
+    metrics.CACHE_BYTES.set(stats['bytes'], 'memory')
+    metrics.CACHE_ENTRIES.set(stats['entries'], 'memory')
+    if 'disk_bytes' in stats:
+        metrics.CACHE_BYTES.set(stats['disk_bytes'], 'disk')
+        metrics.CACHE_ENTRIES.set(stats['disk_entries'], 'disk')
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/metadata', methods=['GET'])
 def get_metadata():
     """Downloads and returns metadata about available download files."""
@@ -27,39 +255,51 @@ def get_metadata():
         logging.error(err)
         return 'Internal server error: {}'.format(err), 500
 
-    def generate_response(data: bytes):
-        next_row = b'['
-        for row in data.splitlines():
-            yield next_row
-            next_row = row + b','
-        yield next_row.rstrip(b',') + b']'
     headers = Headers()
     headers.add('Content-Disposition', 'attachment',
                 filename=os.environ.get('METADATA_FILENAME'))
     headers.add('Vary', 'Accept-Encoding')
-    return Response(generate_response(metadata), mimetype='application/json',
-                    headers=headers)
+    return make_dataset_response(metadata, headers)
 
 
 @app.route('/dataset', methods=['GET'])
 def get_dataset():
-    """Downloads and returns the requested dataset if it exists."""
+    """Downloads and returns the requested dataset if it exists.
+
+    Rows of json datasets can be filtered with the state_fips, county_fips
+    (by prefix) and breakdown column url params, e.g. state_fips=06&sex=Male,
+    and trimmed to the columns listed in the columns url param. Rows of any
+    dataset can be paged with the offset and limit url params, and byte
+    ranges of csv datasets can be requested with the Range header. Datasets
+    too large to cache are streamed as-is, and can't be filtered or paged."""
     dataset_name = request.args.get('name')
     if dataset_name is None:
         return 'Request missing required url param \'name\'', 400
 
     try:
-        dataset = cache.getDataset(os.environ.get('GCS_BUCKET'), dataset_name)
+        row_filter = RowFilter.from_args(request.args)
+    except ValueError as err:
+        return str(err), 400
+
+    passthrough, dataset = None, None
+    try:
+        if row_filter is not None:
+            dataset = cache.get_filtered_dataset(
+                os.environ.get('GCS_BUCKET'), dataset_name, row_filter)
+        else:
+            passthrough = cache.get_passthrough(os.environ.get('GCS_BUCKET'),
+                                                dataset_name)
+            if passthrough is None:
+                dataset = cache.getDataset(os.environ.get('GCS_BUCKET'),
+                                           dataset_name)
+    except UnsupportedFilterError as err:
+        return str(err), 400
+    except exceptions.NotFound:
+        return 'Dataset {} not found'.format(dataset_name), 404
     except Exception as err:
         logging.error(err)
         return 'Internal server error: {}'.format(err), 500
 
-    def generate_response(data: bytes):
-        next_row = b'['
-        for row in dataset.splitlines():
-            yield next_row
-            next_row = row + b','
-        yield next_row.rstrip(b',') + b']'
     headers = Headers()
     headers.add('Content-Disposition', 'attachment', filename=dataset_name)
     headers.add('Vary', 'Accept-Encoding')
@@ -68,11 +308,95 @@ def get_dataset():
     # TTL, move this to a constant that's shared between them.
     headers.add('Cache-Control', 'public, max-age=7200')
 
-    if dataset_name.endswith('.csv'):
-        return Response(dataset, mimetype='text/csv', headers=headers)
+    if passthrough is not None:
+        return make_passthrough_response(dataset_name, passthrough, headers)
+    return make_dataset_response(dataset, headers,
+                                 accept_ranges=dataset.mimetype == 'text/csv')
+
+
+@app.route('/datasets', methods=['GET'])
+def get_datasets():
+    """Downloads and returns several datasets as a single json object keyed by
+    dataset name, e.g. /datasets?names=a.json,b.json. Csv datasets are
+    included as json strings."""
+    names = request.args.get('names')
+    if not names:
+        return 'Request missing required url param \'names\'', 400
+    # Drop duplicates, keeping the order of the request.
+    dataset_names = list(dict.fromkeys(
+        name for name in names.split(',') if name))
+    if len(dataset_names) > MAX_BATCH_DATASETS:
+        return 'Too many datasets requested, the max is {}'.format(
+            MAX_BATCH_DATASETS), 400
+
+    try:
+        batch = cache.get_batch(os.environ.get('GCS_BUCKET'), dataset_names)
+    except exceptions.NotFound as err:
+        return 'Dataset not found: {}'.format(err.message), 404
+    except Exception as err:
+        logging.error(err)
+        return 'Internal server error: {}'.format(err), 500
+
+    headers = Headers()
+    headers.add('Vary', 'Accept-Encoding')
+    headers.add('Cache-Control', 'public, max-age=7200')
+    return make_dataset_response(batch, headers)
+
+
+def is_invalidate_authorized() -> bool:
+    """Checks the request's token against INVALIDATE_TOKEN. The token can be
+    sent as a bearer token, or as the token url param for Pub/Sub push
+    subscriptions. Invalidation is disabled if INVALIDATE_TOKEN isn't set."""
+    expected = os.environ.get('INVALIDATE_TOKEN')
+    if not expected:
+        return False
+    token = request.args.get('token', '')
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    return hmac.compare_digest(token.encode(), expected.encode())
+
+
+def parse_invalidate_request(payload: dict) -> dict:
+    """Returns the invalidation request in payload, unwrapping it from a
+    Pub/Sub push message if needed. A message from a GCS bucket notification
+    invalidates the object it is about."""
+    message = payload.get('message')
+    if not isinstance(message, dict):
+        return payload
+    attributes = message.get('attributes') or {}
+    if 'objectId' in attributes:
+        return {'names': [attributes['objectId']]}
+    return json.loads(base64.b64decode(message.get('data', '')))
+
+
+@app.route('/invalidate', methods=['POST'])
+def invalidate():
+    """Drops or refreshes cached datasets, e.g. after new files were exported.
+    Takes a json body of the form
+    {"names": ["a.json"], "prefix": "cdc_restricted_data-", "refresh": true},
+    either directly or as the data of a Pub/Sub push message."""
+    if not is_invalidate_authorized():
+        return 'Forbidden', 403
+
+    try:
+        payload = parse_invalidate_request(request.get_json(force=True))
+        names = payload.get('names', [])
+        prefix = payload.get('prefix')
+        if isinstance(names, str) or not all(
+                isinstance(name, str) for name in names):
+            raise ValueError('names must be a list of strings')
+        if prefix is not None and not isinstance(prefix, str):
+            raise ValueError('prefix must be a string')
+        if not names and not prefix:
+            raise ValueError('Either names or prefix is required')
+    except Exception as err:  # pylint: disable=broad-except
+        return 'Bad request: {}'.format(err), 400
 
-    return Response(generate_response(dataset), mimetype='application/json',
-                    headers=headers)
+    invalidated = cache.invalidate(os.environ.get('GCS_BUCKET'), names,
+                                   prefix, bool(payload.get('refresh')))
+    logging.info('Invalidated %s', invalidated)
+    return jsonify({'invalidated': invalidated})
 
 
 if __name__ == "__main__":
@@ -1,3 +1,5 @@
+import base64
+import gzip
 import json
 import os
 from unittest import mock
@@ -6,7 +8,11 @@ import google.cloud.exceptions
 import pytest
 from flask.testing import FlaskClient
 
+from data_server import cached_dataset, metrics
 from data_server.dataset_cache import DatasetCache
+from data_server.disk_cache import DiskCache
+from data_server.gcs_utils import BlobMetadata, DownloadedBlob
+import main
 from main import app, cache
 
 os.environ['GCS_BUCKET'] = 'test'
@@ -33,15 +39,15 @@ test_data_csv = (
 
 
 def get_test_data(gcs_bucket: str, filename: str):
-    """Returns the contents of filename as a bytes object. Meant to be used to
-    patch gcs_utils.download_blob_as_bytes."""
-    return test_data
+    """Returns the contents and generation of filename. Meant to be used to
+    patch gcs_utils.download_blob."""
+    return DownloadedBlob(test_data, 1234)
 
 
 def get_test_data_csv(gcs_bucket: str, filename: str):
-    """Returns the contents of filename.csv as a bytes object. Meant to be used to
-    patch gcs_utils.download_blob_as_bytes."""
-    return test_data_csv
+    """Returns the contents and generation of filename.csv. Meant to be used
+    to patch gcs_utils.download_blob."""
+    return DownloadedBlob(test_data_csv, 5678)
 
 
 @pytest.fixture(autouse=True)
@@ -63,7 +69,22 @@ def testGetProgramName(client: FlaskClient):
     assert b'Running data server.' in response.data
 
 
-@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+def testGetReady(client: FlaskClient):
+    response = client.get('/ready')
+    assert response.status_code == 200
+
+    warmer = mock.MagicMock()
+    warmer.ready.is_set.return_value = False
+    with mock.patch('main.warmer', warmer):
+        response = client.get('/ready')
+        assert response.status_code == 503
+
+        warmer.ready.is_set.return_value = True
+        response = client.get('/ready')
+        assert response.status_code == 200
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
             side_effect=get_test_data)
 def testGetMetadata(mock_func: mock.MagicMock, client: FlaskClient):
     response = client.get('/metadata')
@@ -74,6 +95,7 @@ def testGetMetadata(mock_func: mock.MagicMock, client: FlaskClient):
     assert response.headers.get('Access-Control-Allow-Origin') == '*'
     assert response.headers.get('Vary') == 'Accept-Encoding'
     assert response.data == test_data_json
+    assert response.headers.get('Content-Length') == str(len(test_data_json))
     # Make sure that the response is valid json
     try:
         json.loads(response.data)
@@ -81,7 +103,7 @@ def testGetMetadata(mock_func: mock.MagicMock, client: FlaskClient):
         pytest.fail(err.msg)
 
 
-@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+@mock.patch('data_server.gcs_utils.download_blob',
             side_effect=get_test_data)
 def testGetMetadata_FromCache(mock_func: mock.MagicMock, client: FlaskClient):
     # Make the first request, which will incur an API call.
@@ -105,7 +127,7 @@ def testGetMetadata_InternalError(mock_func: mock.MagicMock,
     assert b'Internal server error: 404 File not found' in response.data
 
 
-@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+@mock.patch('data_server.gcs_utils.download_blob',
             side_effect=get_test_data)
 def testGetDataset_DataExists(mock_func: mock.MagicMock, client: FlaskClient):
     response = client.get('/dataset?name=test_dataset')
@@ -116,6 +138,7 @@ def testGetDataset_DataExists(mock_func: mock.MagicMock, client: FlaskClient):
     assert response.headers.get('Access-Control-Allow-Origin') == '*'
     assert response.headers.get('Vary') == 'Accept-Encoding'
     assert response.data == test_data_json
+    assert response.headers.get('Content-Length') == str(len(test_data_json))
     # Make sure that the response is valid json
     try:
         json.loads(response.data)
@@ -123,15 +146,176 @@ def testGetDataset_DataExists(mock_func: mock.MagicMock, client: FlaskClient):
         pytest.fail(err.msg)
 
 
-@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_FromCache(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset')
+    assert response.status_code == 200
+    mock_func.assert_called_once_with('test', 'test_dataset')
+
+    # The second request is served from the cached body.
+    response = client.get('/dataset?name=test_dataset')
+    assert response.status_code == 200
+    assert response.data == test_data_json
+    mock_func.assert_called_once()
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_Gzip(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') == 'gzip'
+    assert response.headers.get('Vary') == 'Accept-Encoding'
+    assert response.headers.get('Content-Length') == str(len(response.data))
+    assert gzip.decompress(response.data) == test_data_json
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_FromDisk(mock_func: mock.MagicMock, client: FlaskClient,
+                            tmp_path):
+    disk = DiskCache(str(tmp_path), promote_after=0)
+    disk_backed_cache = DatasetCache(max_cache_bytes=1, disk_cache=disk)
+    with mock.patch('main.cache', disk_backed_cache):
+        client.get('/dataset?name=test_dataset')
+        assert len(disk) == 1
+
+        response = client.get('/dataset?name=test_dataset')
+        assert response.status_code == 200
+        assert response.headers.get('Content-Length') == str(
+            len(test_data_json))
+        assert response.data == test_data_json
+
+        response = client.get('/dataset?name=test_dataset',
+                              headers={'Accept-Encoding': 'gzip'})
+        assert response.headers.get('Content-Encoding') == 'gzip'
+        assert gzip.decompress(response.data) == test_data_json
+    mock_func.assert_called_once()
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_Brotli(mock_func: mock.MagicMock, client: FlaskClient):
+    if cached_dataset.brotli is None:
+        pytest.skip('brotli is not installed')
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'gzip, deflate, br'})
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') == 'br'
+    assert response.headers.get('Content-Length') == str(len(response.data))
+    assert cached_dataset.brotli.decompress(response.data) == test_data_json
+
+    # Client preferences take precedence over the server's.
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'gzip, br;q=0.5'})
+    assert response.headers.get('Content-Encoding') == 'gzip'
+    mock_func.assert_called_once()
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_EncodingNotAcceptable(mock_func: mock.MagicMock,
+                                         client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'gzip;q=0, br;q=0'})
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') is None
+    assert response.data == test_data_json
+
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'deflate'})
+    assert response.headers.get('Content-Encoding') is None
+    assert response.data == test_data_json
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetMetadata_Gzip(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/metadata', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') == 'gzip'
+    assert gzip.decompress(response.data) == test_data_json
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_Etag(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset')
+    assert response.status_code == 200
+    assert response.headers.get('ETag') == '"1234"'
+
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers.get('ETag') == '"1234-gzip"'
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_IfNoneMatch(mock_func: mock.MagicMock,
+                               client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'If-None-Match': '"1234"'})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers.get('ETag') == '"1234"'
+    assert response.headers.get('Cache-Control') == 'public, max-age=7200'
+    assert response.headers.get('Vary') == 'Accept-Encoding'
+
+    # Tags of any representation of the same version match, including ones
+    # weakened by a proxy.
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'If-None-Match': 'W/"1234-gzip"',
+                                   'Accept-Encoding': 'gzip'})
+    assert response.status_code == 304
+    assert response.headers.get('ETag') == '"1234-gzip"'
+
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'If-None-Match': '"1", "1234-gzip"'})
+    assert response.status_code == 304
+
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'If-None-Match': '*'})
+    assert response.status_code == 304
+    mock_func.assert_called_once()
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_IfNoneMatchStale(mock_func: mock.MagicMock,
+                                    client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'If-None-Match': '"1233"'})
+    assert response.status_code == 200
+    assert response.headers.get('ETag') == '"1234"'
+    assert response.data == test_data_json
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetMetadata_IfNoneMatch(mock_func: mock.MagicMock,
+                                client: FlaskClient):
+    response = client.get('/metadata', headers={'If-None-Match': '"1234"'})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
             side_effect=google.cloud.exceptions.NotFound('File not found'))
 def testGetDataset_DatasetNotFound(mock_func: mock.MagicMock,
                                    client: FlaskClient):
     response = client.get('/dataset?name=not_found')
     mock_func.assert_called_once_with('test', 'not_found')
     assert response.headers.get('Access-Control-Allow-Origin') == '*'
-    assert response.status_code == 500
-    assert b'Internal server error: 404 File not found' in response.data
+    assert response.status_code == 404
+    assert b'Dataset not_found not found' in response.data
+
+    # Missing datasets are remembered for a while.
+    response = client.get('/dataset?name=not_found')
+    assert response.status_code == 404
+    mock_func.assert_called_once()
 
 
 def testGetDataset_UrlParamMissing(client: FlaskClient):
@@ -144,7 +328,7 @@ def testGetDataset_UrlParamMissing(client: FlaskClient):
     assert b'Request missing required url param \'name\'' in response.data
 
 
-@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+@mock.patch('data_server.gcs_utils.download_blob',
             side_effect=get_test_data_csv)
 def testGetDataset_csvType(mock_func: mock.MagicMock, client: FlaskClient):
     response = client.get('/dataset?name=test_dataset.csv')
@@ -155,3 +339,344 @@ def testGetDataset_csvType(mock_func: mock.MagicMock, client: FlaskClient):
            'attachment; filename=test_dataset.csv')
     # Make sure that the response hasn't changed
     assert response.data == test_data_csv
+    assert response.headers.get('Content-Length') == str(len(test_data_csv))
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_Filtered(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset&label1=value1'
+                          '&columns=label1,label3')
+    assert response.status_code == 200
+    # label1 isn't a filter column, so only the projection applies.
+    assert json.loads(response.data) == [
+        {'label1': 'value{}'.format(i), 'label3': 'value{}'.format(3 * i)}
+        for i in range(1, 7)]
+    assert response.headers['ETag'].startswith('"1234-')
+    assert response.headers.get('Cache-Control') == 'public, max-age=7200'
+
+    response = client.get('/dataset?name=test_dataset&state_fips=06')
+    assert response.status_code == 200
+    assert json.loads(response.data) == []
+    mock_func.assert_called_once()
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data_csv)
+def testGetDataset_FilteredCsv(mock_func: mock.MagicMock,
+                               client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset.csv&state_fips=06')
+    assert response.status_code == 400
+    assert b'does not support filtering' in response.data
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetMetrics(mock_func: mock.MagicMock, client: FlaskClient):
+    metrics.clear()
+    client.get('/dataset?name=test_dataset')
+    client.get('/dataset?name=test_dataset')
+
+    assert metrics.CACHE_MISSES.get('test_dataset') == 1
+    assert metrics.CACHE_HITS.get('test_dataset', 'memory') == 1
+    assert metrics.GCS_FETCH_SECONDS.get_count() == 1
+    assert metrics.REQUEST_SECONDS.get_count('/dataset', 200) == 2
+    assert metrics.RESPONSE_BYTES.get_sum('/dataset') == 2 * len(
+        test_data_json)
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    body = response.data.decode()
+    assert ('data_server_cache_hits_total{dataset="test_dataset",'
+            'tier="memory"} 1') in body
+    assert 'data_server_cache_bytes{{tier="memory"}} {}'.format(
+        cache.stats()['bytes']) in body
+    assert ('data_server_request_seconds_count{route="/dataset",'
+            'status="200"} 2') in body
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDatasets(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/datasets?names=a.json,b.json,a.json',
+                          headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+    assert response.headers.get('Content-Encoding') == 'gzip'
+    assert json.loads(gzip.decompress(response.data)) == {
+        'a.json': json.loads(test_data_json),
+        'b.json': json.loads(test_data_json)}
+    assert mock_func.call_count == 2
+
+    etag = response.headers.get('ETag')
+    response = client.get('/datasets?names=a.json,b.json',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def testGetDatasets_BadRequest(client: FlaskClient):
+    response = client.get('/datasets')
+    assert response.status_code == 400
+    assert b'Request missing required url param \'names\'' in response.data
+
+    names = ','.join('{}.json'.format(i) for i in range(21))
+    response = client.get('/datasets?names=' + names)
+    assert response.status_code == 400
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=google.cloud.exceptions.NotFound('File error'))
+def testGetDatasets_NotFound(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/datasets?names=a.json')
+    assert response.status_code == 404
+    assert b'Dataset not found: File error' in response.data
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_Page(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset&offset=2&limit=3')
+    assert response.status_code == 200
+    assert json.loads(response.data) == json.loads(test_data_json)[2:5]
+
+    response = client.get('/dataset?name=test_dataset&offset=first')
+    assert response.status_code == 400
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data_csv)
+def testGetDataset_CsvPage(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset.csv&offset=1')
+    assert response.status_code == 200
+    assert response.data == b'label1,label2,label3\nvalueD,valueE,valueF\n'
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data_csv)
+def testGetDataset_CsvRange(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset.csv',
+                          headers={'Range': 'bytes=6-11'})
+    assert response.status_code == 206
+    assert response.data == test_data_csv[6:12]
+    assert response.headers.get('Content-Range') == 'bytes 6-11/{}'.format(
+        len(test_data_csv))
+    assert response.headers.get('Content-Length') == '6'
+    assert response.headers.get('Accept-Ranges') == 'bytes'
+
+    response = client.get('/dataset?name=test_dataset.csv',
+                          headers={'Range': 'bytes=-4'})
+    assert response.status_code == 206
+    assert response.data == test_data_csv[-4:]
+
+    response = client.get('/dataset?name=test_dataset.csv',
+                          headers={'Range': 'bytes=1000-'})
+    assert response.status_code == 416
+    assert response.headers.get('Content-Range') == 'bytes */{}'.format(
+        len(test_data_csv))
+
+    # A range for another version of the file gets the whole file.
+    response = client.get('/dataset?name=test_dataset.csv',
+                          headers={'Range': 'bytes=0-3',
+                                   'If-Range': '"1"'})
+    assert response.status_code == 200
+    assert response.data == test_data_csv
+
+    response = client.get('/dataset?name=test_dataset.csv',
+                          headers={'Range': 'bytes=0-3',
+                                   'If-Range': '"5678"'})
+    assert response.status_code == 206
+    assert response.data == test_data_csv[:4]
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_JsonIgnoresRange(mock_func: mock.MagicMock,
+                                    client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Range': 'bytes=0-3'})
+    assert response.status_code == 200
+    assert response.data == test_data_json
+    assert response.headers.get('Accept-Ranges') is None
+
+
+@mock.patch.dict('os.environ', {'INVALIDATE_TOKEN': 'secret'})
+def testInvalidate(client: FlaskClient):
+    with mock.patch.object(cache, 'invalidate',
+                           return_value=['a.json']) as mock_invalidate:
+        response = client.post('/invalidate',
+                               json={'prefix': 'a', 'refresh': True},
+                               headers={'Authorization': 'Bearer secret'})
+        assert response.status_code == 200
+        assert response.get_json() == {'invalidated': ['a.json']}
+        mock_invalidate.assert_called_once_with('test', [], 'a', True)
+
+        # Pub/Sub push messages with the token in the url.
+        data = base64.b64encode(json.dumps({'names': ['b.json']}).encode())
+        response = client.post('/invalidate?token=secret',
+                               json={'message': {'data': data.decode()}})
+        assert response.status_code == 200
+        mock_invalidate.assert_called_with('test', ['b.json'], None, False)
+
+        # GCS notifications name the changed object in their attributes.
+        response = client.post('/invalidate?token=secret', json={
+            'message': {'attributes': {'objectId': 'c.json'}, 'data': ''}})
+        assert response.status_code == 200
+        mock_invalidate.assert_called_with('test', ['c.json'], None, False)
+
+
+@mock.patch.dict('os.environ', {'INVALIDATE_TOKEN': 'secret'})
+def testInvalidate_BadRequest(client: FlaskClient):
+    headers = {'Authorization': 'Bearer secret'}
+    for body in [{}, {'names': 'a.json'}, {'prefix': 5}, [1]]:
+        response = client.post('/invalidate', json=body, headers=headers)
+        assert response.status_code == 400
+    response = client.post('/invalidate', data='not json', headers=headers)
+    assert response.status_code == 400
+
+
+def testInvalidate_Forbidden(client: FlaskClient):
+    with mock.patch.object(cache, 'invalidate') as mock_invalidate:
+        response = client.post('/invalidate', json={'prefix': 'a'},
+                               headers={'Authorization': 'Bearer secret'})
+        assert response.status_code == 403
+
+        with mock.patch.dict('os.environ', {'INVALIDATE_TOKEN': 'secret'}):
+            response = client.post('/invalidate?token=wrong',
+                                   json={'prefix': 'a'})
+            assert response.status_code == 403
+        mock_invalidate.assert_not_called()
+
+
+def iter_test_chunks(gcs_bucket: str, filename: str, size: int,
+                     generation: int):
+    """Yields test_data in small chunks. Meant to be used to patch
+    gcs_utils.iter_blob_chunks."""
+    for start in range(0, size, 10):
+        yield test_data[start:start + 10]
+
+
+@mock.patch('data_server.gcs_utils.iter_blob_chunks',
+            side_effect=iter_test_chunks)
+@mock.patch('data_server.gcs_utils.get_blob_metadata',
+            return_value=BlobMetadata(1234, len(test_data)))
+@mock.patch('data_server.gcs_utils.download_blob')
+def testGetDataset_Passthrough(mock_download: mock.MagicMock,
+                               mock_meta: mock.MagicMock,
+                               mock_chunks: mock.MagicMock,
+                               client: FlaskClient):
+    with mock.patch.object(cache, 'passthrough_min_bytes', 10):
+        response = client.get('/dataset?name=test_dataset')
+        assert response.status_code == 200
+        assert response.mimetype == 'application/json'
+        assert response.data == test_data_json
+        assert response.headers.get('ETag') == '"1234"'
+        mock_chunks.assert_called_once_with('test', 'test_dataset',
+                                            len(test_data), 1234)
+
+        response = client.get('/dataset?name=test_dataset.csv')
+        assert response.mimetype == 'text/csv'
+        assert response.data == test_data
+        assert response.headers.get('Content-Length') == str(len(test_data))
+
+        response = client.get('/dataset?name=test_dataset',
+                              headers={'If-None-Match': '"1234"'})
+        assert response.status_code == 304
+
+    mock_download.assert_not_called()
+    assert cache.stats()['entries'] == 0
+
+
+@mock.patch('data_server.gcs_utils.get_blob_metadata',
+            return_value=BlobMetadata(1234, len(test_data)))
+@mock.patch('data_server.gcs_utils.download_blob')
+def testGetDataset_PassthroughFiltered(mock_download: mock.MagicMock,
+                                       mock_meta: mock.MagicMock,
+                                       client: FlaskClient):
+    with mock.patch.object(cache, 'passthrough_min_bytes', 10):
+        response = client.get('/dataset?name=test_dataset&limit=1')
+        assert response.status_code == 400
+        assert b'too large to filter' in response.data
+    mock_download.assert_not_called()
+
+
+def iter_overwritten_chunks(gcs_bucket: str, filename: str, size: int,
+                            generation: int):
+    """Fails like a ranged read of a generation that was overwritten. Meant to
+    be used to patch gcs_utils.iter_blob_chunks."""
+    raise google.cloud.exceptions.NotFound('No such object generation')
+    yield  # pylint: disable=unreachable
+
+
+@mock.patch('data_server.gcs_utils.get_blob_metadata',
+            return_value=BlobMetadata(1234, len(test_data)))
+def testGetDataset_PassthroughErrors(mock_meta: mock.MagicMock,
+                                     client: FlaskClient):
+    with mock.patch.object(cache, 'passthrough_min_bytes', 10):
+        # Errors reading the first chunk are reported before the response
+        # starts.
+        with mock.patch('data_server.gcs_utils.iter_blob_chunks',
+                        side_effect=iter_overwritten_chunks):
+            response = client.get('/dataset?name=test_dataset')
+            assert response.status_code == 404
+
+        with mock.patch('data_server.gcs_utils.iter_blob_chunks',
+                        side_effect=Exception('GCS is down')):
+            response = client.get('/dataset?name=test_dataset.csv')
+            assert response.status_code == 500
+
+        # The metadata is read again for every request.
+        assert mock_meta.call_count == 2
+
+
+@mock.patch('data_server.gcs_utils.iter_blob_chunks',
+            side_effect=iter_test_chunks)
+@mock.patch('data_server.gcs_utils.get_blob_metadata',
+            return_value=BlobMetadata(1234, len(test_data)))
+def testGetDataset_PassthroughMetrics(mock_meta: mock.MagicMock,
+                                      mock_chunks: mock.MagicMock,
+                                      client: FlaskClient):
+    metrics.clear()
+    with mock.patch.object(cache, 'passthrough_min_bytes', 10):
+        response = client.get('/dataset?name=test_dataset')
+        assert response.data == test_data_json
+
+    # The streamed body's length isn't known up front, so it is counted as
+    # it is sent.
+    assert metrics.RESPONSE_BYTES.get_count('/dataset') == 1
+    assert metrics.RESPONSE_BYTES.get_sum('/dataset') == len(test_data_json)
+
+
+@mock.patch('data_server.gcs_utils.download_blob', side_effect=get_test_data)
+def testGetDataset_ServerTiming(mock_func: mock.MagicMock,
+                                client: FlaskClient, capsys):
+    # Timings are only sent when enabled.
+    response = client.get('/dataset?name=test_dataset')
+    assert 'Server-Timing' not in response.headers
+    assert 'Timing-Allow-Origin' not in response.headers
+
+    config = main.timing_config._replace(
+        header=True, allow_origin='https://example.org')
+    with mock.patch.object(main, 'timing_config', config):
+        response = client.get('/dataset?name=test_dataset')
+    phases = [phase.split(';')[0] for phase in
+              response.headers['Server-Timing'].split(', ')]
+    assert phases[0] == 'lookup'
+    assert 'total' in phases
+    assert response.headers['Timing-Allow-Origin'] == 'https://example.org'
+    assert capsys.readouterr().out == ''
+
+    config = main.timing_config._replace(header=False, log_sample_rate=1)
+    with mock.patch.object(main, 'timing_config', config):
+        response = client.get('/dataset?name=test_dataset')
+    assert 'Server-Timing' not in response.headers
+    entry = json.loads(capsys.readouterr().out)
+    assert entry['route'] == '/dataset'
+    assert entry['status'] == 200
+    assert entry['dataset'] == 'test_dataset'
+    assert 'lookup' in entry['phases_ms']
+
+
+def testIterChunks():
+    assert list(main.iter_chunks(memoryview(b'abcdefg'), 3)) == [
+        b'abc', b'def', b'g']
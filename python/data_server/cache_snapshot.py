@@ -0,0 +1,320 @@
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import signal
+import socket
+import tempfile
+import time
+
+from google.cloud import exceptions
+
+from data_server import gcs_utils
+from data_server.cached_dataset import CachedDataset
+from data_server.dataset_cache import DatasetCache
+from data_server.dataset_index import DatasetIndex
+
+# Prefix and suffix of the files listing the saved datasets. Every process
+# that saves writes a manifest of its own, after the files it lists, and the
+# files of a dataset are named after its version. This way neither an
+# interrupted save nor other workers saving to the same destination can leave
+# a manifest pointing at missing or different files.
+MANIFEST_PREFIX = 'manifest-'
+MANIFEST_SUFFIX = '.json'
+
+# Seconds after which files that no manifest lists are deleted. Files that
+# are more recent may belong to a save still in progress in another process.
+CLEANUP_GRACE_SECONDS = 600
+
+# Max number of files uploaded to or downloaded from GCS at the same time.
+MAX_GCS_CONCURRENCY = 8
+
+SNAPSHOT_VERSION = 2
+
+
+class _LocalStore():
+    """Reads and writes snapshot files in a local directory."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def write(self, name: str, data: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.directory,
+                                         delete=False) as f:
+            f.write(data)
+        os.replace(f.name, os.path.join(self.directory, name))
+
+    def read(self, name: str) -> bytes:
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            return f.read()
+
+    def list(self) -> list:
+        """Returns a (name, modified time) pair for every file."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        files = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                modified = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            files.append((name, modified))
+        return files
+
+    def delete(self, name: str):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+
+class _GcsStore():
+    """Reads and writes snapshot files under a prefix of a GCS bucket."""
+
+    def __init__(self, gcs_bucket: str, prefix: str):
+        self.gcs_bucket = gcs_bucket
+        self.prefix = prefix
+
+    def _name(self, name: str) -> str:
+        return '{}/{}'.format(self.prefix, name) if self.prefix else name
+
+    def write(self, name: str, data: bytes):
+        gcs_utils.upload_blob(self.gcs_bucket, self._name(name), data)
+
+    def read(self, name: str) -> bytes:
+        return gcs_utils.download_blob(self.gcs_bucket, self._name(name)).data
+
+    def list(self) -> list:
+        """Returns a (name, modified time) pair for every file."""
+        prefix = self._name('')
+        return [(name[len(prefix):], modified) for name, modified in
+                gcs_utils.list_blobs(self.gcs_bucket, prefix)]
+
+    def delete(self, name: str):
+        try:
+            gcs_utils.delete_blob(self.gcs_bucket, self._name(name))
+        except exceptions.NotFound:
+            pass
+
+
+def _get_store(destination: str):
+    """Returns the store for a local directory or a gs://bucket/prefix
+    url."""
+    if destination.startswith('gs://'):
+        bucket, _, prefix = destination[len('gs://'):].partition('/')
+        return _GcsStore(bucket, prefix.strip('/'))
+    return _LocalStore(destination)
+
+
+def _map(store, func, items: list) -> list:
+    """Applies func to every item, concurrently for GCS stores."""
+    if not isinstance(store, _GcsStore) or len(items) < 2:
+        return [func(item) for item in items]
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_GCS_CONCURRENCY) as executor:
+        return list(executor.map(func, items))
+
+
+def _get_manifest_name() -> str:
+    """Returns the name of this process's manifest."""
+    return '{}{}-{}{}'.format(MANIFEST_PREFIX, socket.gethostname(),
+                              os.getpid(), MANIFEST_SUFFIX)
+
+
+def _is_manifest(name: str) -> bool:
+    return name.startswith(MANIFEST_PREFIX) and name.endswith(
+        MANIFEST_SUFFIX)
+
+
+def _file_name(entry: dict, encoding: str) -> str:
+    return '{}.{}.{}'.format(entry['key'], entry['version'], encoding)
+
+
+def _read_manifests(store) -> list:
+    """Returns a (name, manifest) pair for every manifest in the store.
+    Manifests that can't be read or were written by another snapshot version
+    have a manifest of None."""
+    manifests = []
+    for name, _ in store.list():
+        if not _is_manifest(name):
+            continue
+        try:
+            manifest = json.loads(store.read(name))
+        except Exception as err:  # pylint: disable=broad-except
+            logging.warning('Failed to read snapshot manifest %s: %s', name,
+                            err)
+            manifest = None
+        if manifest is not None and manifest.get(
+                'version') != SNAPSHOT_VERSION:
+            manifest = None
+        manifests.append((name, manifest))
+    return manifests
+
+
+def _clean_up(store, hard_cache_ttl: float):
+    """Deletes the manifests whose datasets are all past the hard TTL, and
+    the files that no remaining manifest lists."""
+    now = time.time()
+    files = store.list()
+    modified = dict(files)
+    listed = set()
+    for name, manifest in _read_manifests(store):
+        if manifest is None:
+            expired = now - modified.get(name, now) >= CLEANUP_GRACE_SECONDS
+        else:
+            saved_for = max(0, now - manifest['saved_at'])
+            expired = all(entry['age'] + saved_for >= hard_cache_ttl
+                          for entry in manifest['datasets'])
+        if expired:
+            store.delete(name)
+            continue
+        listed.add(name)
+        for entry in manifest['datasets'] if manifest is not None else []:
+            listed.update(_file_name(entry, encoding)
+                          for encoding in entry['sizes'])
+    for name, written_at in files:
+        if name not in listed and not _is_manifest(name) and \
+                now - written_at >= CLEANUP_GRACE_SECONDS:
+            store.delete(name)
+
+
+def save(cache: DatasetCache, destination: str) -> int:
+    """Saves the datasets held in the cache's memory, along with their
+    generation and age. Each process keeps a manifest of its own, so that
+    the workers of an instance can all save to the same destination. Files
+    of older saves that are no longer listed are deleted afterwards.
+
+    cache: DatasetCache to save.
+    destination: Local directory or gs://bucket/prefix url to save to.
+
+    Returns: The number of datasets saved."""
+    store = _get_store(destination)
+    files = []
+    entries = []
+    for table_id, dataset, age in cache.snapshot():
+        # Names include the dataset's version, so files are never replaced
+        # with a different version while a manifest still lists them.
+        entry = {'key': hashlib.sha1(table_id.encode()).hexdigest(),
+                 'version': hashlib.sha1(
+                     str(dataset.etag).encode()).hexdigest()[:16]}
+        representations = dict(dataset.encodings)
+        representations['identity'] = dataset.body
+        sizes = {}
+        for encoding, data in representations.items():
+            files.append((_file_name(entry, encoding), data))
+            sizes[encoding] = len(data)
+        entries.append(dict(
+            entry,
+            table_id=table_id,
+            mimetype=dataset.mimetype,
+            etag=dataset.etag,
+            generation=dataset.generation,
+            age=age,
+            sizes=sizes,
+            index=(dataset.index.to_dict()
+                   if dataset.index is not None else None)))
+
+    _map(store, lambda file: store.write(file[0], bytes(file[1])), files)
+    manifest = {'version': SNAPSHOT_VERSION, 'saved_at': time.time(),
+                'datasets': entries}
+    store.write(_get_manifest_name(), json.dumps(manifest).encode())
+    try:
+        _clean_up(store, cache.hard_cache_ttl)
+    except Exception as err:  # pylint: disable=broad-except
+        logging.warning('Failed to clean up cache snapshot %s: %s',
+                        destination, err)
+    return len(entries)
+
+
+def load(cache: DatasetCache, destination: str) -> int:
+    """Loads the datasets saved by save into the cache. They are marked
+    stale, so that each is revalidated against GCS the first time it is used.
+    When several manifests list a dataset, the most recently confirmed copy
+    is loaded. Datasets that are past the cache's hard TTL, or whose files
+    don't match the manifest, are skipped.
+
+    cache: DatasetCache to load the datasets into.
+    destination: Local directory or gs://bucket/prefix url to load from.
+
+    Returns: The number of datasets loaded."""
+    store = _get_store(destination)
+    try:
+        manifests = _read_manifests(store)
+    except Exception as err:  # pylint: disable=broad-except
+        logging.info('No cache snapshot loaded from %s: %s', destination,
+                     err)
+        return 0
+    # The youngest saved copy of each dataset, with its age.
+    entries: dict = {}
+    now = time.time()
+    for _, manifest in manifests:
+        if manifest is None:
+            continue
+        saved_for = max(0, now - manifest['saved_at'])
+        for entry in manifest['datasets']:
+            age = entry['age'] + saved_for
+            current = entries.get(entry['table_id'])
+            if current is None or age < current[1]:
+                entries[entry['table_id']] = (entry, age)
+
+    def load_entry(item: tuple) -> bool:
+        entry, age = item
+        if age >= cache.hard_cache_ttl:
+            return False
+        try:
+            representations = {
+                encoding: store.read(_file_name(entry, encoding))
+                for encoding in entry['sizes']}
+        except Exception as err:  # pylint: disable=broad-except
+            logging.warning('Failed to load %s from snapshot: %s',
+                            entry['table_id'], err)
+            return False
+        if any(len(representations[encoding]) != size
+               for encoding, size in entry['sizes'].items()):
+            return False
+        body = representations.pop('identity')
+        index = None
+        if entry['index'] is not None:
+            index = DatasetIndex.from_dict(entry['index'])
+        dataset = CachedDataset(body, entry['mimetype'], representations,
+                                entry['etag'], entry['generation'], index)
+        return cache.restore(entry['table_id'], dataset, age)
+
+    loaded = sum(_map(store, load_entry, list(entries.values())))
+    logging.info('Loaded %d datasets from cache snapshot %s', loaded,
+                 destination)
+    return loaded
+
+
+def save_on_sigterm(cache: DatasetCache, destination: str):
+    """Saves the cache when the process receives SIGTERM, then hands the
+    signal to the previously installed handler. Must be called from the main
+    thread."""
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        try:
+            count = save(cache, destination)
+            logging.info('Saved %d datasets to cache snapshot %s', count,
+                         destination)
+        except Exception as err:  # pylint: disable=broad-except
+            logging.warning('Failed to save cache snapshot: %s', err)
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            # Let the default action terminate the process.
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+def get_destination_from_env():
+    """Returns the snapshot destination configured with
+    DATASET_CACHE_SNAPSHOT, or None if snapshots are disabled."""
+    return os.environ.get('DATASET_CACHE_SNAPSHOT') or None
@@ -0,0 +1,141 @@
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import time
+
+from data_server.dataset_cache import DatasetCache
+
+# Default number of datasets downloaded at the same time while warming up. Can
+# be overridden with the DATASET_CACHE_WARMUP_CONCURRENCY environment variable.
+DEFAULT_CONCURRENCY = 4
+
+# Default number of seconds after which the server reports ready even if not
+# every dataset was loaded. Can be overridden with the
+# DATASET_CACHE_WARMUP_DEADLINE_SECONDS environment variable.
+DEFAULT_DEADLINE_SECONDS = 60
+
+
+def dataset_names_from_metadata(metadata) -> list:
+    """Returns the file names of the datasets listed in the metadata file,
+    given as a CachedDataset."""
+    rows = json.loads(bytes(metadata.body))
+    return ['{}.json'.format(row['id']) for row in rows if 'id' in row]
+
+
+class CacheWarmer():
+    """CacheWarmer prefetches datasets into a DatasetCache in the background
+    when the server starts, so that the first requests don't all wait for
+    GCS. Datasets are loaded in the given order until they are all loaded,
+    the cache's memory budget is full or the deadline passes, whichever comes
+    first."""
+
+    def __init__(self, cache: DatasetCache, gcs_bucket: str,
+                 dataset_names=None, metadata_filename=None,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 deadline_seconds=DEFAULT_DEADLINE_SECONDS):
+        """cache: DatasetCache to load the datasets into.
+        gcs_bucket: Name of GCS bucket where the datasets are stored.
+        dataset_names: List of dataset file names to load. If None, the
+                       datasets listed in the metadata file are loaded.
+        metadata_filename: Name of the metadata file. It is loaded first, and
+                           lists the datasets to load if dataset_names isn't
+                           given.
+        concurrency: Max number of datasets downloaded at the same time.
+        deadline_seconds: Seconds after which the warmup is reported done
+                          even if some datasets are still loading."""
+        self.cache = cache
+        self.gcs_bucket = gcs_bucket
+        self.dataset_names = dataset_names
+        self.metadata_filename = metadata_filename
+        self.concurrency = concurrency
+        self.deadline_seconds = deadline_seconds
+        # Set once the warmup is done or the deadline passed.
+        self.ready = threading.Event()
+        self.loaded: list = []
+        self.failed: list = []
+
+    def start(self):
+        """Starts warming up the cache in a background thread."""
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        """Warms up the cache, blocking until done or the deadline passes."""
+        deadline = time.monotonic() + self.deadline_seconds
+        try:
+            names = self._get_dataset_names()
+            initial_evictions = self.cache.stats()['evictions']
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency)
+            futures = [executor.submit(self._load, name, deadline,
+                                       initial_evictions)
+                       for name in names]
+            concurrent.futures.wait(
+                futures, timeout=max(0, deadline - time.monotonic()))
+            # Datasets still queued notice the deadline and skip themselves.
+            executor.shutdown(wait=False)
+        except Exception as err:  # pylint: disable=broad-except
+            logging.warning('Cache warmup failed: %s', err)
+        finally:
+            logging.info('Cache warmup done: %d datasets loaded, %d failed',
+                         len(self.loaded), len(self.failed))
+            self.ready.set()
+
+    def _get_dataset_names(self) -> list:
+        names = []
+        if self.metadata_filename:
+            metadata = self.cache.getDataset(self.gcs_bucket,
+                                             self.metadata_filename)
+            if self.dataset_names is None:
+                names = dataset_names_from_metadata(metadata)
+        if self.dataset_names is not None:
+            names = self.dataset_names
+        return names
+
+    def _load(self, name: str, deadline: float, initial_evictions: int):
+        """Loads a single dataset into the cache, unless the deadline passed
+        or the cache is already full."""
+        if time.monotonic() >= deadline:
+            return
+        stats = self.cache.stats()
+        # Once datasets start being evicted, loading more would only push out
+        # the ones loaded earlier, which are listed first for a reason.
+        if (stats['bytes'] >= stats['max_bytes'] or
+                stats['evictions'] > initial_evictions):
+            return
+        try:
+            self.cache.getDataset(self.gcs_bucket, name)
+            self.loaded.append(name)
+        except Exception as err:  # pylint: disable=broad-except
+            logging.warning('Failed to warm up %s: %s', name, err)
+            self.failed.append(name)
+
+
+def from_env(cache: DatasetCache):
+    """Returns a CacheWarmer for the given cache configured from the
+    environment, or None if DATASET_CACHE_WARMUP isn't enabled or GCS_BUCKET
+    isn't set.
+
+    DATASET_CACHE_WARMUP_DATASETS may hold a comma-separated list of dataset
+    file names to load instead of the ones listed in METADATA_FILENAME."""
+    if os.environ.get('DATASET_CACHE_WARMUP', '').lower() not in (
+            '1', 'true'):
+        return None
+    gcs_bucket = os.environ.get('GCS_BUCKET')
+    if not gcs_bucket:
+        logging.warning('Cache warmup is enabled but GCS_BUCKET is not set')
+        return None
+    dataset_names = None
+    if os.environ.get('DATASET_CACHE_WARMUP_DATASETS'):
+        dataset_names = [
+            name.strip() for name in
+            os.environ['DATASET_CACHE_WARMUP_DATASETS'].split(',')
+            if name.strip()]
+    return CacheWarmer(
+        cache, gcs_bucket, dataset_names,
+        os.environ.get('METADATA_FILENAME'),
+        int(os.environ.get('DATASET_CACHE_WARMUP_CONCURRENCY',
+                           DEFAULT_CONCURRENCY)),
+        float(os.environ.get('DATASET_CACHE_WARMUP_DEADLINE_SECONDS',
+                             DEFAULT_DEADLINE_SECONDS)))
@@ -0,0 +1,201 @@
+import base64
+import gzip
+import hashlib
+import json
+
+from data_server import timing
+from data_server.dataset_index import DatasetIndex
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional, gzip is always available.
+    brotli = None
+
+# Compression settings used when a dataset enters the cache. Each dataset is
+# compressed once per fill, so these favor ratio over speed a little more than
+# on-the-fly compression would, without making cache misses noticeably slower.
+GZIP_COMPRESS_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+class CachedDataset():
+    """A dataset held by DatasetCache, stored in the exact form it is served
+    in so that requests don't need to do any per-row work.
+
+    body: The response body. For csv files this is the file as stored in GCS.
+          For newline-delimited json files this is a single json array of all
+          the rows. Usually bytes, but datasets read from a DiskCache have
+          memory-mapped bodies.
+    mimetype: The mimetype of body.
+    encodings: Dict of content-coding name (e.g. 'gzip') to body compressed
+               with that coding.
+    etag: Strong entity tag identifying the version of the dataset, without
+          the surrounding quotes.
+    generation: The GCS generation of the file the dataset was built from, or
+                None if unknown.
+    index: DatasetIndex of the rows of body, or None if the dataset has no
+           rows to select from."""
+
+    def __init__(self, body: bytes, mimetype: str, encodings=None, etag=None,
+                 generation=None, index=None):
+        self.body = body
+        self.mimetype = mimetype
+        self.encodings = encodings if encodings is not None else {}
+        self.etag = etag
+        self.generation = generation
+        self.index = index
+        # When the dataset was last confirmed to be up to date with GCS,
+        # according to the owning cache's timer. Set by DatasetCache.
+        self.fetched_at = None
+
+    def get_etag(self, encoding=None) -> str:
+        """Returns the entity tag of the body compressed with the given
+        content-coding, or of the uncompressed body if encoding is None. Each
+        representation gets its own tag since their bytes differ."""
+        if encoding is None:
+            return self.etag
+        return '{}-{}'.format(self.etag, encoding)
+
+    @property
+    def in_memory(self) -> bool:
+        """Whether the body is held in memory, as opposed to being mapped from
+        a file on disk."""
+        return isinstance(self.body, bytes)
+
+    def copy_to_memory(self):
+        """Returns a copy of the dataset with its body and encodings read
+        into memory."""
+        copy = CachedDataset(
+            bytes(self.body), self.mimetype,
+            {encoding: bytes(encoded)
+             for encoding, encoded in self.encodings.items()},
+            self.etag, self.generation, self.index)
+        copy.fetched_at = self.fetched_at
+        return copy
+
+    @property
+    def nbytes(self) -> int:
+        """The number of bytes of memory used by the dataset, including its
+        compressed variants and index."""
+        nbytes = len(self.body) + sum(
+            len(encoded) for encoded in self.encodings.values())
+        if self.index is not None:
+            nbytes += self.index.nbytes
+        return nbytes
+
+
+def ndjson_to_json_array(data: bytes) -> bytes:
+    """Converts newline-delimited json rows to a single json array."""
+    return b'[' + b','.join(data.splitlines()) + b']'
+
+
+def iter_ndjson_to_json_array(chunks):
+    """Converts newline-delimited json rows, given as an iterable of chunks
+    split at arbitrary points, to a single json array yielded in chunks.
+    Only one chunk is held in memory at a time. Blank lines are skipped."""
+    yield b'['
+    pending = b''
+    first = True
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        rows = [line.rstrip(b'\r') for line in lines]
+        rows = [row for row in rows if row]
+        if rows:
+            yield (b'' if first else b',') + b','.join(rows)
+            first = False
+    pending = pending.rstrip(b'\r')
+    if pending:
+        yield (b'' if first else b',') + pending
+    yield b']'
+
+
+def compress(body: bytes) -> dict:
+    """Returns the compressed variants of body, keyed by content-coding.
+    Variants that aren't smaller than body are left out."""
+    with timing.phase('compress'):
+        encodings = {'gzip': gzip.compress(body, GZIP_COMPRESS_LEVEL)}
+        if brotli is not None:
+            encodings['br'] = brotli.compress(body, quality=BROTLI_QUALITY)
+    return {coding: encoded for coding, encoded in encodings.items()
+            if len(encoded) < len(body)}
+
+
+def make_etag(data: bytes, generation=None) -> str:
+    """Returns the entity tag for a dataset file. This is the GCS generation
+    of the file when known, otherwise the file's md5 hash."""
+    if generation is not None:
+        return str(generation)
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+def from_blob(table_id: str, data: bytes, generation=None) -> CachedDataset:
+    """Builds the servable form of a dataset downloaded from GCS.
+
+    table_id: Name of the dataset file. Files ending in .csv are served as-is,
+              everything else is treated as newline-delimited json.
+    data: The contents of the file.
+    generation: The GCS generation of the file, if known."""
+    etag = make_etag(data, generation)
+    if table_id.endswith('.csv'):
+        return CachedDataset(data, 'text/csv', compress(data), etag,
+                             generation, DatasetIndex.from_csv(data))
+    rows = data.splitlines()
+    body = b'[' + b','.join(rows) + b']'
+    return CachedDataset(body, 'application/json', compress(body), etag,
+                         generation, DatasetIndex.from_rows(rows))
+
+
+def from_datasets(datasets: dict, reuse_encodings=False) -> CachedDataset:
+    """Builds a single json object holding several datasets, keyed by
+    dataset name. Json datasets are included as-is, while other datasets such
+    as csv files are included as json strings.
+
+    datasets: Dict of dataset name to CachedDataset.
+    reuse_encodings: If set, only a gzip variant is built, from the gzip
+                     variants the json datasets already have plus the parts
+                     in between, instead of compressing the whole body. This
+                     is much cheaper for batches that are built on every
+                     request because they are too large to cache."""
+    # Pairs of bytes of the body and their gzip member, if one exists.
+    parts: list = [(b'{', None)]
+    for name, dataset in datasets.items():
+        if len(parts) > 1:
+            parts.append((b',', None))
+        parts.append((json.dumps(name).encode() + b':', None))
+        if dataset.mimetype == 'application/json':
+            gzipped = dataset.encodings.get('gzip')
+            parts.append((bytes(dataset.body),
+                          bytes(gzipped) if gzipped is not None else None))
+        else:
+            parts.append(
+                (json.dumps(bytes(dataset.body).decode()).encode(), None))
+    parts.append((b'}', None))
+    body = b''.join(data for data, _ in parts)
+
+    etags = json.dumps([[name, dataset.etag]
+                        for name, dataset in datasets.items()])
+    etag = hashlib.sha1(etags.encode()).hexdigest()[:16]
+    if not reuse_encodings:
+        return CachedDataset(body, 'application/json', compress(body), etag)
+
+    # A gzip stream of several members decompresses to the concatenation of
+    # their contents (RFC 1952), so only the parts without a member of their
+    # own need compressing.
+    members = []
+    uncompressed: list = []
+    with timing.phase('compress'):
+        for data, gzipped in parts:
+            if gzipped is None:
+                uncompressed.append(data)
+                continue
+            if uncompressed:
+                members.append(gzip.compress(b''.join(uncompressed),
+                                             GZIP_COMPRESS_LEVEL))
+                uncompressed = []
+            members.append(gzipped)
+        members.append(gzip.compress(b''.join(uncompressed),
+                                     GZIP_COMPRESS_LEVEL))
+    encoded = b''.join(members)
+    encodings = {'gzip': encoded} if len(encoded) < len(body) else {}
+    return CachedDataset(body, 'application/json', encodings, etag)
@@ -1,47 +1,789 @@
+import concurrent.futures
+import contextlib
+import logging
+import os
 import threading
+import time
 
 import cachetools
+from google.cloud import exceptions
 
-from data_server import gcs_utils
+from data_server import cached_dataset, gcs_utils, metrics, timing
+from data_server.dataset_index import RowFilter, UnsupportedFilterError
+
+# Default memory budget for cached datasets, in bytes. Can be overridden with
+# the DATASET_CACHE_MAX_BYTES environment variable.
+DEFAULT_MAX_CACHE_BYTES = 1024 * 1024 * 1024
+
+# Default memory budget for filtered datasets and batches, in bytes. Can be
+# overridden with the DATASET_CACHE_FILTERED_MAX_BYTES environment variable.
+DEFAULT_MAX_FILTERED_BYTES = 64 * 1024 * 1024
+
+# Default number of seconds a dataset that wasn't found in GCS is remembered
+# as missing.
+DEFAULT_NOT_FOUND_TTL = 60
+
+# Max number of missing datasets remembered at once. This is bounded
+# separately from the datasets so that requests for missing datasets can't
+# evict real ones.
+MAX_NOT_FOUND_ENTRIES = 1024
+
+# Default max number of datasets of a batch downloaded from GCS at the same
+# time.
+DEFAULT_BATCH_CONCURRENCY = 8
+
+
+def get_passthrough_min_bytes_from_env():
+    """Returns the size from which datasets are streamed from GCS instead of
+    cached, configured with DATASET_PASSTHROUGH_MIN_BYTES, or None if
+    passthrough is disabled."""
+    value = os.environ.get('DATASET_PASSTHROUGH_MIN_BYTES')
+    return int(value) if value else None
+
+
+def get_max_cache_bytes_from_env() -> int:
+    """Returns the cache memory budget configured in the environment, or the
+    default budget if DATASET_CACHE_MAX_BYTES is not set."""
+    return int(os.environ.get('DATASET_CACHE_MAX_BYTES',
+                              DEFAULT_MAX_CACHE_BYTES))
+
+
+class _SizedTTLCache(cachetools.TTLCache):
+    """TTLCache that keeps track of the entries that were evicted to make
+    room for new ones. Entries that simply expire are not counted."""
+
+    def __init__(self, maxsize, ttl, timer=time.monotonic, getsizeof=None):
+        super().__init__(maxsize=maxsize, ttl=ttl, timer=timer,
+                         getsizeof=getsizeof)
+        self.evictions = 0
+        # (key, value) pairs evicted since the owner last took them.
+        self.evicted = []
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        metrics.CACHE_EVICTIONS.inc(item[0])
+        self.evicted.append(item)
+        return item
+
+    def take_evicted(self) -> list:
+        """Returns the entries evicted since the last call."""
+        evicted, self.evicted = self.evicted, []
+        return evicted
+
+
+class _PendingFetch():
+    """A GCS fetch in progress for a single dataset. Callers that miss the
+    cache while the fetch is running wait on it instead of starting their own
+    download."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Whether the result was read from the disk cache rather than GCS.
+        self.from_disk = False
+        # Set when the dataset is invalidated while it is being fetched, since
+        # the fetch may have read the version from before the invalidation.
+        # Its result is then only handed to the callers already waiting, and
+        # isn't cached. Guarded by the owning cache's cache_lock.
+        self.invalidated = False
+
+    def wait(self):
+        """Blocks until the fetch completes, then returns its result or
+        raises its error."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
 
 
 class DatasetCache():
     """DatasetCache manages and stores datasets accessed through GCS.
-    DatasetCache is a thin, thread-safe wrapper around cachetools.TTLCache."""
+    DatasetCache is a thin, thread-safe wrapper around cachetools.TTLCache.
+    The cache is bounded by the total size of the stored datasets in bytes,
+    and evicts the least recently used datasets first when it is full.
 
-    def __init__(self, max_cache_size=8, cache_ttl=2 * 3600):
-        """max_cache_size: Max number of cache elements. Default 8.
-        cache_ttl: TTL per object in seconds. Default 2 hours."""
-        self.cache = cachetools.TTLCache(maxsize=max_cache_size, ttl=cache_ttl)
+    Datasets older than cache_ttl are still served, but are refreshed from GCS
+    in the background. Only datasets older than hard_cache_ttl are dropped, so
+    that the next request has to wait for GCS.
+
+    With a DiskCache, datasets evicted from memory or too large to keep in
+    memory are written to disk and served from there until they are fetched
+    often enough to be promoted back into memory. With a SharedDiskCache,
+    every dataset fetched from GCS is written to disk and served from there,
+    so that the worker processes of an instance share one copy."""
+
+    def __init__(self, max_cache_bytes=None, cache_ttl=2 * 3600,
+                 hard_cache_ttl=6 * 3600, timer=time.monotonic,
+                 disk_cache=None, max_filtered_bytes=None,
+                 not_found_ttl=DEFAULT_NOT_FOUND_TTL,
+                 passthrough_min_bytes=None):
+        """max_cache_bytes: Max total size of the cached datasets in bytes.
+                            Defaults to DATASET_CACHE_MAX_BYTES if set in the
+                            environment, otherwise 1 GiB.
+        cache_ttl: Seconds after which a dataset is refreshed in the
+                   background. Default 2 hours.
+        hard_cache_ttl: Seconds after which a dataset that couldn't be
+                        refreshed is no longer served. Default 6 hours.
+        timer: Clock used for the TTLs, in seconds. Mostly useful for
+               tests.
+        disk_cache: Optional DiskCache or SharedDiskCache used as a second
+                    tier.
+        max_filtered_bytes: Max total size of the cached filtered datasets and
+                            batches in bytes. Defaults to
+                            DATASET_CACHE_FILTERED_MAX_BYTES if set in the
+                            environment, otherwise 64 MiB.
+        not_found_ttl: Seconds during which a dataset that wasn't found in
+                       GCS is reported missing without checking GCS again.
+                       Default 1 minute.
+        passthrough_min_bytes: Size in bytes from which datasets are streamed
+                               from GCS on every request instead of being
+                               cached. Defaults to
+                               DATASET_PASSTHROUGH_MIN_BYTES if set in the
+                               environment, otherwise disabled."""
+        if max_cache_bytes is None:
+            max_cache_bytes = get_max_cache_bytes_from_env()
+        if passthrough_min_bytes is None:
+            passthrough_min_bytes = get_passthrough_min_bytes_from_env()
+        if max_filtered_bytes is None:
+            max_filtered_bytes = int(os.environ.get(
+                'DATASET_CACHE_FILTERED_MAX_BYTES',
+                DEFAULT_MAX_FILTERED_BYTES))
+        self.cache = _SizedTTLCache(maxsize=max_cache_bytes,
+                                    ttl=max(cache_ttl, hard_cache_ttl),
+                                    timer=timer,
+                                    getsizeof=lambda entry: entry.nbytes)
+        self.cache_ttl = cache_ttl
+        self.hard_cache_ttl = max(cache_ttl, hard_cache_ttl)
+        self.timer = timer
+        self.disk_cache = disk_cache
+        # Datasets built from cached ones: filtered datasets keyed by
+        # (table_id, etag, RowFilter) and batches keyed by a tuple of
+        # (table_id, etag). Including the etags means results built from an
+        # outdated version are never served. Guarded by cache_lock.
+        self.derived = cachetools.LRUCache(
+            maxsize=max_filtered_bytes, getsizeof=lambda entry: entry.nbytes)
+        # Messages of the NotFound errors of missing datasets, keyed by
+        # table_id. Guarded by cache_lock.
+        self.not_found = cachetools.TTLCache(maxsize=MAX_NOT_FOUND_ENTRIES,
+                                             ttl=not_found_ttl, timer=timer)
+        self.passthrough_min_bytes = passthrough_min_bytes
         self.cache_lock = threading.Lock()
+        # Fetches of missing datasets currently in progress, keyed by
+        # table_id. Guarded by cache_lock.
+        self.pending_fetches = {}
+        # Background refreshes of cached datasets currently in progress, keyed
+        # by table_id. They are tracked separately so that requests never wait
+        # on a refresh while a cached copy can be served. Guarded by
+        # cache_lock.
+        self.pending_refreshes = {}
+        # Where requests were served from. Guarded by cache_lock.
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.gcs_fetches = 0
 
     def clear(self):
         """Clears entries from the cache. Mostly useful for tests."""
         with self.cache_lock:
             self.cache.clear()
+            self.cache.take_evicted()
+            self.derived.clear()
+            self.not_found.clear()
+        if self.disk_cache is not None:
+            self.disk_cache.clear()
+
+    def invalidate(self, gcs_bucket: str, names=(), prefix=None,
+                   refresh=False) -> list:
+        """Drops or refreshes the given datasets, e.g. after new versions were
+        exported to GCS. Fetches of these datasets that are in progress may
+        have read the previous version, so their results aren't cached.
+
+        gcs_bucket: Name of GCS bucket where the datasets are stored.
+        names: Names of the data set files to invalidate.
+        prefix: If set, every dataset whose name starts with it is
+                invalidated too.
+        refresh: If True, datasets held in memory are kept and refreshed from
+                 GCS in the background, so they keep being served until the
+                 new version is ready. Otherwise they are dropped, and the
+                 next request for them waits for GCS.
+
+        Returns: Sorted list of the names of the invalidated datasets."""
+        names = set(names)
+
+        def matches(table_id: str) -> bool:
+            return table_id in names or (
+                prefix is not None and table_id.startswith(prefix))
+
+        refreshes = []
+        with self.cache_lock:
+            invalidated = {table_id for table_id in self.cache
+                           if matches(table_id)}
+            # Fetches and refreshes in progress may have read an outdated
+            # version. They are detached, so that they don't cache it and the
+            # next request or refresh starts over.
+            for in_progress in (self.pending_fetches, self.pending_refreshes):
+                for table_id in [table_id for table_id in in_progress
+                                 if matches(table_id)]:
+                    in_progress.pop(table_id).invalidated = True
+                    invalidated.add(table_id)
+            for table_id in invalidated:
+                if table_id not in self.cache:
+                    continue
+                if refresh:
+                    item = self.cache[table_id]
+                    pending = self._start_refresh_locked(table_id, item,
+                                                         force=True)
+                    refreshes.append((table_id, pending, item))
+                else:
+                    del self.cache[table_id]
+            # Filtered datasets and batches of an invalidated dataset are
+            # dropped, since they'd never be used once it changes.
+            for key in list(self.derived):
+                if isinstance(key[0], tuple):
+                    table_ids = [table_id for table_id, _ in key]
+                else:
+                    table_ids = [key[0]]
+                if any(matches(table_id) for table_id in table_ids):
+                    del self.derived[key]
+            # Missing datasets may have just been exported.
+            for table_id in list(self.not_found):
+                if matches(table_id):
+                    del self.not_found[table_id]
+
+        if self.disk_cache is not None:
+            for table_id in self.disk_cache.table_ids():
+                if matches(table_id):
+                    self.disk_cache.remove(table_id)
+                    invalidated.add(table_id)
+
+        for table_id, pending, item in refreshes:
+            self._run_refresh(gcs_bucket, table_id, pending, item)
+        return sorted(invalidated)
+
+    def stats(self) -> dict:
+        """Returns a snapshot of the cache's memory usage and hit counts.
+
+        Returns: dict with the number of bytes currently held in memory
+        ('bytes'), the configured budget ('max_bytes'), the number of
+        datasets held in memory ('entries'), the number of datasets evicted
+        from memory to stay under budget so far ('evictions'), the number of
+        requests served from memory ('memory_hits'), from disk ('disk_hits')
+        and the number of downloads from GCS ('gcs_fetches'). When a disk
+        cache is used, it also has the bytes ('disk_bytes') and datasets
+        ('disk_entries') held on disk."""
+        with self.cache_lock:
+            self.cache.expire()
+            stats = {'bytes': self.cache.currsize,
+                     'max_bytes': self.cache.maxsize,
+                     'entries': len(self.cache),
+                     'evictions': self.cache.evictions,
+                     'memory_hits': self.memory_hits,
+                     'disk_hits': self.disk_hits,
+                     'gcs_fetches': self.gcs_fetches}
+        if self.disk_cache is not None:
+            stats['disk_bytes'] = self.disk_cache.currsize
+            stats['disk_entries'] = len(self.disk_cache)
+        return stats
+
+    def snapshot(self) -> list:
+        """Returns the datasets held in memory, for saving them across
+        restarts.
+
+        Returns: List of (table_id, dataset, age) tuples, where age is the
+        number of seconds since the dataset was last confirmed to be up to
+        date with GCS."""
+        with self.cache_lock:
+            self.cache.expire()
+            now = self.timer()
+            return [(table_id, dataset, now - dataset.fetched_at)
+                    for table_id, dataset in self.cache.items()]
+
+    def restore(self, table_id: str, dataset, age: float) -> bool:
+        """Adds a dataset saved by snapshot to the cache, unless a dataset is
+        already cached for table_id. The dataset is marked stale, so that it
+        is served right away but revalidated against GCS on its first use.
+
+        table_id: Name of the data set file.
+        dataset: The saved CachedDataset.
+        age: Seconds since the dataset was last confirmed to be up to date,
+             including the time it spent saved.
+
+        Returns: Whether the dataset was added. Datasets older than the hard
+        TTL or larger than the memory budget are not."""
+        if age >= self.hard_cache_ttl or dataset.nbytes > self.cache.maxsize:
+            return False
+        with self.cache_lock:
+            if table_id in self.cache:
+                return False
+            dataset.fetched_at = self.timer() - max(age, self.cache_ttl)
+            self.cache[table_id] = dataset
+            evicted = self.cache.take_evicted()
+        self._write_to_disk(evicted)
+        return True
+
+    def get_passthrough(self, gcs_bucket: str, table_id: str):
+        """Checks whether the given dataset is too large to cache and should
+        be streamed from GCS instead. Only datasets that aren't cached are
+        checked, with a metadata request to GCS. The metadata isn't
+        remembered, so that every stream reads the latest generation of the
+        file.
+
+        gcs_bucket: Name of GCS bucket where the dataset is stored.
+        table_id: Name of the data set file to access.
+
+        Returns: The dataset's gcs_utils.BlobMetadata if it should be
+        streamed, None otherwise. Throws NotFound if the dataset doesn't
+        exist."""
+        if self.passthrough_min_bytes is None:
+            return None
+        with self.cache_lock:
+            not_found = self.not_found.get(table_id)
+            if not_found is not None:
+                raise exceptions.NotFound(not_found)
+            if table_id in self.cache:
+                return None
+        if self.disk_cache is not None and table_id in self.disk_cache:
+            return None
+
+        try:
+            with timing.phase('gcs'):
+                metadata = gcs_utils.get_blob_metadata(gcs_bucket, table_id)
+        except exceptions.NotFound as err:
+            with self.cache_lock:
+                self.not_found[table_id] = err.message
+            raise
+        if metadata.size is None or metadata.size < self.passthrough_min_bytes:
+            return None
+        return metadata
 
     def getDataset(self, gcs_bucket: str, table_id: str):
-        """Returns the given dataset identified by table_id as bytes.
+        """Returns the given dataset identified by table_id, ready to serve.
 
         getDataset will return the dataset from memory if it exists in the
-        cache. Otherwise, it will request the file from GCS and update the
-        cache on success.
+        cache, or from disk if there is a disk cache. Otherwise, it will
+        request the file from GCS, build the response body and update the
+        cache on success. Concurrent requests for a dataset that isn't cached
+        share a single download. Datasets larger than the cache's memory
+        budget are returned without being kept in memory.
 
         gcs_bucket: Name of GCS bucket where the dataset is stored.
         table_id: Name of the data set file to access.
 
-        Returns: Bytes object containing the dataset if successful. Throws
-        NotFoundError on failure."""
-        with self.cache_lock:
+        Returns: CachedDataset containing the dataset if successful. Throws
+        NotFound if the dataset doesn't exist, which is remembered for
+        not_found_ttl seconds, and other errors on failure."""
+        with timing.phase('lookup'), self._locked():
+            not_found = self.not_found.get(table_id)
+            if not_found is not None:
+                raise exceptions.NotFound(not_found)
             item = self.cache.get(table_id)
+            if item is not None and \
+                    self.timer() - item.fetched_at >= self.hard_cache_ttl:
+                # The cache expires entries a fixed time after they are
+                # added, which for restored datasets is later than their hard
+                # TTL.
+                del self.cache[table_id]
+                item = None
             if item is not None:
-                return item
+                self.memory_hits += 1
+                refresh = self._start_refresh_locked(table_id, item)
+            else:
+                # Only one caller downloads a given dataset at a time.
+                # Everyone else who misses meanwhile waits for that download
+                # to finish.
+                pending = self.pending_fetches.get(table_id)
+                if pending is not None:
+                    is_owner = False
+                else:
+                    pending = _PendingFetch()
+                    self.pending_fetches[table_id] = pending
+                    is_owner = True
 
+        if item is not None:
+            metrics.CACHE_HITS.inc(table_id, 'memory')
+            self._run_refresh(gcs_bucket, table_id, refresh, item)
+            return item
+
+        try:
+            dataset = self._get_missing(gcs_bucket, table_id, pending,
+                                        is_owner)
+        except Exception:
+            metrics.CACHE_MISSES.inc(metrics.UNKNOWN_DATASET)
+            raise
+        if pending.from_disk:
+            # With a shared disk cache datasets usually live on disk only, so
+            # reading them from there counts as a hit.
+            metrics.CACHE_HITS.inc(table_id, 'disk')
+        else:
+            metrics.CACHE_MISSES.inc(table_id)
+        return dataset
+
+    def get_filtered_dataset(self, gcs_bucket: str, table_id: str,
+                             row_filter: RowFilter):
+        """Returns the rows of the given dataset selected by row_filter, ready
+        to serve. Json datasets can be filtered, projected and paged, while
+        csv datasets can only be paged. The rows are looked up in the
+        dataset's index, and the result is cached so that repeating the same
+        request only costs a dictionary lookup.
+
+        gcs_bucket: Name of GCS bucket where the dataset is stored.
+        table_id: Name of the data set file to access.
+        row_filter: RowFilter to apply to the dataset.
+
+        Returns: CachedDataset containing the filtered dataset. Throws
+        UnsupportedFilterError if the dataset can't be filtered, including
+        datasets too large to cache, and the same errors as getDataset
+        otherwise."""
+        # Filtering needs the whole dataset and its index in memory, which is
+        # what streaming large datasets avoids.
+        if self.get_passthrough(gcs_bucket, table_id) is not None:
+            raise UnsupportedFilterError(
+                'Dataset {} is too large to filter'.format(table_id))
+        dataset = self.getDataset(gcs_bucket, table_id)
+        if dataset.index is None or (not dataset.index.filterable and
+                                     not row_filter.is_page_only):
+            raise UnsupportedFilterError(
+                'Dataset {} does not support filtering'.format(table_id))
+
+        key = (table_id, dataset.etag, row_filter)
+        with self.cache_lock:
+            filtered = self.derived.get(key)
+        if filtered is not None:
+            return filtered
+
+        # Concurrent requests for the same filter may both build it, which is
+        # harmless and cheap compared to a GCS fetch.
+        with timing.phase('build'):
+            body = dataset.index.filter_body(dataset.body, row_filter)
+            filtered = cached_dataset.CachedDataset(
+                body, dataset.mimetype, cached_dataset.compress(body),
+                '{}-{}'.format(dataset.etag, row_filter.digest()),
+                dataset.generation)
+        self._put_derived(key, filtered)
+        return filtered
+
+    def get_datasets(self, gcs_bucket: str, table_ids: list,
+                     max_workers=DEFAULT_BATCH_CONCURRENCY) -> dict:
+        """Returns several datasets at once. Datasets that aren't in memory
+        are fetched concurrently.
+
+        gcs_bucket: Name of GCS bucket where the datasets are stored.
+        table_ids: Names of the data set files to access.
+        max_workers: Max number of datasets fetched at the same time.
+
+        Returns: Dict of table_id to CachedDataset, in the order of
+        table_ids. Throws the first error of the failed fetches, if any."""
+        with self.cache_lock:
+            missing = [table_id for table_id in table_ids
+                       if table_id not in self.cache]
+
+        datasets = {}
+        if len(missing) > 1:
+            # Phases of the fetches themselves happen on other threads, so
+            # they are only recorded as a whole.
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(len(missing), max_workers))
+            with timing.phase('fetch'), executor:
+                futures = [(table_id,
+                            executor.submit(self.getDataset, gcs_bucket,
+                                            table_id))
+                           for table_id in missing]
+            for table_id, future in futures:
+                datasets[table_id] = future.result()
+
+        result = {}
+        for table_id in table_ids:
+            dataset = datasets.get(table_id)
+            if dataset is None:
+                dataset = self.getDataset(gcs_bucket, table_id)
+            result[table_id] = dataset
+        return result
+
+    def get_batch(self, gcs_bucket: str, table_ids: list):
+        """Returns several datasets as a single json object keyed by dataset
+        name, ready to serve. The object is cached so that repeating the same
+        request only costs a dictionary lookup per dataset, unless it is
+        larger than the budget for filtered datasets and batches.
+
+        gcs_bucket: Name of GCS bucket where the datasets are stored.
+        table_ids: Names of the data set files to access.
+
+        Returns: CachedDataset containing the json object. Throws the same
+        errors as getDataset."""
+        datasets = self.get_datasets(gcs_bucket, table_ids)
+        key = tuple((table_id, dataset.etag)
+                    for table_id, dataset in datasets.items())
+        with self.cache_lock:
+            batch = self.derived.get(key)
+        if batch is not None:
+            return batch
+
+        # Batches that won't fit the cache are built again on every request,
+        # so they reuse the datasets' compressed variants instead of
+        # compressing the whole batch.
+        too_large = sum(dataset.nbytes for dataset in datasets.values()) > \
+            self.derived.maxsize
+        with timing.phase('build'):
+            batch = cached_dataset.from_datasets(datasets,
+                                                 reuse_encodings=too_large)
+        if not too_large:
+            self._put_derived(key, batch)
+        return batch
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Holds cache_lock, recording the time spent waiting for it."""
+        with timing.phase('lock'):
+            self.cache_lock.acquire()
+        try:
+            yield
+        finally:
+            self.cache_lock.release()
+
+    def _put_derived(self, key, dataset):
+        with self.cache_lock:
+            if dataset.nbytes <= self.derived.maxsize:
+                self.derived[key] = dataset
+
+    def _get_missing(self, gcs_bucket: str, table_id: str, pending,
+                     is_owner: bool):
+        """Returns a dataset that isn't in memory, waiting on `pending` unless
+        this caller owns the fetch, in which case it reads the dataset from
+        disk or GCS and hands it to everyone waiting."""
+        if not is_owner:
+            with timing.phase('lock'):
+                return pending.wait()
+        try:
+            if self.disk_cache is None:
+                return self._fill(gcs_bucket, table_id, pending)
+            # Copies on disk are served without the fill lock, which is only
+            # needed to fill the dataset.
+            dataset = self._get_from_disk(gcs_bucket, table_id, pending)
+            if dataset is not None:
+                return dataset
+            with contextlib.ExitStack() as stack:
+                # With a shared disk cache, workers that miss the same dataset
+                # take turns here, and all but the first find it on disk.
+                with timing.phase('lock'):
+                    stack.enter_context(self.disk_cache.fill_lock(table_id))
+                dataset = self._get_from_disk(gcs_bucket, table_id, pending)
+                if dataset is not None:
+                    return dataset
+                return self._fill(gcs_bucket, table_id, pending)
+        except Exception as err:
+            # Whatever failed, the callers waiting on this fetch get the error
+            # and the next request tries again.
+            self._abandon(table_id, pending, err)
+            raise
+
+    def _get_from_disk(self, gcs_bucket: str, table_id: str, pending):
+        """Returns the dataset from the disk cache and hands it to everyone
+        waiting on `pending`, promoting it to memory if it has been read often
+        enough. Returns None if the disk cache doesn't have a usable copy."""
+        with timing.phase('disk'):
+            dataset, hits = self.disk_cache.get(table_id)
+        if dataset is None:
+            return None
+        if self.timer() - dataset.fetched_at >= self.hard_cache_ttl:
+            self.disk_cache.remove(table_id)
+            return None
+
+        promote_after = self.disk_cache.promote_after
+        promote = (promote_after > 0 and hits >= promote_after
+                   and dataset.nbytes <= self.cache.maxsize)
+        if promote:
+            dataset = dataset.copy_to_memory()
+
+        evicted = []
+        with self.cache_lock:
+            self.disk_hits += 1
+            if promote and not pending.invalidated:
+                self.cache[table_id] = dataset
+                evicted = self.cache.take_evicted()
+            self._unregister_locked(table_id, pending)
+            refresh = self._start_refresh_locked(table_id, dataset)
+        pending.result = dataset
+        pending.from_disk = True
+        pending.done.set()
+
+        self._write_to_disk(evicted)
+        self._run_refresh(gcs_bucket, table_id, refresh, dataset)
+        return dataset
+
+    def _write_to_disk(self, datasets: list):
+        """Writes the given (table_id, dataset) pairs to the disk cache, if
+        there is one."""
+        if self.disk_cache is None or not datasets:
+            return
+        for table_id, dataset in datasets:
+            try:
+                with timing.phase('disk'):
+                    self.disk_cache.put(table_id, dataset)
+            except OSError as err:
+                logging.warning('Failed to write %s to disk: %s', table_id,
+                                err)
+
+    def _start_refresh_locked(self, table_id: str, item, force=False):
+        """Registers a background refresh for the cached item if it is older
+        than the cache TTL, or force is set, and isn't already being
+        refreshed. Must be called with cache_lock held.
+
+        Returns: The _PendingFetch for the new refresh, or None if no refresh
+        is needed."""
+        if not force and self.timer() - item.fetched_at < self.cache_ttl:
+            return None
+        if table_id in self.pending_refreshes:
+            return None
+        pending = _PendingFetch()
+        self.pending_refreshes[table_id] = pending
+        return pending
+
+    def _unregister_locked(self, table_id: str, pending):
+        """Removes `pending` from the fetches or refreshes in progress, if it
+        is still registered there. Must be called with cache_lock held."""
+        for in_progress in (self.pending_fetches, self.pending_refreshes):
+            if in_progress.get(table_id) is pending:
+                del in_progress[table_id]
+
+    def _abandon(self, table_id: str, pending, err: Exception):
+        """Unregisters `pending` and hands err to everyone waiting on it,
+        unless it was already resolved."""
+        with self.cache_lock:
+            self._unregister_locked(table_id, pending)
+        if not pending.done.is_set():
+            pending.error = err
+            pending.done.set()
+
+    def _run_refresh(self, gcs_bucket: str, table_id: str, pending, current):
+        """Starts the refresh registered by _start_refresh_locked, if any, in a
+        background thread."""
+        if pending is None:
+            return
+        threading.Thread(target=self._refresh,
+                         args=(gcs_bucket, table_id, pending, current),
+                         daemon=True).start()
+
+    def _refresh(self, gcs_bucket: str, table_id: str, pending, current):
+        """Refreshes a cached dataset in the background, keeping the current
+        one if GCS still has the same generation of the file."""
+        try:
+            if self.disk_cache is None or not self.disk_cache.shared:
+                self._fill(gcs_bucket, table_id, pending, current)
+            else:
+                self._refresh_shared(gcs_bucket, table_id, pending, current)
+        except Exception as err:  # pylint: disable=broad-except
+            # The stale dataset keeps being served until it hits the hard TTL.
+            logging.warning('Failed to refresh %s: %s', table_id, err)
+            # Whatever failed, the refresh mustn't stay registered, or the
+            # dataset would never be refreshed again.
+            self._abandon(table_id, pending, err)
+
+    def _refresh_shared(self, gcs_bucket: str, table_id: str, pending,
+                        current):
+        """Refreshes a dataset of the shared disk cache. The fill lock is
+        only held when a new version has to be downloaded, so that checking
+        GCS doesn't hold up the other workers."""
+        # Another worker may have refreshed the dataset already.
+        latest, _ = self.disk_cache.get(table_id)
+        if latest is not None:
+            current = latest
+        if current.generation is not None:
+            with timing.phase('gcs'):
+                metadata = gcs_utils.get_blob_metadata(gcs_bucket, table_id)
+            if metadata.generation == current.generation:
+                self._store(table_id, pending, current)
+                return
+        with self.disk_cache.fill_lock(table_id):
+            latest, _ = self.disk_cache.get(table_id)
+            if latest is not None:
+                current = latest
+            self._fill(gcs_bucket, table_id, pending, current)
+
+    def _fill(self, gcs_bucket: str, table_id: str, pending, current=None):
+        """Fetches the dataset from GCS, stores it in the cache and hands it to
+        everyone waiting on `pending`.
+
+        current: The cached dataset being refreshed, if any. It is kept as-is
+                 if its generation is still the latest one in GCS."""
         # Release the lock while performing IO.
-        blob_str = gcs_utils.download_blob_as_bytes(gcs_bucket, table_id)
+        try:
+            dataset = self._fetch(gcs_bucket, table_id, current)
+        except Exception as err:
+            with self.cache_lock:
+                self._unregister_locked(table_id, pending)
+                if isinstance(err, exceptions.NotFound) and \
+                        current is None and not pending.invalidated:
+                    self.not_found[table_id] = err.message
+            pending.error = err
+            pending.done.set()
+            raise
+        return self._store(table_id, pending, dataset)
+
+    def _store(self, table_id: str, pending, dataset):
+        """Stores a dataset that was just fetched from GCS or confirmed to be
+        up to date with it, and hands it to everyone waiting on `pending`."""
+        dataset.fetched_at = self.timer()
+        share = (self.disk_cache is not None and self.disk_cache.shared
+                 and not pending.invalidated)
+        if share:
+            dataset = self._share(table_id, dataset)
 
         # If this has been updated since we last checked, it's still okay to
         # overwrite since it will only affect freshness.
         with self.cache_lock:
-            self.cache[table_id] = blob_str
-            return blob_str
+            invalidated = pending.invalidated
+            if invalidated:
+                # Invalidated while it was being fetched, so it may be an
+                # outdated version. It is only handed to the callers already
+                # waiting for it.
+                to_disk = []
+            elif dataset.in_memory and dataset.nbytes <= self.cache.maxsize:
+                self.cache[table_id] = dataset
+                to_disk = self.cache.take_evicted()
+            else:
+                # Too large for memory, or a refreshed copy that still lives
+                # on disk.
+                to_disk = [(table_id, dataset)]
+            self._unregister_locked(table_id, pending)
+        pending.result = dataset
+        pending.done.set()
+
+        if invalidated and share:
+            # The copy written to the shared disk cache is outdated too.
+            self.disk_cache.remove(table_id)
+        self._write_to_disk(to_disk)
+        return dataset
+
+    def _share(self, table_id: str, dataset):
+        """Writes a dataset fetched from GCS to the shared disk cache, and
+        returns the mapped copy so that this process doesn't keep a copy of
+        its own. Returns the dataset as-is if it couldn't be written."""
+        if not dataset.in_memory:
+            return dataset
+        self._write_to_disk([(table_id, dataset)])
+        with timing.phase('disk'):
+            shared, _ = self.disk_cache.get(table_id)
+        if shared is None or shared.etag != dataset.etag:
+            return dataset
+        return shared
+
+    def _fetch(self, gcs_bucket: str, table_id: str, current=None):
+        """Downloads the dataset from GCS and builds its servable form. If
+        current is given and GCS still has the same generation of the file,
+        current is returned without downloading the file again."""
+        if current is not None and current.generation is not None:
+            with timing.phase('gcs'):
+                metadata = gcs_utils.get_blob_metadata(gcs_bucket, table_id)
+            if metadata.generation == current.generation:
+                return current
+
+        start = time.perf_counter()
+        with timing.phase('gcs'):
+            blob = gcs_utils.download_blob(gcs_bucket, table_id)
+        metrics.GCS_FETCH_SECONDS.observe(time.perf_counter() - start)
+        with self.cache_lock:
+            self.gcs_fetches += 1
+        with timing.phase('build'):
+            return cached_dataset.from_blob(table_id, blob.data,
+                                            blob.generation)
@@ -0,0 +1,280 @@
+import base64
+import hashlib
+import json
+from array import array
+from typing import NamedTuple, Optional, Sequence
+
+# Columns that rows can be filtered on. They all have few distinct values
+# compared to the number of rows, so an index from value to rows stays small.
+FILTER_COLUMNS = ('state_fips', 'county_fips', 'race_category_id',
+                  'race_and_ethnicity', 'race', 'hispanic_or_latino',
+                  'race_includes_hispanic', 'age', 'sex')
+
+# Filter columns that match values by prefix rather than exactly, so that
+# e.g. county_fips=06 selects every county in California.
+PREFIX_COLUMNS = ('county_fips',)
+
+
+class UnsupportedFilterError(ValueError):
+    """Raised when a filter is requested on a dataset that can't be
+    filtered, such as a csv file."""
+
+
+def _index_key(value) -> str:
+    """Returns the string a row value is indexed under, which is what it
+    looks like in a url parameter."""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _split_args(args, name: str) -> list:
+    """Returns the comma-separated values of every url parameter called
+    name."""
+    return [value for arg in args.getlist(name)
+            for value in arg.split(',') if value]
+
+
+def _encode_array(values: array) -> dict:
+    return {'typecode': values.typecode,
+            'data': base64.b64encode(values.tobytes()).decode('ascii')}
+
+
+def _decode_array(encoded: dict) -> array:
+    values = array(encoded['typecode'])
+    values.frombytes(base64.b64decode(encoded['data']))
+    return values
+
+
+def _get_int_arg(args, name: str) -> Optional[int]:
+    """Returns the url parameter called name as a non-negative int, or None
+    if it isn't set. Throws ValueError if it isn't a non-negative int."""
+    value = args.get(name)
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise ValueError(
+            'Url param \'{}\' must be a non-negative integer'.format(name))
+    return int(value)
+
+
+class RowFilter(NamedTuple):
+    """A filter, projection and page of a dataset's rows.
+
+    filters: Tuple of (column, values) pairs, sorted by column. A row is kept
+             if, for every column, its value is one of the column's values.
+    columns: Tuple of the columns to keep in each row, or None to keep the
+             rows as-is.
+    offset: Number of rows to skip, after filtering.
+    limit: Max number of rows to keep after skipping offset rows, or None to
+           keep them all."""
+    filters: tuple
+    columns: Optional[tuple]
+    offset: int = 0
+    limit: Optional[int] = None
+
+    @classmethod
+    def from_args(cls, args):
+        """Builds the filter from url parameters, given as a MultiDict. Each
+        filter parameter may be repeated or hold comma-separated values.
+        Returns None if no filter, projection or page was requested. Throws
+        ValueError if offset or limit isn't a non-negative int."""
+        filters = []
+        for column in FILTER_COLUMNS:
+            values = _split_args(args, column)
+            if values:
+                filters.append((column, tuple(sorted(set(values)))))
+        columns = None
+        if 'columns' in args:
+            columns = tuple(_split_args(args, 'columns'))
+        offset = _get_int_arg(args, 'offset')
+        limit = _get_int_arg(args, 'limit')
+        if not filters and columns is None and offset is None and (
+                limit is None):
+            return None
+        return cls(tuple(filters), columns, offset or 0, limit)
+
+    @property
+    def is_page_only(self) -> bool:
+        """Whether the filter only selects a page of rows."""
+        return not self.filters and self.columns is None
+
+    def digest(self) -> str:
+        """Returns a short hash identifying the filter, for use in etags."""
+        canonical = json.dumps([self.filters, self.columns, self.offset,
+                                self.limit])
+        return hashlib.sha1(canonical.encode()).hexdigest()[:16]
+
+
+class DatasetIndex():
+    """Index of the rows of a dataset, built once when the dataset enters the
+    cache so that filtering and paging don't need to scan every row.
+
+    starts, ends: Byte offsets of each row within the dataset's body. The
+                  bytes between two consecutive rows are the separator.
+    values: Dict of column to a dict of indexed value to the ids of the rows
+            holding that value, in row order. None if the rows can't be
+            filtered, as for csv files.
+    prefix, separator, suffix: Bytes that go before, between and after the
+                               rows to make up a body."""
+
+    def __init__(self, starts: array, ends: array, values=None,
+                 prefix=b'[', separator=b',', suffix=b']'):
+        self.starts = starts
+        self.ends = ends
+        self.values = values
+        self.prefix = prefix
+        self.separator = separator
+        self.suffix = suffix
+
+    @property
+    def filterable(self) -> bool:
+        """Whether rows can be filtered and projected, not only paged."""
+        return self.values is not None
+
+    @classmethod
+    def from_rows(cls, rows: list):
+        """Builds the index of the json array made by joining rows with
+        commas inside brackets, as cached_dataset.ndjson_to_json_array does.
+        Returns None if the rows aren't all json objects."""
+        starts, ends = array('Q'), array('Q')
+        values: dict = {column: {} for column in FILTER_COLUMNS}
+        position = 1  # Skip the opening bracket.
+        for row_id, row in enumerate(rows):
+            try:
+                parsed = json.loads(row)
+            except ValueError:
+                return None
+            if not isinstance(parsed, dict):
+                return None
+            starts.append(position)
+            position += len(row)
+            ends.append(position)
+            position += 1  # Skip the comma.
+
+            for column, column_values in values.items():
+                value = parsed.get(column)
+                if value is None or isinstance(value, (dict, list)):
+                    continue
+                row_ids = column_values.get(_index_key(value))
+                if row_ids is None:
+                    row_ids = column_values[_index_key(value)] = array('L')
+                row_ids.append(row_id)
+        return cls(starts, ends, values)
+
+    @classmethod
+    def from_csv(cls, data: bytes):
+        """Builds the index of the lines of a csv file in a single pass over
+        its bytes. The header line is kept as the prefix of every page, and
+        line breaks inside quoted fields don't end a row."""
+        starts, ends = array('Q'), array('Q')
+        header_end = None
+        position, row_start, quotes = 0, 0, 0
+        while position < len(data):
+            newline = data.find(b'\n', position)
+            end = len(data) if newline == -1 else newline + 1
+            # An odd number of quotes so far means the line break is inside a
+            # quoted field.
+            quotes += data.count(b'"', position, end)
+            position = end
+            if quotes % 2 and position < len(data):
+                continue
+            if header_end is None:
+                header_end = position
+            else:
+                starts.append(row_start)
+                ends.append(position)
+            row_start = position
+        header = data[:header_end] if header_end is not None else b''
+        return cls(starts, ends, None, header, b'', b'')
+
+    def to_dict(self) -> dict:
+        """Returns the index as a json-serializable dict, which can be turned
+        back into an index with from_dict."""
+        values = None
+        if self.values is not None:
+            values = {column: {key: _encode_array(row_ids)
+                               for key, row_ids in column_values.items()}
+                      for column, column_values in self.values.items()}
+        return {'starts': _encode_array(self.starts),
+                'ends': _encode_array(self.ends),
+                'values': values,
+                'delimiters': [
+                    base64.b64encode(delimiter).decode('ascii')
+                    for delimiter in (self.prefix, self.separator,
+                                      self.suffix)]}
+
+    @classmethod
+    def from_dict(cls, encoded: dict):
+        """Rebuilds an index from the output of to_dict."""
+        values = None
+        if encoded['values'] is not None:
+            values = {column: {key: _decode_array(row_ids)
+                               for key, row_ids in column_values.items()}
+                      for column, column_values in encoded['values'].items()}
+        prefix, separator, suffix = (base64.b64decode(delimiter)
+                                     for delimiter in encoded['delimiters'])
+        return cls(_decode_array(encoded['starts']),
+                   _decode_array(encoded['ends']), values, prefix, separator,
+                   suffix)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate number of bytes of memory used by the index."""
+        nbytes = (self.starts.itemsize * len(self.starts) +
+                  self.ends.itemsize * len(self.ends) + len(self.prefix))
+        for column_values in (self.values or {}).values():
+            for key, row_ids in column_values.items():
+                nbytes += len(key) + row_ids.itemsize * len(row_ids)
+        return nbytes
+
+    def _matching_rows(self, column: str, wanted: tuple) -> set:
+        column_values = self.values[column]
+        if column in PREFIX_COLUMNS:
+            keys = [key for key in column_values
+                    if key.startswith(wanted)]
+        else:
+            keys = [key for key in wanted if key in column_values]
+        rows = set()
+        for key in keys:
+            rows.update(column_values[key])
+        return rows
+
+    def select(self, row_filter: RowFilter) -> Sequence[int]:
+        """Returns the ids of the rows that pass row_filter's filters and are
+        in its page, in row order."""
+        if not row_filter.filters:
+            selected: Sequence[int] = range(len(self.starts))
+        else:
+            matching = set.intersection(*(
+                self._matching_rows(column, wanted)
+                for column, wanted in row_filter.filters))
+            selected = sorted(matching)
+        stop = None
+        if row_filter.limit is not None:
+            stop = row_filter.offset + row_filter.limit
+        return selected[row_filter.offset:stop]
+
+    def filter_body(self, body, row_filter: RowFilter) -> bytes:
+        """Returns a body made of the rows of body selected by row_filter,
+        with only the requested columns if any."""
+        selected = self.select(row_filter)
+        if row_filter.columns is None and isinstance(selected, range):
+            # Consecutive rows are a single slice of the body.
+            if not selected:
+                return self.prefix + self.suffix
+            return (self.prefix +
+                    body[self.starts[selected[0]]:self.ends[selected[-1]]] +
+                    self.suffix)
+
+        rows = []
+        for row_id in selected:
+            row = body[self.starts[row_id]:self.ends[row_id]]
+            if row_filter.columns is not None:
+                parsed = json.loads(row)
+                row = json.dumps(
+                    {column: parsed[column] for column in row_filter.columns
+                     if column in parsed},
+                    separators=(',', ':'), ensure_ascii=False).encode()
+            rows.append(row)
+        return self.prefix + self.separator.join(rows) + self.suffix
@@ -0,0 +1,463 @@
+import collections
+import contextlib
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+from data_server.cached_dataset import CachedDataset
+from data_server.dataset_index import DatasetIndex
+
+# Default disk budget for the disk cache, in bytes. Can be overridden with the
+# DATASET_CACHE_DISK_MAX_BYTES environment variable.
+DEFAULT_MAX_DISK_BYTES = 4 * 1024 * 1024 * 1024
+
+# Default number of disk cache hits after which a dataset is copied back into
+# memory. Can be overridden with the DATASET_CACHE_DISK_PROMOTE_AFTER
+# environment variable. 0 means datasets are never promoted.
+DEFAULT_PROMOTE_AFTER = 2
+
+# Number of fill lock files of a SharedDiskCache. Datasets share them by hash
+# of their table_id, so that requests for arbitrary names can't create lock
+# files without bound, while fills of different datasets rarely wait on each
+# other.
+FILL_LOCK_FILES = 64
+
+
+class _DiskEntry():
+    """Bookkeeping for one dataset stored on disk. The dataset's index is
+    small, so it stays in memory."""
+
+    def __init__(self, key: str, nbytes: int, meta: dict, index=None):
+        self.key = key
+        self.nbytes = nbytes
+        self.meta = meta
+        self.index = index
+        self.hits = 0
+
+
+def _write_file(directory: str, path: str, data):
+    """Writes data to path atomically, so that readers in other threads or
+    processes see either the old file or the new one."""
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        f.write(data)
+    os.replace(f.name, path)
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _touch(path: str):
+    """Sets the modification time of the file at path to now, with more
+    precision than the kernel gives files when they're written."""
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+def _map_file(path: str):
+    """Maps the file at path into memory read-only. Returns b'' for empty
+    files, which can't be mapped."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class DiskCache():
+    """DiskCache stores datasets that don't fit in DatasetCache's memory in a
+    local directory, bounded by a disk budget. The least recently used
+    datasets are deleted first when the budget is exceeded.
+
+    Datasets are read back as memory-mapped files, so serving them doesn't
+    copy the whole dataset into Python bytes. Note that on Cloud Run the local
+    filesystem is in-memory, so the disk budget counts against the instance's
+    memory limit."""
+
+    # Whether the stored datasets are shared with other processes.
+    shared = False
+
+    def __init__(self, directory: str, max_disk_bytes=DEFAULT_MAX_DISK_BYTES,
+                 promote_after=DEFAULT_PROMOTE_AFTER):
+        """directory: Directory to store the datasets in. Each DiskCache uses
+                      its own new subdirectory of it.
+        max_disk_bytes: Max total size of the stored datasets in bytes.
+        promote_after: Number of hits after which a dataset should be copied
+                       back into memory, or 0 to never promote datasets."""
+        os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='dataset-cache-',
+                                          dir=directory)
+        self.max_disk_bytes = max_disk_bytes
+        self.promote_after = promote_after
+        self.currsize = 0
+        # Entries in least to most recently used order, keyed by table_id.
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, table_id: str):
+        return table_id in self.entries
+
+    def _path(self, key: str, encoding=None) -> str:
+        name = key if encoding is None else '{}.{}'.format(key, encoding)
+        return os.path.join(self.directory, name)
+
+    def put(self, table_id: str, dataset: CachedDataset):
+        """Writes the dataset to disk, evicting the least recently used
+        datasets to stay under the disk budget. Datasets larger than the whole
+        budget are skipped. If the same version of the dataset is already
+        stored, only its fetched_at time is updated."""
+        with self.lock:
+            existing = self.entries.get(table_id)
+            if existing is not None and existing.meta['etag'] == dataset.etag:
+                existing.meta['fetched_at'] = dataset.fetched_at
+                return
+        if dataset.nbytes > self.max_disk_bytes:
+            return
+
+        # Files are written under a new name and swapped in, so that readers
+        # that still have the old files mapped are unaffected.
+        key = hashlib.sha1(
+            (table_id + '\0' + str(dataset.etag)).encode()).hexdigest()
+        representations = dict(dataset.encodings)
+        representations[None] = dataset.body
+        for encoding, data in representations.items():
+            _write_file(self.directory, self._path(key, encoding), data)
+
+        meta = {'mimetype': dataset.mimetype,
+                'encodings': sorted(dataset.encodings),
+                'etag': dataset.etag,
+                'generation': dataset.generation,
+                'fetched_at': dataset.fetched_at}
+        with self.lock:
+            # A concurrent put of the same version may have just written the
+            # same files, so only delete files under a different key.
+            self._remove_locked(table_id, keep_key=key)
+            self.entries[table_id] = _DiskEntry(key, dataset.nbytes, meta,
+                                                dataset.index)
+            self.currsize += dataset.nbytes
+            while self.currsize > self.max_disk_bytes:
+                self._remove_locked(next(iter(self.entries)))
+
+    def get(self, table_id: str):
+        """Returns the dataset stored for table_id with its body and encodings
+        memory-mapped, along with the number of times it has been read
+        including this one. Returns (None, 0) if it isn't stored."""
+        with self.lock:
+            entry = self.entries.get(table_id)
+            if entry is None:
+                return None, 0
+            self.entries.move_to_end(table_id)
+            entry.hits += 1
+            hits = entry.hits
+            # Open the files under the lock so they can't be deleted first.
+            meta = entry.meta
+            index = entry.index
+            body = _map_file(self._path(entry.key))
+            encodings = {encoding: _map_file(self._path(entry.key, encoding))
+                         for encoding in meta['encodings']}
+
+        dataset = CachedDataset(body, meta['mimetype'], encodings,
+                                meta['etag'], meta['generation'], index)
+        dataset.fetched_at = meta['fetched_at']
+        return dataset, hits
+
+    def table_ids(self) -> list:
+        """Returns the names of the stored datasets."""
+        with self.lock:
+            return list(self.entries)
+
+    def fill_lock(self, table_id: str):
+        """Returns a context manager held while filling table_id. DiskCache
+        belongs to a single process, whose DatasetCache already makes sure
+        only one thread fills a dataset at a time, so this does nothing."""
+        return contextlib.nullcontext()
+
+    def remove(self, table_id: str):
+        """Deletes the dataset stored for table_id, if any."""
+        with self.lock:
+            self._remove_locked(table_id)
+
+    def clear(self):
+        with self.lock:
+            for table_id in list(self.entries):
+                self._remove_locked(table_id)
+
+    def _remove_locked(self, table_id: str, keep_key=None):
+        entry = self.entries.pop(table_id, None)
+        if entry is None:
+            return
+        self.currsize -= entry.nbytes
+        if entry.key == keep_key:
+            return
+        for encoding in [None] + entry.meta['encodings']:
+            _remove_file(self._path(entry.key, encoding))
+
+
+class SharedDiskCache():
+    """SharedDiskCache stores datasets in a directory shared by every worker
+    process of an instance, such as a directory under /dev/shm, so that the
+    workers share one copy of each dataset instead of each downloading and
+    holding its own. It has the same interface as DiskCache.
+
+    All the bookkeeping lives in the directory: each dataset has a metadata
+    file, named after a hash of its table_id, next to its body and encodings.
+    Datasets are read back as memory-mapped files, whose pages the kernel
+    shares between the processes mapping them. Fills of a dataset are
+    serialized across processes with one of a fixed set of lock files, and
+    writes and evictions with a lock file for the whole directory. The
+    modification time of a dataset's body records when it was last read, for
+    evicting the least recently used datasets first.
+
+    fetched_at times are compared across processes, so the owning
+    DatasetCaches must use a clock shared by the whole machine, such as the
+    default time.monotonic."""
+
+    shared = True
+
+    def __init__(self, directory: str, max_disk_bytes=DEFAULT_MAX_DISK_BYTES,
+                 promote_after=0):
+        """directory: Directory to store the datasets in, shared by every
+                      process using the same datasets.
+        max_disk_bytes: Max total size of the stored datasets in bytes.
+        promote_after: Number of hits in this process after which a dataset
+                       should be copied into the process's memory, or 0 to
+                       never promote datasets. Defaults to 0, since promoted
+                       datasets are no longer shared."""
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.promote_after = promote_after
+        # Number of reads of each dataset in this process, keyed by table_id.
+        self.hits: collections.Counter = collections.Counter()
+        # Parsed metadata files, keyed by key. Each value is a
+        # (file identity, metadata, DatasetIndex) tuple, so that metadata is
+        # only parsed again after it is rewritten.
+        self.parsed: dict = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._read_all_meta())
+
+    def __contains__(self, table_id: str):
+        return os.path.exists(self._meta_path(self._key(table_id)))
+
+    @property
+    def currsize(self) -> int:
+        """The total size of the stored datasets in bytes."""
+        return sum(meta['nbytes'] for _, meta in self._read_all_meta())
+
+    @staticmethod
+    def _key(table_id: str) -> str:
+        return hashlib.sha1(table_id.encode()).hexdigest()
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.json')
+
+    def _path(self, key: str, version: str, encoding=None) -> str:
+        name = '{}.{}'.format(key, version)
+        if encoding is not None:
+            name = '{}.{}'.format(name, encoding)
+        return os.path.join(self.directory, name)
+
+    @contextlib.contextmanager
+    def _flock(self, name: str):
+        """Holds an exclusive lock on the lock file called name across
+        processes. Lock files are never deleted, since a process could be
+        waiting on one."""
+        with open(os.path.join(self.directory, name), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def fill_lock(self, table_id: str):
+        """Returns a context manager that holds table_id's fill lock across
+        processes. Callers that miss the cache hold it while checking the
+        cache again and fetching the dataset, so that the other workers wait
+        and then find the dataset stored instead of downloading it too."""
+        slot = int(self._key(table_id), 16) % FILL_LOCK_FILES
+        return self._flock('fill-{:02d}.lock'.format(slot))
+
+    def _read_meta(self, key: str):
+        """Returns the metadata of the dataset stored under key, along with
+        its DatasetIndex. Returns (None, None) if it isn't stored."""
+        try:
+            with open(self._meta_path(key), 'rb') as f:
+                info = os.fstat(f.fileno())
+                identity = (info.st_ino, info.st_mtime_ns, info.st_size)
+                with self.lock:
+                    parsed = self.parsed.get(key)
+                if parsed is not None and parsed[0] == identity:
+                    return parsed[1], parsed[2]
+                meta = json.loads(f.read())
+        except FileNotFoundError:
+            return None, None
+        index = None
+        if meta['index'] is not None:
+            index = DatasetIndex.from_dict(meta['index'])
+        with self.lock:
+            self.parsed[key] = (identity, meta, index)
+        return meta, index
+
+    def _read_all_meta(self) -> list:
+        """Returns a (key, metadata) pair for every stored dataset."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                meta, _ = self._read_meta(name[:-len('.json')])
+                if meta is not None:
+                    entries.append((name[:-len('.json')], meta))
+        return entries
+
+    def _write_meta(self, key: str, meta: dict):
+        _write_file(self.directory, self._meta_path(key),
+                    json.dumps(meta).encode())
+
+    def put(self, table_id: str, dataset: CachedDataset):
+        """Writes the dataset to the shared directory, evicting the least
+        recently used datasets to stay under the disk budget. Datasets larger
+        than the whole budget are skipped. If the same version of the dataset
+        is already stored, only its fetched_at time is updated."""
+        key = self._key(table_id)
+        existing, _ = self._read_meta(key)
+        if existing is not None and existing['etag'] == dataset.etag:
+            if existing['fetched_at'] != dataset.fetched_at:
+                with self._flock('.lock'):
+                    self._write_meta(key, dict(
+                        existing, fetched_at=dataset.fetched_at))
+            return
+        if dataset.nbytes > self.max_disk_bytes:
+            return
+
+        version = hashlib.sha1(str(dataset.etag).encode()).hexdigest()[:16]
+        representations = dict(dataset.encodings)
+        representations[None] = dataset.body
+        for encoding, data in representations.items():
+            _write_file(self.directory, self._path(key, version, encoding),
+                        data)
+        _touch(self._path(key, version))
+        meta = {'table_id': table_id,
+                'version': version,
+                'nbytes': dataset.nbytes,
+                'mimetype': dataset.mimetype,
+                'encodings': sorted(dataset.encodings),
+                'etag': dataset.etag,
+                'generation': dataset.generation,
+                'fetched_at': dataset.fetched_at,
+                'index': (dataset.index.to_dict()
+                          if dataset.index is not None else None)}
+        with self._flock('.lock'):
+            existing, _ = self._read_meta(key)
+            self._write_meta(key, meta)
+            if existing is not None and existing['version'] != version:
+                self._remove_files(key, existing)
+            self._evict_locked()
+
+    def get(self, table_id: str):
+        """Returns the dataset stored for table_id with its body and encodings
+        memory-mapped, along with the number of times this process has read
+        it including this one. Returns (None, 0) if it isn't stored."""
+        key = self._key(table_id)
+        meta, index = self._read_meta(key)
+        if meta is None:
+            return None, 0
+        path = self._path(key, meta['version'])
+        try:
+            body = _map_file(path)
+            encodings = {
+                encoding: _map_file(self._path(key, meta['version'],
+                                               encoding))
+                for encoding in meta['encodings']}
+            _touch(path)
+        except FileNotFoundError:
+            # Replaced or evicted by another process since the metadata was
+            # read.
+            return None, 0
+        with self.lock:
+            self.hits[table_id] += 1
+            hits = self.hits[table_id]
+
+        dataset = CachedDataset(body, meta['mimetype'], encodings,
+                                meta['etag'], meta['generation'], index)
+        dataset.fetched_at = meta['fetched_at']
+        return dataset, hits
+
+    def table_ids(self) -> list:
+        """Returns the names of the stored datasets."""
+        return [meta['table_id'] for _, meta in self._read_all_meta()]
+
+    def remove(self, table_id: str):
+        """Deletes the dataset stored for table_id, if any."""
+        key = self._key(table_id)
+        with self._flock('.lock'):
+            meta, _ = self._read_meta(key)
+            if meta is not None:
+                self._remove_files(key, meta)
+
+    def clear(self):
+        with self._flock('.lock'):
+            for key, meta in self._read_all_meta():
+                self._remove_files(key, meta)
+        with self.lock:
+            self.hits.clear()
+
+    def _remove_files(self, key: str, meta: dict):
+        """Deletes a dataset's files, metadata first so that readers don't
+        look for the rest. Must be called with the directory lock held."""
+        current, _ = self._read_meta(key)
+        if current is not None and current['version'] == meta['version']:
+            _remove_file(self._meta_path(key))
+        for encoding in [None] + meta['encodings']:
+            _remove_file(self._path(key, meta['version'], encoding))
+
+    def _evict_locked(self):
+        """Deletes the least recently read datasets until the stored ones
+        fit the disk budget. Must be called with the directory lock held."""
+        entries = []
+        for key, meta in self._read_all_meta():
+            try:
+                last_read = os.stat(
+                    self._path(key, meta['version'])).st_mtime_ns
+            except FileNotFoundError:
+                last_read = 0
+            entries.append((last_read, key, meta))
+        size = sum(meta['nbytes'] for _, _, meta in entries)
+        for _, key, meta in sorted(entries, key=lambda entry: entry[0]):
+            if size <= self.max_disk_bytes:
+                break
+            self._remove_files(key, meta)
+            size -= meta['nbytes']
+
+
+def from_env():
+    """Returns a DiskCache configured from the environment, or None if
+    neither DATASET_CACHE_DISK_DIR nor DATASET_CACHE_SHARED_DIR is set. If
+    DATASET_CACHE_SHARED_DIR is set, it is a SharedDiskCache shared by every
+    worker using the same directory."""
+    shared_directory = os.environ.get('DATASET_CACHE_SHARED_DIR')
+    if shared_directory:
+        return SharedDiskCache(
+            shared_directory,
+            int(os.environ.get('DATASET_CACHE_DISK_MAX_BYTES',
+                               DEFAULT_MAX_DISK_BYTES)),
+            int(os.environ.get('DATASET_CACHE_DISK_PROMOTE_AFTER', 0)))
+    directory = os.environ.get('DATASET_CACHE_DISK_DIR')
+    if not directory:
+        return None
+    return DiskCache(
+        directory,
+        int(os.environ.get('DATASET_CACHE_DISK_MAX_BYTES',
+                           DEFAULT_MAX_DISK_BYTES)),
+        int(os.environ.get('DATASET_CACHE_DISK_PROMOTE_AFTER',
+                           DEFAULT_PROMOTE_AFTER)))
@@ -1,8 +1,135 @@
+import os
+import threading
+from typing import NamedTuple, Optional
+
 from google.cloud import storage
+from requests.adapters import HTTPAdapter
+
+# Max number of HTTP connections kept open to GCS. This should be at least the
+# number of threads serving requests, which is 8 in the Dockerfile's gunicorn
+# command. Can be overridden with the GCS_HTTP_POOL_SIZE environment variable.
+DEFAULT_HTTP_POOL_SIZE = 8
+
+# Timeout in seconds for each request to GCS. Can be overridden with the
+# GCS_TIMEOUT_SECONDS environment variable.
+DEFAULT_TIMEOUT_SECONDS = 60
+
+# Size of the ranged reads used to stream objects from GCS.
+DEFAULT_CHUNK_BYTES = 1024 * 1024
+
+_client = None
+_buckets: dict = {}
+_client_lock = threading.Lock()
+
+
+def get_timeout() -> float:
+    """Returns the timeout in seconds for each request to GCS."""
+    return float(os.environ.get('GCS_TIMEOUT_SECONDS',
+                                DEFAULT_TIMEOUT_SECONDS))
+
+
+def get_client() -> storage.Client:
+    """Returns the storage client shared by the whole process, creating it on
+    first use. Reusing the client avoids redoing auth and TLS setup on every
+    request to GCS."""
+    global _client  # pylint: disable=global-statement
+    with _client_lock:
+        if _client is None:
+            pool_size = int(os.environ.get('GCS_HTTP_POOL_SIZE',
+                                           DEFAULT_HTTP_POOL_SIZE))
+            client = storage.Client()
+            # The default pool only keeps 10 connections per host, and is
+            # shared by all threads. Size it to the number of threads so that
+            # concurrent fetches don't have to open new connections.
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size)
+            # pylint: disable=protected-access
+            client._http.mount('https://', adapter)
+            client._http.mount('http://', adapter)
+            _client = client
+        return _client
+
+
+def get_bucket(gcs_bucket: str) -> storage.Bucket:
+    """Returns a handle to the given bucket. Unlike Client.get_bucket, this
+    doesn't make a request to GCS to check that the bucket exists."""
+    client = get_client()
+    with _client_lock:
+        bucket = _buckets.get(gcs_bucket)
+        if bucket is None:
+            bucket = client.bucket(gcs_bucket)
+            _buckets[gcs_bucket] = bucket
+        return bucket
+
+
+def reset_client():
+    """Drops the shared client and bucket handles. Mostly useful for tests."""
+    global _client  # pylint: disable=global-statement
+    with _client_lock:
+        _client = None
+        _buckets.clear()
+
+
+class DownloadedBlob(NamedTuple):
+    """The contents of a GCS object and the generation of the object that was
+    read. generation is None if GCS didn't report it."""
+    data: bytes
+    generation: Optional[int]
+
+
+def download_blob(gcs_bucket: str, filename: str) -> DownloadedBlob:
+    blob = get_bucket(gcs_bucket).blob(filename)
+    data = blob.download_as_bytes(timeout=get_timeout())
+    # The client fills in the generation from the download's response headers,
+    # so this doesn't cost another request.
+    return DownloadedBlob(data, blob.generation)
+
+
+class BlobMetadata(NamedTuple):
+    """Metadata of a GCS object. Fields are None if GCS didn't report them."""
+    generation: Optional[int]
+    size: Optional[int]
+
+
+def get_blob_metadata(gcs_bucket: str, filename: str) -> BlobMetadata:
+    """Fetches the metadata of a GCS object without downloading it. Throws
+    NotFound if the object doesn't exist."""
+    blob = get_bucket(gcs_bucket).blob(filename)
+    blob.reload(timeout=get_timeout())
+    return BlobMetadata(blob.generation, blob.size)
+
+
+def iter_blob_chunks(gcs_bucket: str, filename: str, size: int,
+                     generation=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Yields the contents of a GCS object in chunks, using one ranged read
+    per chunk so that only a single chunk is held in memory at a time.
+
+    size: The size of the object, as reported by get_blob_metadata.
+    generation: If set, every chunk is read from this generation of the
+                object, so that chunks of different versions are never
+                mixed."""
+    blob = get_bucket(gcs_bucket).blob(filename, generation=generation)
+    for start in range(0, size, chunk_bytes):
+        end = min(start + chunk_bytes, size) - 1
+        yield blob.download_as_bytes(start=start, end=end,
+                                     timeout=get_timeout())
+
+
+def upload_blob(gcs_bucket: str, filename: str, data: bytes):
+    """Uploads data to a GCS object, replacing it if it exists."""
+    blob = get_bucket(gcs_bucket).blob(filename)
+    blob.upload_from_string(data, timeout=get_timeout())
+
+
+def list_blobs(gcs_bucket: str, prefix: str) -> list:
+    """Returns a (name, updated) pair for every GCS object whose name starts
+    with prefix, where updated is when the object was last written, in
+    seconds since the epoch."""
+    blobs = get_client().list_blobs(gcs_bucket, prefix=prefix,
+                                    timeout=get_timeout())
+    return [(blob.name, blob.updated.timestamp()) for blob in blobs]
 
 
-def download_blob_as_bytes(gcs_bucket: str, filename: str) -> bytes:
-    client = storage.Client()
-    bucket = client.get_bucket(gcs_bucket)
-    blob = bucket.blob(filename)
-    return blob.download_as_bytes()
+def delete_blob(gcs_bucket: str, filename: str):
+    """Deletes a GCS object. Throws NotFound if it doesn't exist."""
+    get_bucket(gcs_bucket).blob(filename).delete(timeout=get_timeout())
@@ -0,0 +1,206 @@
+import bisect
+import math
+import threading
+
+# Upper bounds of the default histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+# Upper bounds of the histogram buckets for sizes, in bytes.
+BYTES_BUCKETS = tuple(4 ** power for power in range(5, 15))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Dataset label of the cache misses that failed, e.g. for names that don't
+# exist in GCS. Only datasets that were actually fetched get labels of their
+# own, so that the number of series stays bounded whatever names are
+# requested.
+UNKNOWN_DATASET = 'unknown'
+
+_registry: list = []
+
+
+def _escape(value) -> str:
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(labelnames: tuple, labelvalues: tuple) -> str:
+    if not labelnames:
+        return ''
+    pairs = ('{}="{}"'.format(name, _escape(value))
+             for name, value in zip(labelnames, labelvalues))
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric():
+    """Base class for metrics. Each metric holds one value per combination
+    of label values, and is registered for rendering on creation unless
+    register is False.
+
+    These are kept deliberately simple so that updating a metric on the
+    request path only costs a lock and a dict lookup."""
+
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, labelnames=(),
+                 register=True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values: dict = {}
+        if register:
+            _registry.append(self)
+
+    def clear(self):
+        """Drops all recorded values. Mostly useful for tests."""
+        with self.lock:
+            self.values.clear()
+
+    def render(self) -> list:
+        """Returns the metric's lines in the Prometheus text format."""
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type_name)]
+        with self.lock:
+            samples = sorted(self.values.items())
+        for labelvalues, value in samples:
+            lines.append('{}{} {}'.format(
+                self.name, _format_labels(self.labelnames, labelvalues),
+                _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    """A value that only goes up, such as a number of requests."""
+
+    type_name = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def get(self, *labelvalues):
+        with self.lock:
+            return self.values.get(labelvalues, 0)
+
+
+class Gauge(_Metric):
+    """A value that can go up and down, such as a number of bytes in use."""
+
+    type_name = 'gauge'
+
+    def set(self, value, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = value
+
+    def get(self, *labelvalues):
+        with self.lock:
+            return self.values.get(labelvalues, 0)
+
+
+class Histogram(_Metric):
+    """Counts observations, such as request latencies, in buckets by
+    value."""
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(),
+                 buckets=DEFAULT_BUCKETS, register=True):
+        super().__init__(name, documentation, labelnames, register)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labelvalues)
+            if state is None:
+                # Per-bucket counts, then the sum of the observations.
+                state = self.values[labelvalues] = [0] * len(self.buckets)
+                state.append(0)
+            state[index] += 1
+            state[-1] += value
+
+    def get_count(self, *labelvalues) -> int:
+        with self.lock:
+            state = self.values.get(labelvalues)
+            return sum(state[:-1]) if state is not None else 0
+
+    def get_sum(self, *labelvalues):
+        with self.lock:
+            state = self.values.get(labelvalues)
+            return state[-1] if state is not None else 0
+
+    def render(self) -> list:
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type_name)]
+        with self.lock:
+            samples = sorted((labelvalues, list(state))
+                             for labelvalues, state in self.values.items())
+        labelnames = self.labelnames + ('le',)
+        for labelvalues, state in samples:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(labelnames,
+                                   labelvalues + (_format_value(bound),)),
+                    cumulative))
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append('{}_sum{} {}'.format(self.name, labels,
+                                              _format_value(state[-1])))
+            lines.append('{}_count{} {}'.format(self.name, labels,
+                                                cumulative))
+        return lines
+
+
+def render() -> str:
+    """Returns every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def clear():
+    """Drops the values of every registered metric. Mostly useful for
+    tests."""
+    for metric in _registry:
+        metric.clear()
+
+
+# Metrics recorded by the data server.
+CACHE_HITS = Counter(
+    'data_server_cache_hits_total',
+    'Requests for a dataset served from memory or disk.',
+    ('dataset', 'tier'))
+CACHE_MISSES = Counter(
+    'data_server_cache_misses_total',
+    'Requests for a dataset that had to be fetched from GCS.', ('dataset',))
+CACHE_EVICTIONS = Counter(
+    'data_server_cache_evictions_total',
+    'Datasets evicted from memory to stay under the memory budget.',
+    ('dataset',))
+CACHE_BYTES = Gauge(
+    'data_server_cache_bytes',
+    'Bytes of datasets held by the cache.', ('tier',))
+CACHE_ENTRIES = Gauge(
+    'data_server_cache_entries',
+    'Number of datasets held by the cache.', ('tier',))
+GCS_FETCH_SECONDS = Histogram(
+    'data_server_gcs_fetch_seconds',
+    'Time spent downloading datasets from GCS.')
+REQUEST_SECONDS = Histogram(
+    'data_server_request_seconds',
+    'Time spent handling requests, until the response starts.',
+    ('route', 'status'))
+RESPONSE_BYTES = Histogram(
+    'data_server_response_bytes',
+    'Size of response bodies.', ('route',), buckets=BYTES_BUCKETS)
@@ -0,0 +1,120 @@
+import contextlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from typing import NamedTuple, Optional
+
+_local = threading.local()
+
+
+class _Recorder():
+    """Phase timings of the request handled by the current thread.
+
+    phases: Dict of phase name to seconds spent in it, in the order the
+            phases were first entered.
+    children: Seconds spent in nested phases, for each open phase."""
+
+    def __init__(self):
+        self.phases: dict = {}
+        self.children: list = []
+
+
+def start():
+    """Starts recording phase timings on the current thread, dropping any
+    recorded before."""
+    _local.recorder = _Recorder()
+
+
+def stop() -> dict:
+    """Stops recording phase timings on the current thread.
+
+    Returns: Dict of phase name to seconds spent in it."""
+    recorder = getattr(_local, 'recorder', None)
+    _local.recorder = None
+    return recorder.phases if recorder is not None else {}
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """Adds the time spent in the block to the phase called name, if the
+    current thread is recording. Time spent in nested phases only counts
+    towards the innermost one, so that phases add up to the time spent in
+    them. Work done on other threads, such as background refreshes, isn't
+    recorded."""
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        yield
+        return
+    recorder.phases.setdefault(name, 0.0)
+    recorder.children.append(0.0)
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        own = elapsed - recorder.children.pop()
+        recorder.phases[name] += own
+        if recorder.children:
+            recorder.children[-1] += elapsed
+
+
+def format_server_timing(phases: dict) -> str:
+    """Returns the value of a Server-Timing header for the given phase
+    timings, in seconds. Durations are sent in milliseconds."""
+    return ', '.join('{};dur={:.2f}'.format(name, seconds * 1000)
+                     for name, seconds in phases.items())
+
+
+class TimingConfig(NamedTuple):
+    """How phase timings are reported.
+
+    header: Whether responses get a Server-Timing header. Off by default,
+            since the timings reveal whether datasets were cached.
+    log_sample_rate: Share of requests, between 0 and 1, whose timings are
+                     logged.
+    log_slow_seconds: Requests that take at least this long are always
+                      logged. None to only log sampled requests.
+    allow_origin: Origin, such as the site's, allowed to read the
+                  Server-Timing header of cross-origin requests through a
+                  Timing-Allow-Origin header. None to send no such header."""
+    header: bool = False
+    log_sample_rate: float = 0.0
+    log_slow_seconds: Optional[float] = None
+    allow_origin: Optional[str] = None
+
+    @classmethod
+    def from_env(cls):
+        """Builds the config from SERVER_TIMING_HEADER,
+        TIMING_LOG_SAMPLE_RATE, TIMING_LOG_SLOW_SECONDS and
+        SERVER_TIMING_ALLOW_ORIGIN."""
+        slow_seconds = os.environ.get('TIMING_LOG_SLOW_SECONDS')
+        return cls(
+            os.environ.get('SERVER_TIMING_HEADER', 'false').lower() in (
+                '1', 'true'),
+            float(os.environ.get('TIMING_LOG_SAMPLE_RATE', 0)),
+            float(slow_seconds) if slow_seconds else None,
+            os.environ.get('SERVER_TIMING_ALLOW_ORIGIN') or None)
+
+    def should_log(self, total_seconds: float) -> bool:
+        """Whether the timings of a request that took total_seconds should
+        be logged."""
+        if (self.log_slow_seconds is not None and
+                total_seconds >= self.log_slow_seconds):
+            return True
+        return random.random() < self.log_sample_rate
+
+
+def log_timings(entry: dict, phases: dict):
+    """Writes the phase timings of a request as a single json line to
+    stdout, which Cloud Run ingests as a structured log entry.
+
+    entry: Fields describing the request, such as its route and status.
+    phases: Dict of phase name to seconds spent in it."""
+    entry = dict(entry, severity='INFO', message='request timing',
+                 phases_ms={name: round(seconds * 1000, 3)
+                            for name, seconds in phases.items()})
+    sys.stdout.write(json.dumps(entry) + '\n')
+    sys.stdout.flush()
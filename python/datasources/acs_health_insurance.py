@@ -155,20 +155,21 @@ class AcsHealhInsuranceRaceIngestor:
         self.split_data_frames()
 
         # Create BQ columns and write dataframes to BQ
-        for table_name, df in self.frames.items():
-            # All breakdown columns are strings
-            column_types = {c: "STRING" for c in df.columns}
+        with gcs_to_bq_util.concurrent_loads():
+            for table_name, df in self.frames.items():
+                # All breakdown columns are strings
+                column_types = {c: "STRING" for c in df.columns}
 
-            if RACE_INCLUDES_HISPANIC_COL in df.columns:
-                column_types[RACE_INCLUDES_HISPANIC_COL] = "BOOL"
+                if RACE_INCLUDES_HISPANIC_COL in df.columns:
+                    column_types[RACE_INCLUDES_HISPANIC_COL] = "BOOL"
 
-            column_types[WITH_HEALTH_INSURANCE_COL] = "INT64"
-            column_types[WITHOUT_HEALTH_INSURANCE_COL] = "INT64"
-            column_types[TOTAL_HEALTH_INSURANCE_COL] = "INT64"
+                column_types[WITH_HEALTH_INSURANCE_COL] = "INT64"
+                column_types[WITHOUT_HEALTH_INSURANCE_COL] = "INT64"
+                column_types[TOTAL_HEALTH_INSURANCE_COL] = "INT64"
 
-            gcs_to_bq_util.add_dataframe_to_bq(
-                df, dataset, table_name, column_types=column_types
-            )
+                gcs_to_bq_util.add_dataframe_to_bq(
+                    df, dataset, table_name, column_types=column_types
+                )
 
     #   Get Health insurance data from either GCS or Directly, and aggregate the data in memory
 
@@ -412,17 +413,18 @@ class AcsHealhInsuranceSexIngestor:
         self.split_data_frames()
 
         # Create BQ columns and write dataframes to BQ
-        for table_name, df in self.frames.items():
-            # All breakdown columns are strings
-            column_types = {c: "STRING" for c in df.columns}
+        with gcs_to_bq_util.concurrent_loads():
+            for table_name, df in self.frames.items():
+                # All breakdown columns are strings
+                column_types = {c: "STRING" for c in df.columns}
 
-            column_types[WITH_HEALTH_INSURANCE_COL] = "INT64"
-            column_types[WITHOUT_HEALTH_INSURANCE_COL] = "INT64"
-            column_types[TOTAL_HEALTH_INSURANCE_COL] = "INT64"
+                column_types[WITH_HEALTH_INSURANCE_COL] = "INT64"
+                column_types[WITHOUT_HEALTH_INSURANCE_COL] = "INT64"
+                column_types[TOTAL_HEALTH_INSURANCE_COL] = "INT64"
 
-            gcs_to_bq_util.add_dataframe_to_bq(
-                df, dataset, table_name, column_types=column_types
-            )
+                gcs_to_bq_util.add_dataframe_to_bq(
+                    df, dataset, table_name, column_types=column_types
+                )
 
     # Get Health insurance By Sex from either API or GCS and aggregate it in memory
 
@@ -604,8 +606,9 @@ class ACSHealthInsurance(DataSource):
         return file_diff
 
     def write_to_bq(self, dataset, gcs_bucket, **attrs):
-        for ingester in self._create_ingesters():
-            ingester.write_to_bq(dataset, gcs_bucket)
+        with gcs_to_bq_util.concurrent_loads():
+            for ingester in self._create_ingesters():
+                ingester.write_to_bq(dataset, gcs_bucket)
 
     def _create_ingesters(self):
         return [
@@ -228,13 +228,14 @@ class ACSPopulationIngester():
                 var_map, sex_by_age_frames)
         }
 
-        for table_name, df in frames.items():
-            # All breakdown columns are strings
-            column_types = {c: 'STRING' for c in df.columns}
-            column_types[POPULATION_COL] = 'INT64'
-            column_types[RACE_INCLUDES_HISPANIC_COL] = 'BOOL'
-            gcs_to_bq_util.add_dataframe_to_bq(
-                df, dataset, table_name, column_types=column_types)
+        with gcs_to_bq_util.concurrent_loads():
+            for table_name, df in frames.items():
+                # All breakdown columns are strings
+                column_types = {c: 'STRING' for c in df.columns}
+                column_types[POPULATION_COL] = 'INT64'
+                column_types[RACE_INCLUDES_HISPANIC_COL] = 'BOOL'
+                gcs_to_bq_util.add_dataframe_to_bq(
+                    df, dataset, table_name, column_types=column_types)
 
     def write_local_files_debug(self):
         """Downloads and writes the tables to the local file system as csv and
@@ -435,8 +436,9 @@ class ACSPopulation(DataSource):
         return file_diff
 
     def write_to_bq(self, dataset, gcs_bucket, **attrs):
-        for ingester in self._create_ingesters():
-            ingester.write_to_bq(dataset, gcs_bucket)
+        with gcs_to_bq_util.concurrent_loads():
+            for ingester in self._create_ingesters():
+                ingester.write_to_bq(dataset, gcs_bucket)
 
     def _create_ingesters(self):
         return [
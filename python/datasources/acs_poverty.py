@@ -147,18 +147,19 @@ class AcsPovertyIngestor:
         self.split_data_frames()
 
         # Create BQ columns and write dataframes to BQ
-        for table_name, df in self.frames.items():
-            # All breakdown columns are strings
-            column_types = {c: "STRING" for c in df.columns}
-            if RACE_INCLUDES_HISPANIC_COL in df.columns:
-                column_types[RACE_INCLUDES_HISPANIC_COL] = "BOOL"
-
-            column_types[BELOW_POVERTY_COL] = "INT64"
-            column_types[ABOVE_POVERTY_COL] = "INT64"
-
-            gcs_to_bq_util.add_dataframe_to_bq(
-                df, dataset, table_name, column_types=column_types
-            )
+        with gcs_to_bq_util.concurrent_loads():
+            for table_name, df in self.frames.items():
+                # All breakdown columns are strings
+                column_types = {c: "STRING" for c in df.columns}
+                if RACE_INCLUDES_HISPANIC_COL in df.columns:
+                    column_types[RACE_INCLUDES_HISPANIC_COL] = "BOOL"
+
+                column_types[BELOW_POVERTY_COL] = "INT64"
+                column_types[ABOVE_POVERTY_COL] = "INT64"
+
+                gcs_to_bq_util.add_dataframe_to_bq(
+                    df, dataset, table_name, column_types=column_types
+                )
 
     # Uploads the acs data to gcs and returns if files are diff.
     def upload_to_gcs(self, bucket):
@@ -448,8 +449,9 @@ class ACSPovertyDataSource(DataSource):
         return file_diff
 
     def write_to_bq(self, dataset, gcs_bucket, **attrs):
-        for ingester in self._create_ingesters():
-            ingester.write_to_bq(dataset, gcs_bucket)
+        with gcs_to_bq_util.concurrent_loads():
+            for ingester in self._create_ingesters():
+                ingester.write_to_bq(dataset, gcs_bucket)
 
     def _create_ingesters(self):
         return [
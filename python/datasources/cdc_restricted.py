@@ -36,22 +36,23 @@ class CDCRestrictedData(DataSource):
                     std_col.COVID_HOSP_N, std_col.COVID_HOSP_UNKNOWN,
                     std_col.COVID_DEATH_Y, std_col.COVID_DEATH_N,
                     std_col.COVID_DEATH_UNKNOWN]
-        for f in files:
-            # Explicitly specify county_fips is a string.
-            df = gcs_to_bq_util.load_csv_as_dataframe(
-                gcs_bucket, f, dtype={'county_fips': str})
-
-            # All columns are str, except outcome columns.
-            column_types = {c: 'STRING' for c in df.columns}
-            for col in int_cols:
-                if col in column_types:
-                    column_types[col] = 'FLOAT'
-            if std_col.RACE_INCLUDES_HISPANIC_COL in df.columns:
-                column_types[std_col.RACE_INCLUDES_HISPANIC_COL] = 'BOOL'
-
-            # Clean up column names.
-            self.clean_frame_column_names(df)
-
-            table_name = f.replace('.csv', '')  # Table name is file name
-            gcs_to_bq_util.add_dataframe_to_bq(
-                df, dataset, table_name, column_types=column_types)
+        with gcs_to_bq_util.concurrent_loads():
+            for f in files:
+                # Explicitly specify county_fips is a string.
+                df = gcs_to_bq_util.load_csv_as_dataframe(
+                    gcs_bucket, f, dtype={'county_fips': str})
+
+                # All columns are str, except outcome columns.
+                column_types = {c: 'STRING' for c in df.columns}
+                for col in int_cols:
+                    if col in column_types:
+                        column_types[col] = 'FLOAT'
+                if std_col.RACE_INCLUDES_HISPANIC_COL in df.columns:
+                    column_types[std_col.RACE_INCLUDES_HISPANIC_COL] = 'BOOL'
+
+                # Clean up column names.
+                self.clean_frame_column_names(df)
+
+                table_name = f.replace('.csv', '')  # Table name is file name
+                gcs_to_bq_util.add_dataframe_to_bq(
+                    df, dataset, table_name, column_types=column_types)
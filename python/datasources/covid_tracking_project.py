@@ -54,14 +54,16 @@ class CovidTrackingProject(DataSource):
         merged = CovidTrackingProject.merge_with_metadata(df, metadata)
 
         # Split into separate tables by variable type
-        for variable_type in ["cases", "deaths", "tests", "hosp"]:
-            result = merged.copy()
-            result = result.loc[result["variable_type"] == variable_type]
-            result.rename(columns={"value": variable_type}, inplace=True)
-            result.drop("variable_type", axis="columns", inplace=True)
-            # Write to BQ
-            gcs_to_bq_util.add_dataframe_to_bq(
-                result, dataset, self.get_table_name() + "_" + variable_type)
+        with gcs_to_bq_util.concurrent_loads():
+            for variable_type in ["cases", "deaths", "tests", "hosp"]:
+                result = merged.copy()
+                result = result.loc[result["variable_type"] == variable_type]
+                result.rename(columns={"value": variable_type}, inplace=True)
+                result.drop("variable_type", axis="columns", inplace=True)
+                # Write to BQ
+                gcs_to_bq_util.add_dataframe_to_bq(
+                    result, dataset,
+                    self.get_table_name() + "_" + variable_type)
 
     def standardize(self, df: pd.DataFrame) -> pd.DataFrame:
         """Reformats data into the standard format.
@@ -115,7 +117,7 @@ class CovidTrackingProject(DataSource):
 
         Returns:
         A pandas.DataFrame containing the contents of the requested table."""
-        client = bigquery.Client()
+        client = gcs_to_bq_util.get_bigquery_client()
         job_config = bigquery.QueryJobConfig(
             default_dataset=client.get_dataset(dataset))
         sql = """
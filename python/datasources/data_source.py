@@ -73,16 +73,18 @@ class DataSource(ABC):
         table_name: The name of the BigQuery table to write to"""
         chunked_frame = gcs_to_bq_util.load_csv_as_dataframe(
             gcs_bucket, filename, chunksize=1000)
+        gcs_to_bq_util.add_dataframe_chunks_to_bq(
+            self.clean_frame_chunks(chunked_frame), dataset, table_name,
+            project=project)
 
-        # For the very first chunk, we set the mode to overwrite to clear the
-        # previous table. For subsequent chunks we append.
-        overwrite = True
+    def clean_frame_chunks(self, chunked_frame):
+        """Yields the chunks of a frame read in chunks, with their column names
+        cleaned as they are read.
+
+        chunked_frame: Iterable of pandas dataframes"""
         for chunk in chunked_frame:
             self.clean_frame_column_names(chunk)
-            gcs_to_bq_util.add_dataframe_to_bq(
-                chunk, dataset, table_name, project=project,
-                overwrite=overwrite)
-            overwrite = False
+            yield chunk
 
     def clean_frame_column_names(self, frame):
         """ Replaces unfitting BigQuery characters and
@@ -1,5 +1,4 @@
 import pandas
-from google.cloud import storage
 
 from ingestion import census, url_file_to_gcs, gcs_to_bq_util
 from datasources.data_source import DataSource
@@ -65,7 +64,7 @@ class HouseholdIncome(DataSource):
         table_name: The name of the BigQuery table to write to
         gcs_bucket: The name of the GCS bucket to pull from
         filename: File name prefix used to identify which GCS blobs to fetch"""
-        client = storage.Client()
+        client = gcs_to_bq_util.get_storage_client()
         saipe_blobs = client.list_blobs(gcs_bucket, prefix=filename)
 
         frames = []
@@ -23,13 +23,6 @@ class ManualUploads(DataSource):
             table_name = file_name.split('.')[0]
             chunked_frame = gcs_to_bq_util.load_csv_as_dataframe(
                 gcs_bucket, file_name, chunksize=1000)
-
-            # For the very first chunk, we set the mode to overwrite to clear
-            # the previous table. For subsequent chunks we append.
-            overwrite = True
-            for chunk in chunked_frame:
-                super().clean_frame_column_names(chunk)
-                gcs_to_bq_util.add_dataframe_to_bq_as_str_values(
-                    chunk, dataset, table_name, project=manual_uploads_project,
-                    overwrite=overwrite)
-                overwrite = False
+            gcs_to_bq_util.add_dataframe_chunks_to_bq(
+                self.clean_frame_chunks(chunked_frame), dataset, table_name,
+                project=manual_uploads_project, values_as_str=True)
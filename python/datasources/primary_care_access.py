@@ -1,6 +1,5 @@
 import math
 from pandas import DataFrame, read_excel
-from google.cloud import storage
 
 from ingestion import constants, url_file_to_gcs, gcs_to_bq_util
 from datasources.data_source import DataSource
@@ -45,8 +44,7 @@ class PrimaryCareAccess(DataSource):
             table_name: The name of the biquery table to write to
             gcs_bucket: The name of the gcs bucket to read the data from
             filename: The prefix of files in the landing bucket to read from"""
-        client = storage.Client()
-        bucket = client.get_bucket(gcs_bucket)
+        bucket = gcs_to_bq_util.get_bucket(gcs_bucket)
 
         data = []
         for state_name in constants.STATE_NAMES:
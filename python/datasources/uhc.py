@@ -65,18 +65,21 @@ class UHCData(DataSource):
     def write_to_bq(self, dataset, gcs_bucket, **attrs):
         df = gcs_to_bq_util.load_csv_as_dataframe_from_web(BASE_UHC_URL)
 
-        for breakdown in [std_col.RACE_OR_HISPANIC_COL, std_col.AGE_COL, std_col.SEX_COL]:
-            breakdown_df = self.generate_breakdown(breakdown, df)
+        with gcs_to_bq_util.concurrent_loads():
+            for breakdown in [std_col.RACE_OR_HISPANIC_COL, std_col.AGE_COL,
+                              std_col.SEX_COL]:
+                breakdown_df = self.generate_breakdown(breakdown, df)
 
-            column_types = {c: 'STRING' for c in breakdown_df.columns}
-            for col in [std_col.COPD_PCT, std_col.DIABETES_PCT]:
-                column_types[col] = 'FLOAT'
+                column_types = {c: 'STRING' for c in breakdown_df.columns}
+                for col in [std_col.COPD_PCT, std_col.DIABETES_PCT]:
+                    column_types[col] = 'FLOAT'
 
-            if std_col.RACE_INCLUDES_HISPANIC_COL in breakdown_df.columns:
-                column_types[std_col.RACE_INCLUDES_HISPANIC_COL] = 'BOOL'
+                if std_col.RACE_INCLUDES_HISPANIC_COL in breakdown_df.columns:
+                    column_types[std_col.RACE_INCLUDES_HISPANIC_COL] = 'BOOL'
 
-            gcs_to_bq_util.add_dataframe_to_bq(
-                breakdown_df, dataset, breakdown, column_types=column_types)
+                gcs_to_bq_util.add_dataframe_to_bq(
+                    breakdown_df, dataset, breakdown,
+                    column_types=column_types)
 
     def generate_breakdown(self, breakdown, df):
         output = []
@@ -0,0 +1,128 @@
+"""Measures the time and peak memory of preparing a county-level DataFrame
+for a BigQuery load, with the json path (to_json, json.loads, then the
+newline-delimited json load_table_from_json builds) and with the Parquet
+path that add_dataframe_to_bq uses when column types are given.
+
+No BigQuery requests are made. Each path runs in its own forked process so
+that peak memory isn't shared between them, which means this only runs on
+Linux and macOS.
+
+Usage, from the repository root:
+    cd python && python -m ingestion.benchmarks.bq_load_benchmark --rows 500000
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import resource
+import sys
+import time
+
+import numpy as np
+import pandas
+
+from ingestion import gcs_to_bq_util  # pylint: disable=no-name-in-module
+
+COLUMN_TYPES = {
+    'state_fips': 'STRING',
+    'county_fips': 'STRING',
+    'county_name': 'STRING',
+    'race_and_ethnicity': 'STRING',
+    'age': 'STRING',
+    'population': 'INT64',
+    'population_pct': 'FLOAT',
+    'ingestion_ts': 'TIMESTAMP',
+}
+
+
+def make_frame(rows: int) -> pandas.DataFrame:
+    """Returns a frame shaped like the ACS county-level population tables."""
+    ids = np.arange(rows)
+    races = np.array(['Asian (Non-Hispanic)', 'Black or African American',
+                      'Hispanic or Latino', 'White (Non-Hispanic)', 'Total'])
+    ages = np.array(['0-9', '10-19', '20-29', '30-39', '40-49', '50-59',
+                     '60-69', '70+', 'Total'])
+    counties = ids % 3200 + 1000
+    return pandas.DataFrame({
+        'state_fips': [str(county // 100).zfill(2) for county in counties],
+        'county_fips': [str(county).zfill(5) for county in counties],
+        'county_name': ['County {}'.format(county) for county in counties],
+        'race_and_ethnicity': races[ids % len(races)].astype(object),
+        'age': ages[ids % len(ages)].astype(object),
+        'population': ids * 7 % 100000,
+        'population_pct': (ids % 1000) / 10,
+        'ingestion_ts': '2021-01-01 00:00:00.000000 UTC',
+    })
+
+
+def prepare_json(frame: pandas.DataFrame) -> int:
+    json_data = getattr(gcs_to_bq_util, '__convert_frame_to_json')(frame)
+    # What load_table_from_json does with the rows before uploading them.
+    data = '\n'.join(json.dumps(row, ensure_ascii=False)
+                     for row in json_data).encode()
+    return len(io.BytesIO(data).getbuffer())
+
+
+def prepare_parquet(frame: pandas.DataFrame) -> int:
+    data = getattr(gcs_to_bq_util, '__convert_frame_to_parquet')(
+        frame, COLUMN_TYPES, None)
+    return len(data)
+
+
+def get_rss_bytes() -> int:
+    """Returns the current resident set size, or the peak on platforms
+    without /proc."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return get_peak_rss_bytes()
+
+
+def get_peak_rss_bytes() -> int:
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def run(prepare, rows: int, results):
+    frame = make_frame(rows)
+    rss_before = get_rss_bytes()
+    start = time.perf_counter()
+    payload_bytes = prepare(frame)
+    seconds = time.perf_counter() - start
+    results.put({'seconds': seconds,
+                 'peak_memory_bytes': get_peak_rss_bytes() - rss_before,
+                 'payload_bytes': payload_bytes})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--output', help='Optional JSON file for results.')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('fork')
+    results = {}
+    for name, prepare in [('json', prepare_json),
+                          ('parquet', prepare_parquet)]:
+        queue = context.Queue()
+        process = context.Process(target=run,
+                                  args=(prepare, args.rows, queue))
+        process.start()
+        results[name] = queue.get()
+        process.join()
+
+    for name, stats in results.items():
+        print('{:>8}: {:7.2f} s  peak memory +{:7.1f} MiB  '
+              'payload {:7.1f} MiB'.format(
+                  name, stats['seconds'], stats['peak_memory_bytes'] / 2 ** 20,
+                  stats['payload_bytes'] / 2 ** 20))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
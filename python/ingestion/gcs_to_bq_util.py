@@ -1,11 +1,213 @@
+from collections import deque
+import contextlib
 from datetime import datetime
 from datetime import timezone
+import io
 import json
 import os
+import tempfile
+import threading
 
 import pandas
 from google.cloud import bigquery, storage
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Without pyarrow, frames are always loaded as json.
+    pyarrow = None
+
+# Clients shared by every call in the process, keyed by (kind, project).
+# Reusing clients avoids redoing auth for every call.
+_clients: dict = {}
+# Bucket and dataset handles, keyed by (kind, project, name). Each entry is
+# (client, handle), and is only used while client is still the shared one.
+_handles: dict = {}
+_client_lock = threading.Lock()
+
+
+def __get_client(kind, factory, project):
+    """Returns the shared client of the given kind for project, creating it
+       with factory on first use."""
+    with _client_lock:
+        client = _clients.get((kind, project))
+        if client is None:
+            client = factory(project) if project is not None else factory()
+            _clients[(kind, project)] = client
+        return client
+
+
+def __get_handle(kind, client, project, name, make_handle):
+    """Returns the cached handle to the named bucket or dataset, calling
+       make_handle to create it if client doesn't have one yet."""
+    key = (kind, project, name)
+    with _client_lock:
+        entry = _handles.get(key)
+        if entry is not None and entry[0] is client:
+            return entry[1]
+    # Creating a handle may make a request, which shouldn't block other
+    # threads. Threads racing to create the same handle get equivalent ones.
+    handle = make_handle(name)
+    with _client_lock:
+        _handles[key] = (client, handle)
+    return handle
+
+
+def get_bigquery_client(project=None):
+    """Returns the BigQuery client shared by the whole process for the given
+       project, creating it on first use.
+
+       project: The project to use, or None for the default project."""
+    return __get_client('bigquery', bigquery.Client, project)
+
+
+def get_storage_client(project=None):
+    """Returns the storage client shared by the whole process for the given
+       project, creating it on first use.
+
+       project: The project to use, or None for the default project."""
+    return __get_client('storage', storage.Client, project)
+
+
+def get_bucket(gcs_bucket, project=None):
+    """Returns the given bucket, as Client.get_bucket does. The bucket is
+       only fetched from GCS the first time it is used.
+
+       gcs_bucket: The name of the gcs bucket.
+       project: The project of the storage client, or None for the default."""
+    client = get_storage_client(project)
+    return __get_handle('bucket', client, project, gcs_bucket,
+                        client.get_bucket)
+
+
+def get_dataset_ref(dataset, project=None):
+    """Returns a reference to the given BigQuery dataset.
+
+       dataset: The name of the BigQuery dataset.
+       project: The project of the BigQuery client, or None for the
+                default."""
+    client = get_bigquery_client(project)
+    return __get_handle('dataset', client, project, dataset, client.dataset)
+
+
+def set_bigquery_client(client, project=None):
+    """Makes calls for the given project use client, e.g. a fake in tests,
+       until reset_clients is called."""
+    with _client_lock:
+        _clients[('bigquery', project)] = client
+
+
+def set_storage_client(client, project=None):
+    """Makes calls for the given project use client, e.g. a fake in tests,
+       until reset_clients is called."""
+    with _client_lock:
+        _clients[('storage', project)] = client
+
+
+def reset_clients():
+    """Drops the shared clients and handles, so that they are created again
+       on next use."""
+    with _client_lock:
+        _clients.clear()
+        _handles.clear()
+
+
+# Max number of load jobs running at once within concurrent_loads.
+DEFAULT_MAX_CONCURRENT_LOADS = 8
+
+_local = threading.local()
+
+
+class LoadJobsError(Exception):
+    """Raised when load jobs started within concurrent_loads fail.
+
+       errors: List of (table, exception) pairs, in the order the jobs were
+               started, where table is 'dataset.table_name'."""
+
+    def __init__(self, errors):
+        super().__init__('Failed to load {} table(s): {}'.format(
+            len(errors), '; '.join(
+                '{}: {}'.format(table, err) for table, err in errors)))
+        self.errors = errors
+
+
+class _LoadScheduler():
+    """Starts BigQuery load jobs in order, without waiting for each to finish
+       before starting the next, while keeping at most max_concurrency of
+       them running."""
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.running = deque()
+        self.errors = []
+
+    def _wait_for_oldest(self):
+        table, load_job = self.running.popleft()
+        try:
+            load_job.result()
+        except Exception as err:  # pylint: disable=broad-except
+            self.errors.append((table, err))
+
+    def submit(self, table, start_job):
+        """Calls start_job to start the load job of table, once there's room
+           for it. Jobs loading the same table run one after the other, so
+           that appends land after the overwrite before them."""
+        while self.running and (
+                len(self.running) >= self.max_concurrency or
+                any(running == table for running, _ in self.running)):
+            self._wait_for_oldest()
+        self.running.append((table, start_job()))
+
+    def finish(self):
+        """Waits for every running job. Throws LoadJobsError if any job
+           failed."""
+        while self.running:
+            self._wait_for_oldest()
+        if self.errors:
+            raise LoadJobsError(self.errors)
+
+
+@contextlib.contextmanager
+def concurrent_loads(max_concurrency=DEFAULT_MAX_CONCURRENT_LOADS):
+    """Within the block, loads to BigQuery made by this module on the current
+       thread return once their load job has started, instead of once it has
+       finished. This lets the jobs of a data source with several tables run
+       at the same time. On leaving the block, waits for every job and throws
+       LoadJobsError listing each table whose load failed.
+
+       Blocks nested in another one share its jobs, which are waited for
+       when the outermost block ends.
+
+       max_concurrency: Max number of load jobs running at once."""
+    if getattr(_local, 'load_scheduler', None) is not None:
+        yield
+        return
+    scheduler = _LoadScheduler(max_concurrency)
+    _local.load_scheduler = scheduler
+    try:
+        yield
+    except BaseException:
+        # Jobs that already started still need to finish, but an exception
+        # raised within the block matters more than their failures.
+        _local.load_scheduler = None
+        try:
+            scheduler.finish()
+        except LoadJobsError:
+            pass
+        raise
+    _local.load_scheduler = None
+    scheduler.finish()
+
+
+def __run_load_job(dataset, table_name, start_job):
+    """Calls start_job to start a load job and waits for it to finish, or
+       hands it to the scheduler of the enclosing concurrent_loads block."""
+    scheduler = getattr(_local, 'load_scheduler', None)
+    if scheduler is None:
+        start_job().result()  # Wait for table load to complete.
+    else:
+        scheduler.submit('{}.{}'.format(dataset, table_name), start_job)
+
 
 def __convert_frame_to_json(frame):
     """Returns the serialized version of the given dataframe in json."""
@@ -17,6 +219,69 @@ def __convert_frame_to_json(frame):
     return json_data
 
 
+def __to_arrow_array(series, bq_type):
+    """Returns the given column as an Arrow array of the type BigQuery loads
+       into bq_type, or None if the type isn't supported. Throws if the values
+       don't convert cleanly, e.g. INT64 values with a fractional part."""
+    if bq_type == 'STRING':
+        # The json path lets BigQuery coerce e.g. numbers to strings, which
+        # Parquet doesn't do.
+        if pandas.api.types.infer_dtype(series, skipna=True) not in (
+                'string', 'empty'):
+            return None
+        return pyarrow.array(series, type=pyarrow.string(), from_pandas=True)
+    if bq_type in ('INT64', 'INTEGER'):
+        return pyarrow.array(series, type=pyarrow.int64(), from_pandas=True)
+    if bq_type in ('FLOAT64', 'FLOAT'):
+        return pyarrow.array(series, type=pyarrow.float64(), from_pandas=True)
+    if bq_type in ('BOOL', 'BOOLEAN'):
+        return pyarrow.array(series, type=pyarrow.bool_(), from_pandas=True)
+    if bq_type == 'TIMESTAMP':
+        return pyarrow.array(pandas.to_datetime(series, utc=True),
+                             type=pyarrow.timestamp('us', tz='UTC'),
+                             from_pandas=True)
+    return None
+
+
+def __convert_frame_to_parquet(frame, column_types, col_modes):
+    """Returns the given dataframe serialized as Parquet, with each column
+       converted to the type matching its BigQuery type. This avoids the
+       copies and per-row work of the json path.
+
+       Returns None if the frame should be loaded as json instead: when
+       pyarrow isn't installed, a column is REPEATED (Parquet lists aren't
+       loaded as BigQuery arrays without extra options), a column's type
+       isn't supported or its values don't convert cleanly, or the column
+       types don't match the frame's columns (get_schema then reports it)."""
+    if pyarrow is None:
+        return None
+    if col_modes is None:
+        col_modes = {}
+    if any(mode == 'REPEATED' for mode in col_modes.values()):
+        return None
+    if set(column_types) != set(frame.columns):
+        return None
+
+    arrays = []
+    fields = []
+    for col in frame.columns:
+        try:
+            array = __to_arrow_array(frame[col], column_types[col])
+        except (pyarrow.ArrowException, ValueError, TypeError,
+                OverflowError):
+            return None
+        if array is None:
+            return None
+        arrays.append(array)
+        fields.append(pyarrow.field(
+            col, array.type, nullable=col_modes.get(col) != 'REQUIRED'))
+
+    table = pyarrow.Table.from_arrays(arrays, schema=pyarrow.schema(fields))
+    buffer = io.BytesIO()
+    pyarrow.parquet.write_table(table, buffer)
+    return buffer.getvalue()
+
+
 def __create_bq_load_job_config(frame, column_types, col_modes, overwrite):
     """
     Creates a job to write the given data frame into BigQuery.
@@ -43,26 +308,83 @@ def __create_bq_load_job_config(frame, column_types, col_modes, overwrite):
     return job_config
 
 
-def __add_ingestion_ts(frame, column_types):
-    """Adds a timestamp for when the given DataFrame was ingested."""
+def __get_ingestion_ts():
+    """Returns the current time, formatted for the ingestion_ts column."""
     # Formatting to a string helps BQ autodetection.
-    frame['ingestion_ts'] = datetime.now(
-        timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f %Z")
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f %Z")
+
+
+def __add_ingestion_ts(frame, column_types, ingestion_ts=None):
+    """Adds a timestamp for when the given DataFrame was ingested. Frames
+       loaded together can share the same ingestion_ts, which defaults to
+       now."""
+    if ingestion_ts is None:
+        ingestion_ts = __get_ingestion_ts()
+    frame['ingestion_ts'] = ingestion_ts
     if column_types is not None:
         column_types['ingestion_ts'] = 'TIMESTAMP'
 
 
+def __convert_column_to_str(series):
+    """Returns the given column with every value converted to the string
+       that str() gives for the value after a round trip through json, with
+       nulls converted to 'None'."""
+    if pandas.api.types.is_bool_dtype(series) or (
+            pandas.api.types.is_integer_dtype(series)) or (
+            pandas.api.types.infer_dtype(series, skipna=True) in (
+                'string', 'empty')):
+        # These values are unchanged by the round trip through json.
+        converted = series.astype(str)
+    else:
+        # to_json rounds floats and turns dates into epoch milliseconds, so
+        # other columns still go through json, just one column at a time.
+        converted = pandas.Series(
+            json.loads(series.to_json(orient='values')), index=series.index,
+            dtype=object).astype(str)
+    return converted.mask(series.isna(), 'None')
+
+
+def __convert_frame_to_str_frame(frame):
+    """Returns a copy of the given dataframe with every value converted to a
+       string, column by column. The strings match what str() gives for each
+       value of the json the dataframe serializes to, so None and NaN both
+       become 'None'."""
+    return pandas.DataFrame(
+        {str(col): __convert_column_to_str(frame[col])
+         for col in frame.columns},
+        index=frame.index, columns=[str(col) for col in frame.columns])
+
+
+def __convert_frame_to_str_ndjson(frame):
+    """Returns the given dataframe serialized as newline-delimited json, with
+       every value converted to a string. The json is written in one pass
+       over the string columns, without building a dict per row."""
+    return __convert_frame_to_str_frame(frame).to_json(
+        orient='records', lines=True).encode('utf-8')
+
+
 def __dataframe_to_bq(frame, dataset, table_name, column_types, col_modes,
-                      project, json_data, overwrite):
+                      project, json_data, overwrite, parquet_data=None,
+                      ndjson_data=None):
     job_config = __create_bq_load_job_config(
         frame, column_types, col_modes, overwrite)
 
-    client = bigquery.Client(project)
-    table_id = client.dataset(dataset).table(table_name)
+    client = get_bigquery_client(project)
+    table_id = get_dataset_ref(dataset, project).table(table_name)
 
-    load_job = client.load_table_from_json(
-        json_data,	table_id, job_config=job_config)
-    load_job.result()  # Wait for table load to complete.
+    def start_job():
+        if parquet_data is not None:
+            job_config.source_format = bigquery.SourceFormat.PARQUET
+            return client.load_table_from_file(
+                io.BytesIO(parquet_data), table_id, job_config=job_config)
+        if ndjson_data is not None:
+            job_config.source_format = (
+                bigquery.SourceFormat.NEWLINE_DELIMITED_JSON)
+            return client.load_table_from_file(
+                io.BytesIO(ndjson_data), table_id, job_config=job_config)
+        return client.load_table_from_json(
+            json_data,	table_id, job_config=job_config)
+    __run_load_job(dataset, table_name, start_job)
 
 
 def add_dataframe_to_bq_as_str_values(frame, dataset, table_name,
@@ -83,13 +405,9 @@ def add_dataframe_to_bq_as_str_values(frame, dataset, table_name,
                   column_types to specify col_modes.
        overwrite: Whether to overwrite or append to the BigQuery table."""
     __add_ingestion_ts(frame, column_types)
-    json_data = __convert_frame_to_json(frame)
-    for sub in json_data:
-        for key in sub:
-            sub[key] = str(sub[key])
-
+    ndjson_data = __convert_frame_to_str_ndjson(frame)
     __dataframe_to_bq(frame, dataset, table_name, column_types, col_modes,
-                      project, json_data, overwrite)
+                      project, None, overwrite, ndjson_data=ndjson_data)
 
 
 def add_dataframe_to_bq(frame, dataset, table_name, column_types=None,
@@ -107,13 +425,83 @@ def add_dataframe_to_bq(frame, dataset, table_name, column_types=None,
        col_modes: Optional dict of modes for each field. Possible values include
                   NULLABLE, REQUIRED, and REPEATED. Must also specify
                   column_types to specify col_modes.
-       overwrite: Whether to overwrite or append to the BigQuery table."""
+       overwrite: Whether to overwrite or append to the BigQuery table.
+
+       When column_types is given, the frame is loaded as Parquet if its
+       columns allow it, and as json otherwise."""
     __add_ingestion_ts(frame, column_types)
+    if column_types is not None:
+        parquet_data = __convert_frame_to_parquet(
+            frame, column_types, col_modes)
+        if parquet_data is not None:
+            __dataframe_to_bq(frame, dataset, table_name, column_types,
+                              col_modes, project, None, overwrite,
+                              parquet_data=parquet_data)
+            return
+
     json_data = __convert_frame_to_json(frame)
     __dataframe_to_bq(frame, dataset, table_name, column_types, col_modes,
                       project, json_data, overwrite)
 
 
+def add_dataframe_chunks_to_bq(chunks, dataset, table_name, column_types=None,
+                               col_modes=None, project=None,
+                               values_as_str=False):
+    """Overwrites the table specified by `dataset.table_name` with the rows
+       of several DataFrames, such as the chunks read by load_csv_as_dataframe
+       with a chunksize, in a single load job. Automatically adds an
+       ingestion time column, which is the same for every chunk.
+
+       Each chunk is appended to a local newline-delimited json staging file as
+       soon as it is read, so only one chunk needs to be in memory at a time.
+       The table is only replaced once every chunk has been read and the load
+       job succeeds, so a failure part way through leaves it as it was.
+
+       chunks: Iterable of pandas.DataFrame with the same columns.
+       dataset: The BigQuery dataset to write to.
+       table_name: The BigQuery table to write to.
+       column_types: Optional dict of column name to BigQuery data type. If
+                     present, the column names must match the columns in the
+                     DataFrames. Otherwise, table schema is inferred.
+       col_modes: Optional dict of modes for each field. Possible values include
+                  NULLABLE, REQUIRED, and REPEATED. Must also specify
+                  column_types to specify col_modes.
+       values_as_str: Whether to convert every value to a string, as
+                      add_dataframe_to_bq_as_str_values does."""
+    ingestion_ts = __get_ingestion_ts()
+    columns = None
+    with tempfile.TemporaryFile() as staging:
+        for chunk in chunks:
+            __add_ingestion_ts(chunk, column_types, ingestion_ts)
+            if columns is None:
+                columns = chunk.head(0)
+            if chunk.empty:
+                continue
+            if values_as_str:
+                rows = __convert_frame_to_str_ndjson(chunk)
+            else:
+                rows = chunk.to_json(orient='records', lines=True).encode(
+                    'utf-8')
+            if not rows.endswith(b'\n'):
+                rows += b'\n'
+            staging.write(rows)
+
+        if staging.tell() == 0:
+            return
+        staging.seek(0)
+
+        job_config = __create_bq_load_job_config(
+            columns, column_types, col_modes, True)
+        job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+        client = get_bigquery_client(project)
+        table_id = get_dataset_ref(dataset, project).table(table_name)
+        # The staging file is fully uploaded by the time the job has started,
+        # so it can be closed while the job runs.
+        __run_load_job(
+            dataset, table_name, lambda: client.load_table_from_file(
+                staging, table_id, job_config=job_config))
+
+
 def get_schema(frame, column_types, col_modes):
     """Generates the BigQuery table schema from the column types and modes.
 
@@ -141,8 +529,7 @@ def load_values_as_dataframe(gcs_bucket, filename):
 
        gcs_bucket: The name of the gcs bucket to read the data from
        filename: The name of the file in the gcs bucket to read from"""
-    client = storage.Client()
-    bucket = client.get_bucket(gcs_bucket)
+    bucket = get_bucket(gcs_bucket)
     blob = bucket.blob(filename)
     return load_values_blob_as_dataframe(blob)
 
@@ -178,8 +565,7 @@ def load_csv_as_dataframe(gcs_bucket, filename, dtype=None, chunksize=None,
               example, to force integer-like ids to be treated as strings
        parse_dates: Column(s) that should be parsed and interpreted as dates.
        thousands: str to be used as a thousands separator for parsing numbers"""
-    client = storage.Client()
-    bucket = client.get_bucket(gcs_bucket)
+    bucket = get_bucket(gcs_bucket)
     blob = bucket.blob(filename)
     local_path = local_file_path(filename)
     blob.download_to_filename(local_path)
@@ -205,8 +591,7 @@ def load_json_as_dataframe(gcs_bucket, filename, dtype=None):
               specified by the pandas API. Not all column types need to be
               specified; column type is auto-detected. This is useful, for
               example, to force integer-like ids to be treated as strings"""
-    client = storage.Client()
-    bucket = client.get_bucket(gcs_bucket)
+    bucket = get_bucket(gcs_bucket)
     blob = bucket.blob(filename)
     local_path = local_file_path(filename)
     blob.download_to_filename(local_path)
@@ -236,8 +621,7 @@ def load_values_as_json(gcs_bucket, filename):
 
        gcs_bucket: The name of the gcs bucket to read the data from
        filename: The name of the file in the gcs bucket to read from"""
-    client = storage.Client()
-    bucket = client.get_bucket(gcs_bucket)
+    bucket = get_bucket(gcs_bucket)
     blob = bucket.blob(filename)
     return json.loads(blob.download_as_bytes().decode('utf-8'))
 
@@ -250,8 +634,7 @@ def list_bucket_files(bucket_name: str) -> list:
     """Returns a list of file names contained in the provided bucket.
 
        bucket_name: The name of the gcs bucket containing files"""
-    gcs_client = storage.Client()
-    bucket = gcs_client.get_bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
     blobs = bucket.list_blobs()
 
     return list(map(lambda blob: blob.name, blobs))
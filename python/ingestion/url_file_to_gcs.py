@@ -3,11 +3,12 @@
 
 import logging
 import os
-from google.cloud import storage
 import google.cloud.exceptions
 import requests
 import filecmp
 
+from ingestion import gcs_to_bq_util
+
 
 def local_file_path(filename):
     return '/tmp/{}'.format(filename)
@@ -62,8 +63,7 @@ def download_first_url_to_gcs(url_list, gcs_bucket, dest_filename,
 
     # Establish connection to valid GCS bucket
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket(gcs_bucket)
+        bucket = gcs_to_bq_util.get_bucket(gcs_bucket)
     except google.cloud.exceptions.NotFound:
         logging.error("GCS Bucket %s not found", gcs_bucket)
         return
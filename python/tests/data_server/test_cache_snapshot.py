@@ -0,0 +1,235 @@
+import json
+import os
+import signal
+import time
+from unittest import mock
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from data_server import cache_snapshot
+from data_server.dataset_cache import DatasetCache
+from data_server.dataset_index import RowFilter
+from data_server.gcs_utils import BlobMetadata, DownloadedBlob
+
+from tests.data_server.test_dataset_cache import (
+    FakeTimer, get_test_data, test_data_csv, test_data_json, wait_for_refresh)
+
+
+def make_cache(timer: FakeTimer) -> DatasetCache:
+    return DatasetCache(cache_ttl=100, hard_cache_ttl=1000, timer=timer)
+
+
+@pytest.fixture
+def saved_cache():
+    timer = FakeTimer()
+    cache = make_cache(timer)
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=get_test_data):
+        cache.getDataset('test_bucket', 'test_data')
+        cache.getDataset('test_bucket', 'test_data.csv')
+    timer.now = 50
+    return cache
+
+
+@mock.patch('time.time', return_value=1000)
+def testSaveLoad(mock_time: mock.MagicMock, saved_cache: DatasetCache,
+                 tmp_path):
+    assert cache_snapshot.save(saved_cache, str(tmp_path)) == 2
+
+    mock_time.return_value = 1010
+    timer = FakeTimer()
+    cache = make_cache(timer)
+    assert cache_snapshot.load(cache, str(tmp_path)) == 2
+
+    original = saved_cache.getDataset('test_bucket', 'test_data')
+    with mock.patch('data_server.gcs_utils.get_blob_metadata',
+                    return_value=BlobMetadata(1, 0)) as mock_meta, \
+            mock.patch('data_server.gcs_utils.download_blob') as mock_dl:
+        data = cache.getDataset('test_bucket', 'test_data')
+        assert data.body == test_data_json
+        assert data.encodings == original.encodings
+        assert data.get_etag() == '1'
+        # Loaded datasets are stale, so they're revalidated on first use.
+        wait_for_refresh(cache, 'test_data')
+        mock_meta.assert_called_once_with('test_bucket', 'test_data')
+        mock_dl.assert_not_called()
+
+        csv = cache.getDataset('test_bucket', 'test_data.csv')
+        assert csv.body == test_data_csv
+        wait_for_refresh(cache, 'test_data.csv')
+
+    # The index is saved too, so filtering doesn't need to rebuild it.
+    row_filter = RowFilter.from_args(MultiDict({'limit': '1'}))
+    page = cache.get_filtered_dataset('test_bucket', 'test_data', row_filter)
+    assert json.loads(page.body) == json.loads(test_data_json)[:1]
+
+
+def testLoad_SkipsExpired(saved_cache: DatasetCache, tmp_path):
+    with mock.patch('time.time', return_value=1000):
+        cache_snapshot.save(saved_cache, str(tmp_path))
+
+    cache = make_cache(FakeTimer())
+    # The datasets were 50 seconds old when saved.
+    with mock.patch('time.time', return_value=1000 + 950):
+        assert cache_snapshot.load(cache, str(tmp_path)) == 0
+    assert cache.stats()['entries'] == 0
+
+
+def testRestore_HonorsHardTtl(saved_cache: DatasetCache):
+    timer = FakeTimer()
+    cache = make_cache(timer)
+    dataset = saved_cache.getDataset('test_bucket', 'test_data')
+    assert cache.restore('test_data', dataset, 900)
+
+    # The dataset is past its hard TTL well before the cache would expire
+    # it, so the next request waits for GCS.
+    timer.now = 150
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    return_value=DownloadedBlob(b'{"updated": 1}', 2)) as \
+            mock_dl:
+        data = cache.getDataset('test_bucket', 'test_data')
+        assert data.body == b'[{"updated": 1}]'
+        mock_dl.assert_called_once_with('test_bucket', 'test_data')
+
+
+def update_dataset(cache: DatasetCache):
+    """Replaces test_data in the cache with a new version."""
+    cache.invalidate('test_bucket', names=['test_data'])
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    return_value=DownloadedBlob(b'{"updated": 1}', 2)):
+        cache.getDataset('test_bucket', 'test_data')
+
+
+def testSave_InterruptedKeepsPreviousSnapshot(saved_cache: DatasetCache,
+                                              tmp_path):
+    cache_snapshot.save(saved_cache, str(tmp_path))
+    update_dataset(saved_cache)
+
+    # The process is killed after writing the files of the new version,
+    # before its manifest.
+    write = cache_snapshot._LocalStore.write
+
+    def write_until_manifest(store, name: str, data: bytes):
+        if name.startswith(cache_snapshot.MANIFEST_PREFIX):
+            raise OSError('Killed')
+        write(store, name, data)
+
+    with mock.patch.object(cache_snapshot._LocalStore, 'write',
+                           write_until_manifest):
+        with pytest.raises(OSError):
+            cache_snapshot.save(saved_cache, str(tmp_path))
+
+    cache = make_cache(FakeTimer())
+    assert cache_snapshot.load(cache, str(tmp_path)) == 2
+    datasets = {table_id: dataset
+                for table_id, dataset, _ in cache.snapshot()}
+    assert datasets['test_data'].body == test_data_json
+    assert datasets['test_data'].get_etag() == '1'
+
+
+def testSave_DeletesUnlistedFiles(saved_cache: DatasetCache, tmp_path):
+    cache_snapshot.save(saved_cache, str(tmp_path))
+    old_files = set(os.listdir(str(tmp_path)))
+    written_at = time.time() - cache_snapshot.CLEANUP_GRACE_SECONDS
+    for name in old_files:
+        os.utime(str(tmp_path / name), (written_at, written_at))
+    (tmp_path / 'tmp_interrupted').write_bytes(b'partial')
+
+    update_dataset(saved_cache)
+    cache_snapshot.save(saved_cache, str(tmp_path))
+    files = set(os.listdir(str(tmp_path)))
+    assert 'tmp_interrupted' in files
+    # Only the files of the old version of test_data are gone.
+    deleted = old_files - files
+    assert deleted and all(name.endswith(('.identity', '.gzip', '.br'))
+                           for name in deleted)
+
+    cache = make_cache(FakeTimer())
+    assert cache_snapshot.load(cache, str(tmp_path)) == 2
+
+
+def testLoad_MergesManifestsOfWorkers(saved_cache: DatasetCache, tmp_path):
+    with mock.patch.object(cache_snapshot, '_get_manifest_name',
+                           return_value='manifest-first.json'):
+        cache_snapshot.save(saved_cache, str(tmp_path))
+
+    # Another worker has a newer version of test_data only.
+    timer = FakeTimer()
+    other = make_cache(timer)
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    return_value=DownloadedBlob(b'{"updated": 1}', 2)):
+        other.getDataset('test_bucket', 'test_data')
+    timer.now = 10
+    with mock.patch.object(cache_snapshot, '_get_manifest_name',
+                           return_value='manifest-second.json'):
+        cache_snapshot.save(other, str(tmp_path))
+
+    cache = make_cache(FakeTimer())
+    assert cache_snapshot.load(cache, str(tmp_path)) == 2
+    datasets = {table_id: dataset
+                for table_id, dataset, _ in cache.snapshot()}
+    assert datasets['test_data'].body == b'[{"updated": 1}]'
+    assert datasets['test_data.csv'].body == test_data_csv
+
+
+def testLoad_SkipsMismatchedFiles(saved_cache: DatasetCache, tmp_path):
+    cache_snapshot.save(saved_cache, str(tmp_path))
+    for path in tmp_path.glob('*.identity'):
+        path.write_bytes(b'truncated')
+
+    cache = make_cache(FakeTimer())
+    assert cache_snapshot.load(cache, str(tmp_path)) == 0
+
+
+def testLoad_NoSnapshot(tmp_path):
+    cache = make_cache(FakeTimer())
+    assert cache_snapshot.load(cache, str(tmp_path / 'missing')) == 0
+
+
+def testSaveLoad_Gcs(saved_cache: DatasetCache):
+    blobs = {}
+
+    def upload_blob(gcs_bucket: str, filename: str, data: bytes):
+        blobs[(gcs_bucket, filename)] = data
+
+    def download_blob(gcs_bucket: str, filename: str):
+        return DownloadedBlob(blobs[(gcs_bucket, filename)], 1)
+
+    def list_blobs(gcs_bucket: str, prefix: str):
+        return [(filename, time.time()) for bucket, filename in blobs
+                if bucket == gcs_bucket and filename.startswith(prefix)]
+
+    with mock.patch('data_server.gcs_utils.upload_blob',
+                    side_effect=upload_blob), \
+            mock.patch('data_server.gcs_utils.download_blob',
+                       side_effect=download_blob), \
+            mock.patch('data_server.gcs_utils.list_blobs',
+                       side_effect=list_blobs), \
+            mock.patch('data_server.gcs_utils.delete_blob') as mock_delete:
+        cache_snapshot.save(saved_cache, 'gs://snapshots/data-server/')
+        assert any(filename.startswith('data-server/manifest-')
+                   for _, filename in blobs)
+        mock_delete.assert_not_called()
+
+        cache = make_cache(FakeTimer())
+        assert cache_snapshot.load(cache,
+                                   'gs://snapshots/data-server') == 2
+
+
+def testSaveOnSigterm(saved_cache: DatasetCache, tmp_path):
+    original_handler = signal.getsignal(signal.SIGTERM)
+    calls = []
+
+    def previous(signum, frame):
+        calls.append(signum)
+
+    signal.signal(signal.SIGTERM, previous)
+    try:
+        cache_snapshot.save_on_sigterm(saved_cache, str(tmp_path))
+        signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+    finally:
+        signal.signal(signal.SIGTERM, original_handler)
+
+    assert calls == [signal.SIGTERM]
+    assert list(tmp_path.glob('manifest-*.json'))
@@ -0,0 +1,106 @@
+import json
+import threading
+from unittest import mock
+
+from data_server import cache_warmer
+from data_server.cache_warmer import CacheWarmer
+from data_server.dataset_cache import DatasetCache
+from data_server.gcs_utils import DownloadedBlob
+
+from tests.data_server.test_dataset_cache import test_data, test_data_size
+
+metadata = b'\n'.join(json.dumps({'id': name}).encode()
+                      for name in ['first', 'second', 'third'])
+
+
+def get_test_data(gcs_bucket: str, filename: str):
+    """Returns the metadata file or a dataset. Meant to be used to patch
+    gcs_utils.download_blob."""
+    if filename == 'metadata.ndjson':
+        return DownloadedBlob(metadata, 1)
+    if filename == 'missing.json':
+        raise Exception('Not found')
+    return DownloadedBlob(test_data, 2)
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testRun_FromMetadata(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    warmer = CacheWarmer(cache, 'test_bucket',
+                         metadata_filename='metadata.ndjson')
+    warmer.run()
+
+    assert warmer.ready.is_set()
+    assert sorted(warmer.loaded) == ['first.json', 'second.json',
+                                     'third.json']
+    assert cache.stats()['entries'] == 4
+    assert mock_func.call_count == 4
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testRun_DatasetNames(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    warmer = CacheWarmer(cache, 'test_bucket',
+                         dataset_names=['first.json', 'missing.json'])
+    warmer.run()
+
+    assert warmer.ready.is_set()
+    assert warmer.loaded == ['first.json']
+    assert warmer.failed == ['missing.json']
+    mock_func.assert_has_calls([mock.call('test_bucket', 'first.json'),
+                                mock.call('test_bucket', 'missing.json')],
+                               any_order=True)
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testRun_StopsAtMemoryBudget(mock_func: mock.MagicMock):
+    cache = DatasetCache(max_cache_bytes=test_data_size * 2)
+    warmer = CacheWarmer(cache, 'test_bucket',
+                         dataset_names=['a', 'b', 'c', 'd'], concurrency=1)
+    warmer.run()
+
+    assert warmer.loaded == ['a', 'b']
+    assert cache.stats()['evictions'] == 0
+
+
+def testRun_Deadline():
+    release = threading.Event()
+
+    def slow_download(gcs_bucket: str, filename: str):
+        release.wait(timeout=5)
+        return DownloadedBlob(test_data, 2)
+
+    cache = DatasetCache()
+    warmer = CacheWarmer(cache, 'test_bucket', dataset_names=['a', 'b'],
+                         concurrency=1, deadline_seconds=0.1)
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=slow_download):
+        warmer.run()
+        assert warmer.ready.is_set()
+        assert not warmer.loaded
+        release.set()
+
+
+def testFromEnv():
+    cache = DatasetCache()
+    assert cache_warmer.from_env(cache) is None
+
+    env = {'DATASET_CACHE_WARMUP': 'true',
+           'DATASET_CACHE_WARMUP_DATASETS': 'a.json, b.json',
+           'DATASET_CACHE_WARMUP_CONCURRENCY': '2',
+           'DATASET_CACHE_WARMUP_DEADLINE_SECONDS': '5',
+           'GCS_BUCKET': 'test_bucket',
+           'METADATA_FILENAME': 'metadata.ndjson'}
+    with mock.patch.dict('os.environ', env):
+        warmer = cache_warmer.from_env(cache)
+    assert warmer.dataset_names == ['a.json', 'b.json']
+    assert warmer.metadata_filename == 'metadata.ndjson'
+    assert warmer.concurrency == 2
+    assert warmer.deadline_seconds == 5
+
+    del env['GCS_BUCKET']
+    with mock.patch.dict('os.environ', env):
+        assert cache_warmer.from_env(cache) is None
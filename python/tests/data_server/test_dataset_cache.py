@@ -1,9 +1,17 @@
+import gzip
+import json
+import threading
 from unittest import mock
 from unittest.mock import call
 
 from textwrap import dedent
 
-from data_server.dataset_cache import DatasetCache
+import google.cloud.exceptions
+import pytest
+
+from data_server import cached_dataset
+from data_server.dataset_cache import DatasetCache, _PendingFetch
+from data_server.gcs_utils import BlobMetadata, DownloadedBlob
 
 
 test_data = dedent("""
@@ -13,7 +21,7 @@ test_data = dedent("""
 {"label1":"value4","label2":["value5a","value2b","value2c"],"label3":"value12"}
 {"label1":"value5","label2":["value6a","value2b","value2c"],"label3":"value15"}
 {"label1":"value6","label2":["value7a","value2b","value2c"],"label3":"value18"}
-""").strip()
+""").strip().encode()
 
 test_data2 = dedent("""
     {"county_geoid":"78020","neighbor_geoids":["78020","78030"]}
@@ -22,29 +30,65 @@ test_data2 = dedent("""
     {"county_geoid":"78030","neighbor_geoids":["78020","78030"]}
     {"county_geoid":"78030","neighbor_geoids":["78020","78030"]}
     {"county_geoid":"78030","neighbor_geoids":["78020","78030"]}
-""").strip()
+""").strip().encode()
+
+# The json array form of the datasets, as served by the data server.
+test_data_json = b'[' + b','.join(test_data.splitlines()) + b']'
+test_data2_json = b'[' + b','.join(test_data2.splitlines()) + b']'
+
+# The memory used by each dataset once cached, including compressed variants.
+test_data_size = cached_dataset.from_blob('test_data', test_data).nbytes
+test_data2_size = cached_dataset.from_blob('test_data2', test_data2).nbytes
+
+test_data_csv = b'label1,label2,label3\nvalueA,valueB,valueC\n'
 
 
 def get_test_data(gcs_bucket: str, filename: str):
-    """Returns the contents of filename as a bytes object. Meant to be used to
-    patch gcs_utils.download_blob_as_bytes."""
+    """Returns the contents and generation of filename. Meant to be used to
+    patch gcs_utils.download_blob."""
     if filename == 'test_data':
-        return test_data
+        return DownloadedBlob(test_data, 1)
     elif filename == 'test_data2':
-        return test_data2
-    return ''
+        return DownloadedBlob(test_data2, 2)
+    elif filename == 'test_data.csv':
+        return DownloadedBlob(test_data_csv, 3)
+    return DownloadedBlob(b'', 4)
 
 
-@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+@mock.patch('data_server.gcs_utils.download_blob',
             side_effect=get_test_data)
 def testGetDataset(mock_func: mock.MagicMock):
     cache = DatasetCache()
     data = cache.getDataset('test_bucket', 'test_data')
     mock_func.assert_called_once_with('test_bucket', 'test_data')
-    assert data == test_data.strip()
+    assert data.body == test_data_json
+    assert data.mimetype == 'application/json'
+    assert data.body == (
+        b'[{"label1":"value1","label2":["value2a","value2b","value2c"],'
+        b'"label3":"value3"},'
+        b'{"label1":"value2","label2":["value3a","value2b","value2c"],'
+        b'"label3":"value6"},'
+        b'{"label1":"value3","label2":["value4a","value2b","value2c"],'
+        b'"label3":"value9"},'
+        b'{"label1":"value4","label2":["value5a","value2b","value2c"],'
+        b'"label3":"value12"},'
+        b'{"label1":"value5","label2":["value6a","value2b","value2c"],'
+        b'"label3":"value15"},'
+        b'{"label1":"value6","label2":["value7a","value2b","value2c"],'
+        b'"label3":"value18"}]')
 
 
-@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_Csv(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    data = cache.getDataset('test_bucket', 'test_data.csv')
+    mock_func.assert_called_once_with('test_bucket', 'test_data.csv')
+    assert data.body == test_data_csv
+    assert data.mimetype == 'text/csv'
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
             side_effect=get_test_data)
 def testGetDataset_FromCache(mock_func: mock.MagicMock):
     # Make the first request, which should incur an API call.
@@ -57,28 +101,29 @@ def testGetDataset_FromCache(mock_func: mock.MagicMock):
     mock_func.assert_called_once()
 
 
-@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+@mock.patch('data_server.gcs_utils.download_blob',
             side_effect=get_test_data)
 def testGetDataset_CacheEviction(mock_func: mock.MagicMock):
-    cache = DatasetCache(max_cache_size=1)
+    # Only one of the two datasets fits in the cache at a time.
+    cache = DatasetCache(max_cache_bytes=test_data_size)
 
     data = cache.getDataset('test_bucket', 'test_data')
-    assert data == test_data
+    assert data.body == test_data_json
 
     # Make a second call which doesn't make an API call.
     data = cache.getDataset('test_bucket', 'test_data')
-    assert data == test_data
+    assert data.body == test_data_json
 
     # Now request a file that is not in the cache. It should replace the
     # existing data.
     data = cache.getDataset('test_bucket', 'test_data2')
-    assert data == test_data2
+    assert data.body == test_data2_json
 
     data = cache.getDataset('test_bucket', 'test_data2')
-    assert data == test_data2
+    assert data.body == test_data2_json
 
     data = cache.getDataset('test_bucket', 'test_data')
-    assert data == test_data
+    assert data.body == test_data_json
 
     assert mock_func.call_count == 3
     mock_func.assert_has_calls([call('test_bucket', 'test_data'),
@@ -86,19 +131,621 @@ def testGetDataset_CacheEviction(mock_func: mock.MagicMock):
                                 call('test_bucket', 'test_data')])
 
 
-@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+@mock.patch('data_server.gcs_utils.download_blob',
             side_effect=get_test_data)
 def testGetDataset_MultipleEntries(mock_func: mock.MagicMock):
     cache = DatasetCache()
     data = cache.getDataset('test_bucket', 'test_data')
-    assert data == test_data
+    assert data.body == test_data_json
 
     data = cache.getDataset('test_bucket', 'test_data2')
-    assert data == test_data2
+    assert data.body == test_data2_json
 
     data = cache.getDataset('test_bucket', 'test_data')
-    assert data == test_data
+    assert data.body == test_data_json
 
     assert mock_func.call_count == 2
     mock_func.assert_has_calls([call('test_bucket', 'test_data'),
                                 call('test_bucket', 'test_data2')])
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_EvictsLeastRecentlyUsed(mock_func: mock.MagicMock):
+    # Budget for both datasets plus a little headroom, but not three.
+    cache = DatasetCache(max_cache_bytes=test_data_size + test_data2_size + 10)
+    cache.getDataset('test_bucket', 'test_data')
+    cache.getDataset('test_bucket', 'test_data2')
+
+    # Touch test_data so that test_data2 becomes the least recently used.
+    cache.getDataset('test_bucket', 'test_data')
+    assert mock_func.call_count == 2
+
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    return_value=DownloadedBlob(b'x' * 20, 5)):
+        cache.getDataset('test_bucket', 'test_data3')
+
+    cache.getDataset('test_bucket', 'test_data')
+    assert mock_func.call_count == 2
+    cache.getDataset('test_bucket', 'test_data2')
+    assert mock_func.call_count == 3
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_LargerThanBudget(mock_func: mock.MagicMock):
+    cache = DatasetCache(max_cache_bytes=test_data_size - 1)
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.body == test_data_json
+
+    # The dataset doesn't fit, so it is fetched again on every request.
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.body == test_data_json
+    assert mock_func.call_count == 2
+    assert cache.stats()['entries'] == 0
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testStats(mock_func: mock.MagicMock):
+    cache = DatasetCache(max_cache_bytes=test_data_size)
+    assert cache.stats() == {'bytes': 0, 'max_bytes': test_data_size,
+                             'entries': 0, 'evictions': 0, 'memory_hits': 0,
+                             'disk_hits': 0, 'gcs_fetches': 0}
+
+    cache.getDataset('test_bucket', 'test_data')
+    cache.getDataset('test_bucket', 'test_data')
+    assert cache.stats() == {'bytes': test_data_size,
+                             'max_bytes': test_data_size,
+                             'entries': 1, 'evictions': 0, 'memory_hits': 1,
+                             'disk_hits': 0, 'gcs_fetches': 1}
+
+    cache.getDataset('test_bucket', 'test_data2')
+    assert cache.stats() == {'bytes': test_data2_size,
+                             'max_bytes': test_data_size,
+                             'entries': 1, 'evictions': 1, 'memory_hits': 1,
+                             'disk_hits': 0, 'gcs_fetches': 2}
+
+
+@mock.patch.dict('os.environ', {'DATASET_CACHE_MAX_BYTES': '1234'})
+def testMaxBytesFromEnv():
+    cache = DatasetCache()
+    assert cache.stats()['max_bytes'] == 1234
+
+
+def run_concurrent_requests(cache: DatasetCache, num_requests: int,
+                            release: threading.Event):
+    """Issues num_requests concurrent getDataset calls for the same dataset.
+    The first call's download is expected to block until `release` is set,
+    which only happens once every other call is waiting on that download.
+
+    Returns: A list of (result, error) tuples, one per request."""
+    results = [None] * num_requests
+    waiting = threading.Semaphore(0)
+    original_wait = _PendingFetch.wait
+
+    def counting_wait(pending):
+        waiting.release()
+        return original_wait(pending)
+
+    def request(i):
+        try:
+            results[i] = (cache.getDataset('test_bucket', 'test_data').body,
+                          None)
+        except Exception as err:  # pylint: disable=broad-except
+            results[i] = (None, err)
+
+    with mock.patch.object(_PendingFetch, 'wait', counting_wait):
+        threads = [threading.Thread(target=request, args=(i,))
+                   for i in range(num_requests)]
+        for thread in threads:
+            thread.start()
+        for _ in range(num_requests - 1):
+            assert waiting.acquire(timeout=5)
+        release.set()
+        for thread in threads:
+            thread.join(timeout=5)
+    return results
+
+
+def testGetDataset_ConcurrentMissesShareOneFetch():
+    release = threading.Event()
+
+    def blocking_download(gcs_bucket: str, filename: str):
+        release.wait(timeout=5)
+        return get_test_data(gcs_bucket, filename)
+
+    cache = DatasetCache()
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=blocking_download) as mock_func:
+        results = run_concurrent_requests(cache, 8, release)
+
+    mock_func.assert_called_once_with('test_bucket', 'test_data')
+    assert results == [(test_data_json, None)] * 8
+    assert not cache.pending_fetches
+
+    # The shared result was also cached.
+    with mock.patch('data_server.gcs_utils.download_blob') as mock_func:
+        data = cache.getDataset('test_bucket', 'test_data')
+        assert data.body == test_data_json
+        mock_func.assert_not_called()
+
+
+def testGetDataset_ConcurrentMissesShareOneError():
+    release = threading.Event()
+    unavailable = google.cloud.exceptions.ServiceUnavailable('GCS is down')
+
+    def blocking_download(gcs_bucket: str, filename: str):
+        release.wait(timeout=5)
+        raise unavailable
+
+    cache = DatasetCache()
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=blocking_download) as mock_func:
+        results = run_concurrent_requests(cache, 8, release)
+
+    mock_func.assert_called_once_with('test_bucket', 'test_data')
+    assert results == [(None, unavailable)] * 8
+    assert not cache.pending_fetches
+
+    # A failed fetch isn't remembered unless the dataset is missing, so the
+    # next request tries again.
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=get_test_data) as mock_func:
+        data = cache.getDataset('test_bucket', 'test_data')
+        assert data.body == test_data_json
+        mock_func.assert_called_once()
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=google.cloud.exceptions.NotFound('File not found'))
+def testGetDataset_FetchError(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    with pytest.raises(google.cloud.exceptions.NotFound):
+        cache.getDataset('test_bucket', 'test_data')
+    assert not cache.pending_fetches
+
+
+def testFromBlob_CompressedVariants():
+    dataset = cached_dataset.from_blob('test_data', test_data)
+    assert gzip.decompress(dataset.encodings['gzip']) == test_data_json
+    if cached_dataset.brotli is not None:
+        assert (cached_dataset.brotli.decompress(dataset.encodings['br']) ==
+                test_data_json)
+    assert dataset.nbytes == len(test_data_json) + sum(
+        len(encoded) for encoded in dataset.encodings.values()) + (
+        dataset.index.nbytes)
+
+
+def testFromBlob_SkipsVariantsThatDontShrink():
+    dataset = cached_dataset.from_blob('tiny.csv', b'a\n1\n')
+    assert dataset.body == b'a\n1\n'
+    assert dataset.encodings == {}
+    assert dataset.nbytes == 4 + dataset.index.nbytes
+
+
+@mock.patch.object(cached_dataset, 'brotli', None)
+def testFromBlob_WithoutBrotli():
+    dataset = cached_dataset.from_blob('test_data', test_data)
+    assert set(dataset.encodings) == {'gzip'}
+
+
+def testFromBlob_Etag():
+    dataset = cached_dataset.from_blob('test_data', test_data, 1234)
+    assert dataset.get_etag() == '1234'
+    assert dataset.get_etag('gzip') == '1234-gzip'
+
+    # Without a generation, the tag falls back to the file's md5 hash, in the
+    # same base64 form GCS uses.
+    dataset = cached_dataset.from_blob('test_data.csv', b'a,b\n')
+    assert dataset.get_etag() == '9p9bcrx5qS3HDGPJqhQuNg=='
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDataset_EtagFromGeneration(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    assert cache.getDataset('test_bucket', 'test_data').get_etag() == '1'
+    assert cache.getDataset('test_bucket', 'test_data2').get_etag() == '2'
+
+
+class FakeTimer():
+    """Manually advanced clock for testing the cache TTLs."""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def wait_for_refresh(cache: DatasetCache, table_id: str):
+    """Blocks until any background refresh of table_id has finished."""
+    pending = cache.pending_refreshes.get(table_id)
+    if pending is not None:
+        assert pending.done.wait(timeout=5)
+
+
+def testGetDataset_StaleWhileRevalidate():
+    timer = FakeTimer()
+    cache = DatasetCache(cache_ttl=100, hard_cache_ttl=1000, timer=timer)
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=get_test_data):
+        cache.getDataset('test_bucket', 'test_data')
+
+    # Within the soft TTL nothing is checked.
+    timer.now = 99
+    with mock.patch('data_server.gcs_utils.get_blob_metadata') as mock_meta:
+        assert cache.getDataset('test_bucket', 'test_data').get_etag() == '1'
+        mock_meta.assert_not_called()
+
+    # Past the soft TTL, the stale dataset is returned right away while a
+    # newer generation is downloaded in the background.
+    timer.now = 100
+    with mock.patch('data_server.gcs_utils.get_blob_metadata',
+                    return_value=BlobMetadata(7, len(test_data2))), \
+            mock.patch('data_server.gcs_utils.download_blob',
+                       return_value=DownloadedBlob(test_data2, 7)) as mock_dl:
+        data = cache.getDataset('test_bucket', 'test_data')
+        assert data.body == test_data_json
+        wait_for_refresh(cache, 'test_data')
+        mock_dl.assert_called_once_with('test_bucket', 'test_data')
+
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.body == test_data2_json
+    assert data.get_etag() == '7'
+    assert data.fetched_at == 100
+
+
+def testGetDataset_RefreshSkipsUnchangedGeneration():
+    timer = FakeTimer()
+    cache = DatasetCache(cache_ttl=100, hard_cache_ttl=1000, timer=timer)
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=get_test_data):
+        original = cache.getDataset('test_bucket', 'test_data')
+
+    timer.now = 500
+    metadata = BlobMetadata(1, len(test_data))
+    with mock.patch('data_server.gcs_utils.get_blob_metadata',
+                    return_value=metadata) as mock_meta, \
+            mock.patch('data_server.gcs_utils.download_blob') as mock_dl:
+        cache.getDataset('test_bucket', 'test_data')
+        wait_for_refresh(cache, 'test_data')
+        mock_meta.assert_called_once_with('test_bucket', 'test_data')
+        mock_dl.assert_not_called()
+
+        # The dataset is fresh again.
+        timer.now = 550
+        assert cache.getDataset('test_bucket', 'test_data') is original
+        mock_meta.assert_called_once()
+
+        # Its hard TTL was reset too, so it's still served past the original
+        # one.
+        timer.now = 1400
+        assert cache.getDataset('test_bucket', 'test_data') is original
+        wait_for_refresh(cache, 'test_data')
+        mock_dl.assert_not_called()
+
+
+def testGetDataset_RefreshFailureKeepsServingStale():
+    timer = FakeTimer()
+    cache = DatasetCache(cache_ttl=100, hard_cache_ttl=1000, timer=timer)
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=get_test_data):
+        cache.getDataset('test_bucket', 'test_data')
+
+    timer.now = 200
+    with mock.patch('data_server.gcs_utils.get_blob_metadata',
+                    side_effect=Exception('GCS is down')):
+        data = cache.getDataset('test_bucket', 'test_data')
+        wait_for_refresh(cache, 'test_data')
+        assert data.body == test_data_json
+        assert not cache.pending_refreshes
+
+        data = cache.getDataset('test_bucket', 'test_data')
+        wait_for_refresh(cache, 'test_data')
+        assert data.body == test_data_json
+
+
+def testGetDataset_HardTtlBlocks():
+    timer = FakeTimer()
+    cache = DatasetCache(cache_ttl=100, hard_cache_ttl=1000, timer=timer)
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=get_test_data):
+        cache.getDataset('test_bucket', 'test_data')
+
+    timer.now = 1000
+    with mock.patch('data_server.gcs_utils.get_blob_metadata') as mock_meta, \
+            mock.patch('data_server.gcs_utils.download_blob',
+                       return_value=DownloadedBlob(test_data2, 7)) as mock_dl:
+        data = cache.getDataset('test_bucket', 'test_data')
+        assert data.body == test_data2_json
+        mock_dl.assert_called_once_with('test_bucket', 'test_data')
+        mock_meta.assert_not_called()
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetDatasets(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    cache.getDataset('test_bucket', 'test_data')
+    datasets = cache.get_datasets('test_bucket',
+                                  ['test_data2', 'test_data', 'test_data.csv'])
+    assert list(datasets) == ['test_data2', 'test_data', 'test_data.csv']
+    assert datasets['test_data2'].body == test_data2_json
+    assert datasets['test_data.csv'].body == test_data_csv
+    assert mock_func.call_count == 3
+
+
+def testGetDatasets_FetchesConcurrently():
+    # Both downloads have to be in progress at the same time to finish.
+    barrier = threading.Barrier(2, timeout=5)
+
+    def concurrent_download(gcs_bucket: str, filename: str):
+        barrier.wait()
+        return get_test_data(gcs_bucket, filename)
+
+    cache = DatasetCache()
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=concurrent_download):
+        datasets = cache.get_datasets('test_bucket',
+                                      ['test_data', 'test_data2'])
+    assert datasets['test_data'].body == test_data_json
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetBatch(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    batch = cache.get_batch('test_bucket', ['test_data', 'test_data.csv'])
+    assert json.loads(batch.body) == {
+        'test_data': json.loads(test_data_json),
+        'test_data.csv': test_data_csv.decode()}
+    assert gzip.decompress(batch.encodings['gzip']) == batch.body
+
+    assert cache.get_batch('test_bucket',
+                           ['test_data', 'test_data.csv']) is batch
+    other = cache.get_batch('test_bucket', ['test_data.csv', 'test_data'])
+    assert other.get_etag() != batch.get_etag()
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testGetBatch_TooLargeToCache(mock_func: mock.MagicMock):
+    cache = DatasetCache(max_filtered_bytes=1)
+    table_ids = ['test_data', 'test_data.csv', 'test_data2']
+    cache.get_datasets('test_bucket', table_ids)
+
+    with mock.patch('data_server.cached_dataset.compress') as mock_compress:
+        batch = cache.get_batch('test_bucket', table_ids)
+        mock_compress.assert_not_called()
+    assert json.loads(batch.body) == {
+        'test_data': json.loads(test_data_json),
+        'test_data.csv': test_data_csv.decode(),
+        'test_data2': json.loads(test_data2_json)}
+    assert list(batch.encodings) == ['gzip']
+    assert gzip.decompress(batch.encodings['gzip']) == batch.body
+
+    again = cache.get_batch('test_bucket', table_ids)
+    assert again is not batch
+    assert again.get_etag() == batch.get_etag()
+    assert not cache.derived
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testInvalidate(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    for table_id in ['test_data', 'test_data2', 'test_data.csv']:
+        cache.getDataset('test_bucket', table_id)
+    batch = cache.get_batch('test_bucket', ['test_data', 'test_data.csv'])
+
+    assert cache.invalidate('test_bucket', names=['test_data.csv'],
+                            prefix='test_data2') == [
+        'test_data.csv', 'test_data2']
+    assert cache.stats()['entries'] == 1
+    assert not cache.derived
+
+    cache.getDataset('test_bucket', 'test_data')
+    assert mock_func.call_count == 3
+    assert cache.get_batch('test_bucket',
+                           ['test_data', 'test_data.csv']) is not batch
+    assert mock_func.call_count == 4
+
+
+def testInvalidate_Refresh():
+    timer = FakeTimer()
+    cache = DatasetCache(cache_ttl=100, hard_cache_ttl=1000, timer=timer)
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=get_test_data):
+        cache.getDataset('test_bucket', 'test_data')
+
+    # Refreshes happen even though the dataset is still fresh.
+    timer.now = 10
+    with mock.patch('data_server.gcs_utils.get_blob_metadata',
+                    return_value=BlobMetadata(7, len(test_data2))), \
+            mock.patch('data_server.gcs_utils.download_blob',
+                       return_value=DownloadedBlob(test_data2, 7)):
+        assert cache.invalidate('test_bucket', prefix='test_',
+                                refresh=True) == ['test_data']
+        wait_for_refresh(cache, 'test_data')
+
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.body == test_data2_json
+    assert data.fetched_at == 10
+
+
+def testInvalidate_DuringFetch():
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking_download(gcs_bucket: str, filename: str):
+        started.set()
+        release.wait(timeout=5)
+        return DownloadedBlob(test_data, 1)
+
+    cache = DatasetCache()
+    results = []
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=blocking_download):
+        thread = threading.Thread(target=lambda: results.append(
+            cache.getDataset('test_bucket', 'test_data')))
+        thread.start()
+        assert started.wait(timeout=5)
+        assert cache.invalidate('test_bucket', names=['test_data']) == [
+            'test_data']
+        release.set()
+        thread.join(timeout=5)
+
+    # The request that started the fetch gets its result, but the version
+    # from before the invalidation isn't cached.
+    assert results[0].body == test_data_json
+    assert cache.stats()['entries'] == 0
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    return_value=DownloadedBlob(test_data2, 2)):
+        assert cache.getDataset('test_bucket',
+                                'test_data').body == test_data2_json
+
+
+def testInvalidate_RefreshDuringRefresh():
+    timer = FakeTimer()
+    cache = DatasetCache(cache_ttl=100, hard_cache_ttl=1000, timer=timer)
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=get_test_data):
+        cache.getDataset('test_bucket', 'test_data')
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def get_blob_metadata(gcs_bucket: str, filename: str):
+        # The refresh that is already running read the metadata from before
+        # the export.
+        if not started.is_set():
+            started.set()
+            release.wait(timeout=5)
+            return BlobMetadata(1, None)
+        return BlobMetadata(2, None)
+
+    timer.now = 200
+    with mock.patch('data_server.gcs_utils.get_blob_metadata',
+                    side_effect=get_blob_metadata), \
+            mock.patch('data_server.gcs_utils.download_blob',
+                       return_value=DownloadedBlob(test_data2, 2)):
+        cache.getDataset('test_bucket', 'test_data')
+        assert started.wait(timeout=5)
+        outdated = cache.pending_refreshes['test_data']
+
+        assert cache.invalidate('test_bucket', names=['test_data'],
+                                refresh=True) == ['test_data']
+        wait_for_refresh(cache, 'test_data')
+        release.set()
+        assert outdated.done.wait(timeout=5)
+
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.body == test_data2_json
+    assert data.generation == 2
+
+
+def testGetDataset_NotFoundIsCached():
+    timer = FakeTimer()
+    cache = DatasetCache(not_found_ttl=60, timer=timer)
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=google.cloud.exceptions.NotFound(
+                        'No such object')) as mock_dl:
+        for _ in range(2):
+            with pytest.raises(google.cloud.exceptions.NotFound,
+                               match='No such object'):
+                cache.getDataset('test_bucket', 'missing')
+        mock_dl.assert_called_once()
+
+        timer.now = 60
+        with pytest.raises(google.cloud.exceptions.NotFound):
+            cache.getDataset('test_bucket', 'missing')
+        assert mock_dl.call_count == 2
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=Exception('GCS is down'))
+def testGetDataset_OtherErrorsNotCached(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    for _ in range(2):
+        with pytest.raises(Exception):
+            cache.getDataset('test_bucket', 'test_data')
+    assert mock_func.call_count == 2
+
+
+def testGetDataset_NotFoundDoesntEvictDatasets():
+    cache = DatasetCache(max_cache_bytes=test_data_size)
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=get_test_data):
+        cache.getDataset('test_bucket', 'test_data')
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=google.cloud.exceptions.NotFound('missing')):
+        for i in range(10):
+            with pytest.raises(google.cloud.exceptions.NotFound):
+                cache.getDataset('test_bucket', 'missing{}'.format(i))
+    assert cache.stats()['entries'] == 1
+    assert len(cache.not_found) == 10
+
+
+def testInvalidate_NotFound():
+    cache = DatasetCache()
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=google.cloud.exceptions.NotFound('missing')):
+        with pytest.raises(google.cloud.exceptions.NotFound):
+            cache.getDataset('test_bucket', 'test_data')
+
+    cache.invalidate('test_bucket', names=['test_data'])
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=get_test_data):
+        assert cache.getDataset('test_bucket',
+                                'test_data').body == test_data_json
+
+
+def testIterNdjsonToJsonArray():
+    chunks = [test_data[i:i + 7] for i in range(0, len(test_data), 7)]
+    assert b''.join(cached_dataset.iter_ndjson_to_json_array(
+        chunks)) == test_data_json
+    assert b''.join(cached_dataset.iter_ndjson_to_json_array(
+        [b'{"a":1}\r\n\n{"a":', b'2}\n'])) == b'[{"a":1},{"a":2}]'
+    assert b''.join(cached_dataset.iter_ndjson_to_json_array([])) == b'[]'
+
+
+def testGetPassthrough():
+    cache = DatasetCache(passthrough_min_bytes=100)
+    with mock.patch('data_server.gcs_utils.get_blob_metadata',
+                    return_value=BlobMetadata(7, 100)) as mock_meta:
+        assert cache.get_passthrough('test_bucket', 'big') == BlobMetadata(
+            7, 100)
+        mock_meta.assert_called_once_with('test_bucket', 'big')
+
+    # The metadata is read again on every request, so streams never start
+    # from a generation that was overwritten since.
+    with mock.patch('data_server.gcs_utils.get_blob_metadata',
+                    return_value=BlobMetadata(8, 100)):
+        assert cache.get_passthrough('test_bucket', 'big') == BlobMetadata(
+            8, 100)
+
+    with mock.patch('data_server.gcs_utils.get_blob_metadata',
+                    return_value=BlobMetadata(1, 99)):
+        assert cache.get_passthrough('test_bucket', 'test_data') is None
+
+    # Cached datasets are served from the cache without checking GCS.
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=get_test_data):
+        cache.getDataset('test_bucket', 'test_data')
+    with mock.patch('data_server.gcs_utils.get_blob_metadata') as mock_meta:
+        assert cache.get_passthrough('test_bucket', 'test_data') is None
+        mock_meta.assert_not_called()
+
+
+def testGetPassthrough_Disabled():
+    cache = DatasetCache()
+    with mock.patch('data_server.gcs_utils.get_blob_metadata') as mock_meta:
+        assert cache.get_passthrough('test_bucket', 'big') is None
+        mock_meta.assert_not_called()
+
+
+@mock.patch.dict('os.environ', {'DATASET_PASSTHROUGH_MIN_BYTES': '1234'})
+def testGetPassthrough_FromEnv():
+    assert DatasetCache().passthrough_min_bytes == 1234
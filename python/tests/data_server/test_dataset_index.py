@@ -0,0 +1,155 @@
+import json
+from unittest import mock
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from data_server import cached_dataset
+from data_server.dataset_cache import DatasetCache
+from data_server.dataset_index import (DatasetIndex, RowFilter,
+                                       UnsupportedFilterError)
+from data_server.gcs_utils import BlobMetadata, DownloadedBlob
+
+rows = [
+    {'state_fips': '06', 'county_fips': '06001', 'sex': 'Male', 'cases': 1},
+    {'state_fips': '06', 'county_fips': '06001', 'sex': 'Female',
+     'cases': 2},
+    {'state_fips': '06', 'county_fips': '06003', 'sex': 'Male', 'cases': 3},
+    {'state_fips': '01', 'county_fips': '01001', 'sex': 'Male', 'cases': 4},
+    {'state_fips': '01', 'county_fips': '01001', 'sex': 'Female',
+     'cases': None},
+]
+test_data = b'\n'.join(json.dumps(row).encode() for row in rows)
+
+
+def filter_rows(args: dict) -> list:
+    dataset = cached_dataset.from_blob('test_data', test_data)
+    row_filter = RowFilter.from_args(MultiDict(args))
+    return json.loads(dataset.index.filter_body(dataset.body, row_filter))
+
+
+def testFromArgs():
+    assert RowFilter.from_args(MultiDict({'name': 'test_data'})) is None
+
+    args = MultiDict([('sex', 'Male,Female'), ('state_fips', '06'),
+                      ('sex', 'Male'), ('columns', 'cases,sex')])
+    assert RowFilter.from_args(args) == RowFilter(
+        (('state_fips', ('06',)), ('sex', ('Female', 'Male'))),
+        ('cases', 'sex'))
+
+
+def testFilterBody():
+    assert filter_rows({'state_fips': '06'}) == rows[:3]
+    assert filter_rows({'state_fips': '06', 'sex': 'Male'}) == [
+        rows[0], rows[2]]
+    assert filter_rows({'state_fips': '06,01', 'sex': 'Female'}) == [
+        rows[1], rows[4]]
+    assert filter_rows({'state_fips': '02'}) == []
+
+
+def testFilterBody_CountyPrefix():
+    assert filter_rows({'county_fips': '06'}) == rows[:3]
+    assert filter_rows({'county_fips': '06001'}) == rows[:2]
+
+
+def testFilterBody_Columns():
+    assert filter_rows({'state_fips': '01', 'columns': 'cases,missing'}) == [
+        {'cases': 4}, {'cases': None}]
+    assert filter_rows({'columns': 'sex'}) == [
+        {'sex': row['sex']} for row in rows]
+
+
+def testFilterBody_NonAscii():
+    data = '{"county_name":"Doña Ana","state_fips":"35"}\n{"state_fips":"01"}'
+    dataset = cached_dataset.from_blob('test_data', data.encode())
+    row_filter = RowFilter.from_args(MultiDict({'state_fips': '35'}))
+    assert json.loads(dataset.index.filter_body(dataset.body, row_filter)) == [
+        {'county_name': 'Doña Ana', 'state_fips': '35'}]
+
+
+def testFromRows_NotObjects():
+    assert DatasetIndex.from_rows([b'[1, 2]']) is None
+    assert DatasetIndex.from_rows([b'not json']) is None
+    csv = cached_dataset.from_blob('test_data.csv', b'a,b\n1,2\n')
+    assert not csv.index.filterable
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            return_value=DownloadedBlob(test_data, 1))
+def testGetFilteredDataset(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    row_filter = RowFilter.from_args(MultiDict({'state_fips': '01'}))
+    filtered = cache.get_filtered_dataset('test_bucket', 'test_data',
+                                          row_filter)
+    assert json.loads(filtered.body) == rows[3:]
+    assert filtered.get_etag() == '1-{}'.format(row_filter.digest())
+
+    with mock.patch.object(DatasetIndex, 'filter_body') as mock_filter:
+        assert cache.get_filtered_dataset('test_bucket', 'test_data',
+                                          row_filter) is filtered
+        mock_filter.assert_not_called()
+    mock_func.assert_called_once()
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            return_value=DownloadedBlob(b'a,b\n1,2\n', 1))
+def testGetFilteredDataset_Csv(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    row_filter = RowFilter.from_args(MultiDict({'state_fips': '01'}))
+    with pytest.raises(UnsupportedFilterError):
+        cache.get_filtered_dataset('test_bucket', 'test_data.csv', row_filter)
+
+
+@mock.patch('data_server.gcs_utils.get_blob_metadata',
+            return_value=BlobMetadata(1, 100))
+@mock.patch('data_server.gcs_utils.download_blob')
+def testGetFilteredDataset_TooLargeToCache(mock_download: mock.MagicMock,
+                                           mock_meta: mock.MagicMock):
+    cache = DatasetCache(passthrough_min_bytes=100)
+    row_filter = RowFilter.from_args(MultiDict({'state_fips': '01'}))
+    with pytest.raises(UnsupportedFilterError, match='too large'):
+        cache.get_filtered_dataset('test_bucket', 'test_data', row_filter)
+    mock_download.assert_not_called()
+
+
+def testFilterBody_Page():
+    assert filter_rows({'offset': '1', 'limit': '2'}) == rows[1:3]
+    assert filter_rows({'offset': '4'}) == rows[4:]
+    assert filter_rows({'offset': '10'}) == []
+    assert filter_rows({'limit': '0'}) == []
+    assert filter_rows({'sex': 'Male', 'offset': '1', 'limit': '1'}) == [
+        rows[2]]
+
+
+def testFromArgs_InvalidPage():
+    with pytest.raises(ValueError):
+        RowFilter.from_args(MultiDict({'offset': '-1'}))
+    with pytest.raises(ValueError):
+        RowFilter.from_args(MultiDict({'limit': 'all'}))
+
+
+def testFromCsv():
+    data = b'a,b\n1,"x\ny"\n2,z\n3,w'
+    index = DatasetIndex.from_csv(data)
+    assert [data[start:end] for start, end in zip(index.starts, index.ends)
+            ] == [b'1,"x\ny"\n', b'2,z\n', b'3,w']
+    assert index.prefix == b'a,b\n'
+
+    row_filter = RowFilter((), None, offset=1, limit=1)
+    assert index.filter_body(data, row_filter) == b'a,b\n2,z\n'
+    row_filter = RowFilter((), None, offset=0, limit=2)
+    assert index.filter_body(memoryview(data), row_filter) == (
+        b'a,b\n1,"x\ny"\n2,z\n')
+
+    assert DatasetIndex.from_csv(b'').filter_body(b'', row_filter) == b''
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            return_value=DownloadedBlob(b'a,b\n1,2\n3,4\n', 1))
+def testGetFilteredDataset_CsvPage(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    row_filter = RowFilter.from_args(MultiDict({'offset': '1'}))
+    page = cache.get_filtered_dataset('test_bucket', 'test_data.csv',
+                                      row_filter)
+    assert page.body == b'a,b\n3,4\n'
+    assert page.mimetype == 'text/csv'
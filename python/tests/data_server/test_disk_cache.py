@@ -0,0 +1,448 @@
+import mmap
+import os
+import threading
+from unittest import mock
+
+import pytest
+
+from data_server import cached_dataset, disk_cache
+from data_server.dataset_cache import DatasetCache
+from data_server.disk_cache import DiskCache, SharedDiskCache
+from data_server.gcs_utils import BlobMetadata, DownloadedBlob
+
+from tests.data_server.test_dataset_cache import (
+    FakeTimer, get_test_data, test_data, test_data2, test_data_json,
+    test_data2_json, test_data_size, test_data2_size, wait_for_refresh)
+
+
+@pytest.fixture
+def disk(tmp_path):
+    cache = DiskCache(str(tmp_path), promote_after=0)
+    yield cache
+    cache.clear()
+
+
+def make_dataset(table_id: str, data: bytes, generation: int):
+    dataset = cached_dataset.from_blob(table_id, data, generation)
+    dataset.fetched_at = 10
+    return dataset
+
+
+def testPutGet(disk: DiskCache):
+    original = make_dataset('test_data', test_data, 1)
+    disk.put('test_data', original)
+
+    dataset, hits = disk.get('test_data')
+    assert hits == 1
+    assert isinstance(dataset.body, mmap.mmap)
+    assert not dataset.in_memory
+    assert dataset.body[:] == test_data_json
+    assert dataset.mimetype == 'application/json'
+    assert {coding: bytes(encoded)
+            for coding, encoded in dataset.encodings.items()} == \
+        original.encodings
+    assert dataset.get_etag() == '1'
+    assert dataset.generation == 1
+    assert dataset.fetched_at == 10
+    assert dataset.index is original.index
+    assert dataset.nbytes == original.nbytes
+    assert disk.currsize == original.nbytes
+
+    assert disk.get('test_data')[1] == 2
+    assert disk.get('missing') == (None, 0)
+
+
+def testPut_ReplacesOlderVersion(disk: DiskCache):
+    disk.put('test_data', make_dataset('test_data', test_data, 1))
+    disk.put('test_data', make_dataset('test_data', test_data2, 2))
+
+    dataset, _ = disk.get('test_data')
+    assert dataset.body[:] == test_data2_json
+    assert len(disk) == 1
+    assert disk.currsize == test_data2_size
+    # Only the files of the latest version are left.
+    assert len(os.listdir(disk.directory)) == 1 + len(dataset.encodings)
+
+
+def testPut_SameVersionUpdatesFetchedAt(disk: DiskCache):
+    dataset = make_dataset('test_data', test_data, 1)
+    disk.put('test_data', dataset)
+    dataset.fetched_at = 20
+    disk.put('test_data', dataset)
+    assert disk.get('test_data')[0].fetched_at == 20
+
+
+def testPut_EvictsLeastRecentlyUsed(tmp_path):
+    disk = DiskCache(str(tmp_path),
+                     max_disk_bytes=test_data_size + test_data2_size)
+    disk.put('test_data', make_dataset('test_data', test_data, 1))
+    disk.put('test_data2', make_dataset('test_data2', test_data2, 2))
+    disk.get('test_data')
+
+    disk.put('test_data3', make_dataset('test_data3', test_data2, 3))
+    assert disk.get('test_data')[0] is not None
+    assert disk.get('test_data2')[0] is None
+    assert disk.currsize == test_data_size + test_data2_size
+
+
+def testPut_LargerThanBudget(tmp_path):
+    disk = DiskCache(str(tmp_path), max_disk_bytes=test_data_size - 1)
+    disk.put('test_data', make_dataset('test_data', test_data, 1))
+    assert disk.get('test_data') == (None, 0)
+    assert not os.listdir(disk.directory)
+
+
+def testMappedBodySurvivesRemoval(disk: DiskCache):
+    disk.put('test_data', make_dataset('test_data', test_data, 1))
+    dataset, _ = disk.get('test_data')
+    disk.remove('test_data')
+    assert dataset.body[:] == test_data_json
+
+
+def testFromEnv(tmp_path):
+    assert disk_cache.from_env() is None
+
+    env = {'DATASET_CACHE_DISK_DIR': str(tmp_path),
+           'DATASET_CACHE_DISK_MAX_BYTES': '1234',
+           'DATASET_CACHE_DISK_PROMOTE_AFTER': '5'}
+    with mock.patch.dict('os.environ', env):
+        disk = disk_cache.from_env()
+    assert disk.max_disk_bytes == 1234
+    assert disk.promote_after == 5
+    assert os.path.dirname(disk.directory) == str(tmp_path)
+
+    with mock.patch.dict('os.environ',
+                         {'DATASET_CACHE_SHARED_DIR': str(tmp_path)}):
+        disk = disk_cache.from_env()
+    assert isinstance(disk, SharedDiskCache)
+    assert disk.directory == str(tmp_path)
+    assert disk.promote_after == 0
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testDatasetCache_EvictedToDisk(mock_func: mock.MagicMock,
+                                   disk: DiskCache):
+    cache = DatasetCache(max_cache_bytes=test_data_size, disk_cache=disk)
+    cache.getDataset('test_bucket', 'test_data')
+    cache.getDataset('test_bucket', 'test_data2')
+    assert len(disk) == 1
+
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.body[:] == test_data_json
+    assert mock_func.call_count == 2
+    stats = cache.stats()
+    assert stats['disk_hits'] == 1
+    assert stats['gcs_fetches'] == 2
+    assert stats['disk_entries'] == 1
+    assert stats['disk_bytes'] == test_data_size
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testDatasetCache_LargerThanMemoryGoesToDisk(mock_func: mock.MagicMock,
+                                                disk: DiskCache):
+    cache = DatasetCache(max_cache_bytes=test_data_size - 1, disk_cache=disk)
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.in_memory
+
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert not data.in_memory
+    assert data.body[:] == test_data_json
+    assert mock_func.call_count == 1
+    assert cache.stats()['entries'] == 0
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testDatasetCache_PromotesAfterRepeatedHits(mock_func: mock.MagicMock,
+                                               tmp_path):
+    disk = DiskCache(str(tmp_path), promote_after=2)
+    cache = DatasetCache(max_cache_bytes=test_data_size + test_data2_size,
+                         disk_cache=disk)
+    disk.put('test_data', make_dataset('test_data', test_data, 1))
+    cache.timer = lambda: 10
+
+    assert not cache.getDataset('test_bucket', 'test_data').in_memory
+    assert cache.stats()['entries'] == 0
+
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.in_memory
+    assert data.body == test_data_json
+    assert cache.getDataset('test_bucket', 'test_data') is data
+    mock_func.assert_not_called()
+    stats = cache.stats()
+    assert stats['disk_hits'] == 2
+    assert stats['memory_hits'] == 1
+
+
+def testDatasetCache_DiskHonorsHardTtl(disk: DiskCache):
+    timer = FakeTimer()
+    cache = DatasetCache(max_cache_bytes=1, cache_ttl=100,
+                         hard_cache_ttl=1000, timer=timer, disk_cache=disk)
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    side_effect=get_test_data):
+        cache.getDataset('test_bucket', 'test_data')
+    assert len(disk) == 1
+
+    timer.now = 1000
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    return_value=DownloadedBlob(test_data2, 7)) as mock_dl:
+        data = cache.getDataset('test_bucket', 'test_data')
+        assert data.body == test_data2_json
+        mock_dl.assert_called_once_with('test_bucket', 'test_data')
+
+
+def testDatasetCache_DiskServesStaleWhileRefreshing(disk: DiskCache):
+    timer = FakeTimer()
+    cache = DatasetCache(max_cache_bytes=1, cache_ttl=100,
+                         hard_cache_ttl=1000, timer=timer, disk_cache=disk)
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    return_value=DownloadedBlob(test_data, 1)):
+        cache.getDataset('test_bucket', 'test_data')
+
+    release = threading.Event()
+
+    def blocking_metadata(gcs_bucket: str, filename: str):
+        release.wait(timeout=5)
+        return BlobMetadata(1, None)
+
+    timer.now = 200
+    with mock.patch('data_server.gcs_utils.get_blob_metadata',
+                    side_effect=blocking_metadata) as mock_meta:
+        data = cache.getDataset('test_bucket', 'test_data')
+        assert data.body[:] == test_data_json
+        # Requests made while the refresh waits on GCS are served from disk.
+        data = cache.getDataset('test_bucket', 'test_data')
+        assert data.body[:] == test_data_json
+        assert not release.is_set()
+        release.set()
+        wait_for_refresh(cache, 'test_data')
+        mock_meta.assert_called_once_with('test_bucket', 'test_data')
+    assert not cache.pending_refreshes
+    assert cache.stats()['disk_hits'] == 2
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testDatasetCache_DiskErrorIsHandedToWaiters(mock_func: mock.MagicMock,
+                                                disk: DiskCache):
+    cache = DatasetCache(max_cache_bytes=1, disk_cache=disk)
+    with mock.patch.object(disk, 'get', side_effect=OSError('disk failed')):
+        with pytest.raises(OSError):
+            cache.getDataset('test_bucket', 'test_data')
+    assert not cache.pending_fetches
+
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.body == test_data_json
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testDatasetCache_InvalidateDisk(mock_func: mock.MagicMock,
+                                    disk: DiskCache):
+    cache = DatasetCache(max_cache_bytes=1, disk_cache=disk)
+    cache.getDataset('test_bucket', 'test_data')
+    assert disk.table_ids() == ['test_data']
+
+    assert cache.invalidate('test_bucket', names=['test_data']) == [
+        'test_data']
+    assert len(disk) == 0
+
+
+def list_data_files(directory: str) -> list:
+    return [name for name in os.listdir(directory)
+            if not name.endswith('.lock')]
+
+
+def testSharedPutGet(tmp_path):
+    # Each worker process has its own SharedDiskCache for the same directory.
+    writer = SharedDiskCache(str(tmp_path))
+    reader = SharedDiskCache(str(tmp_path))
+    original = make_dataset('test_data', test_data, 1)
+    writer.put('test_data', original)
+
+    dataset, hits = reader.get('test_data')
+    assert hits == 1
+    assert isinstance(dataset.body, mmap.mmap)
+    assert dataset.body[:] == test_data_json
+    assert {coding: bytes(encoded)
+            for coding, encoded in dataset.encodings.items()} == \
+        original.encodings
+    assert dataset.get_etag() == '1'
+    assert dataset.generation == 1
+    assert dataset.fetched_at == 10
+    assert dataset.index.to_dict() == original.index.to_dict()
+    assert dataset.nbytes == original.nbytes
+    assert reader.currsize == original.nbytes
+    assert len(reader) == 1
+    assert 'test_data' in reader
+    assert reader.table_ids() == ['test_data']
+    assert reader.get('missing') == (None, 0)
+
+    writer.remove('test_data')
+    assert reader.get('test_data') == (None, 0)
+    assert dataset.body[:] == test_data_json
+    assert not list_data_files(str(tmp_path))
+
+
+def testShared_ReplacesOlderVersion(tmp_path):
+    disk = SharedDiskCache(str(tmp_path))
+    disk.put('test_data', make_dataset('test_data', test_data, 1))
+    disk.put('test_data', make_dataset('test_data', test_data2, 2))
+
+    dataset, _ = disk.get('test_data')
+    assert dataset.body[:] == test_data2_json
+    assert disk.currsize == test_data2_size
+    # Only the metadata and files of the latest version are left.
+    assert len(list_data_files(str(tmp_path))) == 2 + len(dataset.encodings)
+
+    dataset.fetched_at = 20
+    SharedDiskCache(str(tmp_path)).put('test_data', dataset)
+    assert disk.get('test_data')[0].fetched_at == 20
+
+
+def testShared_EvictsLeastRecentlyUsed(tmp_path):
+    disk = SharedDiskCache(str(tmp_path),
+                           max_disk_bytes=test_data_size + test_data2_size)
+    disk.put('test_data', make_dataset('test_data', test_data, 1))
+    disk.put('test_data2', make_dataset('test_data2', test_data2, 2))
+    disk.get('test_data')
+
+    disk.put('test_data3', make_dataset('test_data3', test_data2, 3))
+    assert disk.get('test_data')[0] is not None
+    assert disk.get('test_data2')[0] is None
+    assert disk.currsize == test_data_size + test_data2_size
+
+
+def testShared_FillLockIsHeldAcrossInstances(tmp_path):
+    first = SharedDiskCache(str(tmp_path))
+    second = SharedDiskCache(str(tmp_path))
+    acquired = threading.Event()
+
+    def fill():
+        with second.fill_lock('test_data'):
+            acquired.set()
+
+    with first.fill_lock('test_data'):
+        thread = threading.Thread(target=fill)
+        thread.start()
+        assert not acquired.wait(0.1)
+        # Other datasets can still be filled.
+        with second.fill_lock('test_data2'):
+            pass
+    thread.join()
+    assert acquired.is_set()
+
+
+def testShared_FillLocksAreBounded(tmp_path):
+    disk = SharedDiskCache(str(tmp_path))
+    for i in range(4 * disk_cache.FILL_LOCK_FILES):
+        with disk.fill_lock('typo{}'.format(i)):
+            pass
+    lock_files = [name for name in os.listdir(str(tmp_path))
+                  if name.endswith('.lock')]
+    assert len(lock_files) <= disk_cache.FILL_LOCK_FILES
+
+
+def run_with_timeout(target, *args):
+    """Runs target on another thread, failing if it doesn't finish
+    promptly."""
+    thread = threading.Thread(target=target, args=args)
+    thread.start()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testDatasetCache_SharedBetweenWorkers(mock_func: mock.MagicMock,
+                                          tmp_path):
+    first = DatasetCache(disk_cache=SharedDiskCache(str(tmp_path)))
+    second = DatasetCache(disk_cache=SharedDiskCache(str(tmp_path)))
+
+    data = first.getDataset('test_bucket', 'test_data')
+    assert not data.in_memory
+    assert data.body[:] == test_data_json
+    data = second.getDataset('test_bucket', 'test_data')
+    assert data.body[:] == test_data_json
+    assert data.index is not None
+
+    mock_func.assert_called_once_with('test_bucket', 'test_data')
+    assert first.stats()['entries'] == 0
+    assert second.stats()['entries'] == 0
+    assert second.stats()['disk_hits'] == 1
+
+
+def testDatasetCache_SharedRefreshReusesOtherWorkersCopy(tmp_path):
+    timer = FakeTimer()
+    first = DatasetCache(cache_ttl=100, timer=timer,
+                         disk_cache=SharedDiskCache(str(tmp_path)))
+    second = DatasetCache(cache_ttl=100, timer=timer,
+                          disk_cache=SharedDiskCache(str(tmp_path)))
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    return_value=DownloadedBlob(test_data, 1)):
+        first.getDataset('test_bucket', 'test_data')
+        stale = second.getDataset('test_bucket', 'test_data')
+
+    # The first worker refreshes the dataset to a new version.
+    timer.now = 150
+    disk = first.disk_cache
+    with disk.fill_lock('test_data'):
+        updated = make_dataset('test_data', test_data2, 2)
+        updated.fetched_at = 150
+        disk.put('test_data', updated)
+
+    with second.cache_lock:
+        pending = second._start_refresh_locked('test_data', stale)
+    with mock.patch('data_server.gcs_utils.get_blob_metadata',
+                    return_value=BlobMetadata(2, None)) as mock_meta, \
+            mock.patch('data_server.gcs_utils.download_blob') as mock_dl:
+        second._refresh('test_bucket', 'test_data', pending, stale)
+        mock_meta.assert_called_once_with('test_bucket', 'test_data')
+        mock_dl.assert_not_called()
+    assert second.getDataset('test_bucket', 'test_data').body[:] == \
+        test_data2_json
+
+
+def testDatasetCache_SharedHitsDontWaitForFills(tmp_path):
+    timer = FakeTimer()
+    first = DatasetCache(cache_ttl=100, timer=timer,
+                         disk_cache=SharedDiskCache(str(tmp_path)))
+    second = DatasetCache(cache_ttl=100, timer=timer,
+                          disk_cache=SharedDiskCache(str(tmp_path)))
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    return_value=DownloadedBlob(test_data, 1)):
+        first.getDataset('test_bucket', 'test_data')
+
+    results = []
+    timer.now = 150
+    with first.disk_cache.fill_lock('test_data'), \
+            mock.patch('data_server.gcs_utils.get_blob_metadata',
+                       return_value=BlobMetadata(1, None)) as mock_meta:
+        # A stale copy on disk is served and refreshed while another worker
+        # holds the fill lock.
+        run_with_timeout(lambda: results.append(
+            second.getDataset('test_bucket', 'test_data')))
+        wait_for_refresh(second, 'test_data')
+        mock_meta.assert_called_once_with('test_bucket', 'test_data')
+    assert results[0].body[:] == test_data_json
+    assert not second.pending_refreshes
+
+
+def testDatasetCache_SharedRefreshErrorIsResolved(tmp_path):
+    timer = FakeTimer()
+    cache = DatasetCache(cache_ttl=100, timer=timer,
+                         disk_cache=SharedDiskCache(str(tmp_path)))
+    with mock.patch('data_server.gcs_utils.download_blob',
+                    return_value=DownloadedBlob(test_data, 1)):
+        stale = cache.getDataset('test_bucket', 'test_data')
+
+    timer.now = 150
+    with cache.cache_lock:
+        pending = cache._start_refresh_locked('test_data', stale)
+    with mock.patch.object(cache.disk_cache, 'get',
+                           side_effect=OSError('disk failed')):
+        cache._refresh('test_bucket', 'test_data', pending, stale)
+    assert pending.done.is_set()
+    assert not cache.pending_refreshes
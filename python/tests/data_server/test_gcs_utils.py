@@ -0,0 +1,104 @@
+from unittest import mock
+
+import pytest
+
+from data_server import gcs_utils
+
+
+@pytest.fixture(autouse=True)
+def reset_client():
+    """Makes sure every test starts without a shared client."""
+    gcs_utils.reset_client()
+    yield
+    gcs_utils.reset_client()
+
+
+@mock.patch('data_server.gcs_utils.storage.Client')
+def testDownloadBlob_ReusesClientAndBucket(mock_client: mock.MagicMock):
+    mock_blob = mock_client.return_value.bucket.return_value.blob.return_value
+    mock_blob.download_as_bytes.return_value = b'data'
+    mock_blob.generation = 1234
+
+    for _ in range(3):
+        blob = gcs_utils.download_blob('test_bucket', 'test_file')
+        assert blob == gcs_utils.DownloadedBlob(b'data', 1234)
+
+    mock_client.assert_called_once()
+    mock_client.return_value.bucket.assert_called_once_with('test_bucket')
+    mock_client.return_value.get_bucket.assert_not_called()
+    mock_blob.download_as_bytes.assert_called_with(
+        timeout=gcs_utils.DEFAULT_TIMEOUT_SECONDS)
+
+
+@mock.patch('data_server.gcs_utils.storage.Client')
+def testGetBlobMetadata(mock_client: mock.MagicMock):
+    mock_blob = mock_client.return_value.bucket.return_value.blob.return_value
+    mock_blob.generation = 1234
+    mock_blob.size = 56
+
+    metadata = gcs_utils.get_blob_metadata('test_bucket', 'test_file')
+    assert metadata == gcs_utils.BlobMetadata(1234, 56)
+    mock_blob.reload.assert_called_once_with(
+        timeout=gcs_utils.DEFAULT_TIMEOUT_SECONDS)
+    mock_blob.download_as_bytes.assert_not_called()
+
+
+@mock.patch.dict('os.environ', {'GCS_HTTP_POOL_SIZE': '3',
+                                'GCS_TIMEOUT_SECONDS': '2.5'})
+@mock.patch('data_server.gcs_utils.storage.Client')
+def testGetClient_Configuration(mock_client: mock.MagicMock):
+    mock_http = mock_client.return_value._http
+    mock_blob = mock_client.return_value.bucket.return_value.blob.return_value
+
+    gcs_utils.download_blob('test_bucket', 'test_file')
+
+    adapter = mock_http.mount.call_args_list[0].args[1]
+    assert adapter._pool_maxsize == 3
+    mock_http.mount.assert_any_call('https://', adapter)
+    mock_blob.download_as_bytes.assert_called_once_with(timeout=2.5)
+
+
+@mock.patch('data_server.gcs_utils.storage.Client')
+def testGetBucket_PerBucketHandles(mock_client: mock.MagicMock):
+    mock_client.return_value.bucket.side_effect = lambda name: name
+
+    assert gcs_utils.get_bucket('bucket_a') == 'bucket_a'
+    assert gcs_utils.get_bucket('bucket_b') == 'bucket_b'
+    assert gcs_utils.get_bucket('bucket_a') == 'bucket_a'
+    assert mock_client.return_value.bucket.call_count == 2
+
+
+@mock.patch('data_server.gcs_utils.storage.Client')
+def testIterBlobChunks(mock_client: mock.MagicMock):
+    mock_bucket = mock_client.return_value.bucket.return_value
+    mock_blob = mock_bucket.blob.return_value
+    mock_blob.download_as_bytes.side_effect = [b'abc', b'def', b'g']
+
+    chunks = gcs_utils.iter_blob_chunks('test_bucket', 'test_file', 7,
+                                        generation=5, chunk_bytes=3)
+    assert list(chunks) == [b'abc', b'def', b'g']
+    mock_bucket.blob.assert_called_once_with('test_file', generation=5)
+    mock_blob.download_as_bytes.assert_has_calls([
+        mock.call(start=0, end=2, timeout=gcs_utils.DEFAULT_TIMEOUT_SECONDS),
+        mock.call(start=3, end=5, timeout=gcs_utils.DEFAULT_TIMEOUT_SECONDS),
+        mock.call(start=6, end=6, timeout=gcs_utils.DEFAULT_TIMEOUT_SECONDS)])
+
+
+@mock.patch('data_server.gcs_utils.storage.Client')
+def testListAndDeleteBlobs(mock_client: mock.MagicMock):
+    mock_listed = mock.MagicMock()
+    mock_listed.name = 'prefix/file'
+    mock_listed.updated.timestamp.return_value = 123.0
+    mock_client.return_value.list_blobs.return_value = [mock_listed]
+
+    assert gcs_utils.list_blobs('test_bucket', 'prefix/') == [
+        ('prefix/file', 123.0)]
+    mock_client.return_value.list_blobs.assert_called_once_with(
+        'test_bucket', prefix='prefix/',
+        timeout=gcs_utils.DEFAULT_TIMEOUT_SECONDS)
+
+    gcs_utils.delete_blob('test_bucket', 'prefix/file')
+    mock_blob = mock_client.return_value.bucket.return_value.blob
+    mock_blob.assert_called_once_with('prefix/file')
+    mock_blob.return_value.delete.assert_called_once_with(
+        timeout=gcs_utils.DEFAULT_TIMEOUT_SECONDS)
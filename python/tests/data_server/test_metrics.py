@@ -0,0 +1,99 @@
+from unittest import mock
+
+import google.cloud.exceptions
+import pytest
+
+from data_server import metrics
+from data_server.dataset_cache import DatasetCache
+from data_server.disk_cache import SharedDiskCache
+from data_server.metrics import Counter, Gauge, Histogram
+
+from tests.data_server.test_dataset_cache import (get_test_data,
+                                                  test_data_size)
+
+
+@pytest.fixture(autouse=True)
+def clear_metrics():
+    metrics.clear()
+
+
+def testCounter():
+    counter = Counter('test_counter_total', 'A counter.', ('dataset',),
+                      register=False)
+    counter.inc('a')
+    counter.inc('a', amount=2)
+    counter.inc('b "quoted"')
+    assert counter.get('a') == 3
+    assert counter.render() == [
+        '# HELP test_counter_total A counter.',
+        '# TYPE test_counter_total counter',
+        'test_counter_total{dataset="a"} 3',
+        'test_counter_total{dataset="b \\"quoted\\""} 1']
+
+
+def testGauge():
+    gauge = Gauge('test_gauge', 'A gauge.', register=False)
+    gauge.set(5)
+    gauge.set(3)
+    assert gauge.render()[-1] == 'test_gauge 3'
+
+
+def testHistogram():
+    histogram = Histogram('test_seconds', 'A histogram.', ('route',),
+                          buckets=(0.1, 1), register=False)
+    histogram.observe(0.05, '/')
+    histogram.observe(0.1, '/')
+    histogram.observe(5, '/')
+    assert histogram.get_count('/') == 3
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{route="/",le="0.1"} 2',
+        'test_seconds_bucket{route="/",le="1"} 2',
+        'test_seconds_bucket{route="/",le="+Inf"} 3',
+        'test_seconds_sum{route="/"} 5.15',
+        'test_seconds_count{route="/"} 3']
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testDatasetCacheMetrics(mock_func: mock.MagicMock):
+    cache = DatasetCache(max_cache_bytes=test_data_size)
+    cache.getDataset('test_bucket', 'test_data')
+    cache.getDataset('test_bucket', 'test_data')
+    cache.getDataset('test_bucket', 'test_data2')
+
+    assert metrics.CACHE_MISSES.get('test_data') == 1
+    assert metrics.CACHE_MISSES.get('test_data2') == 1
+    assert metrics.CACHE_HITS.get('test_data', 'memory') == 1
+    assert metrics.CACHE_EVICTIONS.get('test_data') == 1
+    assert metrics.GCS_FETCH_SECONDS.get_count() == 2
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=google.cloud.exceptions.NotFound('File not found'))
+def testDatasetCacheMetrics_MissingDatasetsShareOneLabel(
+        mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    for table_id in ('typo1', 'typo2'):
+        with pytest.raises(google.cloud.exceptions.NotFound):
+            cache.getDataset('test_bucket', table_id)
+
+    assert metrics.CACHE_MISSES.get(metrics.UNKNOWN_DATASET) == 2
+    assert metrics.CACHE_MISSES.get('typo1') == 0
+    assert metrics.CACHE_MISSES.render()[2:] == [
+        'data_server_cache_misses_total{dataset="unknown"} 2']
+
+
+@mock.patch('data_server.gcs_utils.download_blob',
+            side_effect=get_test_data)
+def testDatasetCacheMetrics_SharedDiskHits(mock_func: mock.MagicMock,
+                                           tmp_path):
+    first = DatasetCache(disk_cache=SharedDiskCache(str(tmp_path)))
+    second = DatasetCache(disk_cache=SharedDiskCache(str(tmp_path)))
+    first.getDataset('test_bucket', 'test_data')
+    first.getDataset('test_bucket', 'test_data')
+    second.getDataset('test_bucket', 'test_data')
+
+    # Only the first request had to go to GCS.
+    assert metrics.CACHE_MISSES.get('test_data') == 1
+    assert metrics.CACHE_HITS.get('test_data', 'disk') == 2
+    assert metrics.CACHE_HITS.get('test_data', 'memory') == 0
@@ -0,0 +1,83 @@
+import json
+from unittest import mock
+
+import pytest
+
+from data_server import timing
+from data_server.dataset_cache import DatasetCache
+from data_server.timing import TimingConfig
+
+from tests.data_server.test_dataset_cache import get_test_data
+
+
+@pytest.fixture(autouse=True)
+def stop_timing():
+    yield
+    timing.stop()
+
+
+def testPhase_NestedPhasesAreExclusive():
+    timing.start()
+    with mock.patch('time.perf_counter', side_effect=[0, 1, 3, 10]):
+        with timing.phase('outer'):
+            with timing.phase('inner'):
+                pass
+    assert timing.stop() == {'outer': 8, 'inner': 2}
+
+
+def testPhase_AddsUpRepeatedPhases():
+    timing.start()
+    with mock.patch('time.perf_counter', side_effect=[0, 1, 5, 7]):
+        with timing.phase('gcs'):
+            pass
+        with timing.phase('gcs'):
+            pass
+    assert timing.stop() == {'gcs': 3}
+
+
+def testPhase_NotRecording():
+    with timing.phase('gcs'):
+        pass
+    assert timing.stop() == {}
+
+
+def testFormatServerTiming():
+    assert timing.format_server_timing(
+        {'lookup': 0.0001234, 'gcs': 0.5}) == 'lookup;dur=0.12, gcs;dur=500.00'
+
+
+def testTimingConfig_FromEnv():
+    assert TimingConfig.from_env() == TimingConfig(False, 0.0, None, None)
+    env = {'SERVER_TIMING_HEADER': 'true', 'TIMING_LOG_SAMPLE_RATE': '0.5',
+           'TIMING_LOG_SLOW_SECONDS': '2',
+           'SERVER_TIMING_ALLOW_ORIGIN': 'https://example.org'}
+    with mock.patch.dict('os.environ', env):
+        assert TimingConfig.from_env() == TimingConfig(
+            True, 0.5, 2.0, 'https://example.org')
+
+
+def testTimingConfig_ShouldLog():
+    assert not TimingConfig().should_log(100)
+    assert TimingConfig(log_sample_rate=1).should_log(0)
+    assert TimingConfig(log_slow_seconds=2).should_log(2)
+    assert not TimingConfig(log_slow_seconds=2).should_log(1)
+
+
+def testLogTimings(capsys):
+    timing.log_timings({'route': '/dataset'}, {'gcs': 0.25})
+    entry = json.loads(capsys.readouterr().out)
+    assert entry == {'route': '/dataset', 'severity': 'INFO',
+                     'message': 'request timing', 'phases_ms': {'gcs': 250.0}}
+
+
+@mock.patch('data_server.gcs_utils.download_blob', side_effect=get_test_data)
+def testDatasetCache_RecordsPhases(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    timing.start()
+    cache.getDataset('test_bucket', 'test_data')
+    assert set(timing.stop()) == {'lookup', 'lock', 'gcs', 'build',
+                                  'compress'}
+
+    timing.start()
+    cache.getDataset('test_bucket', 'test_data')
+    assert set(timing.stop()) == {'lookup', 'lock'}
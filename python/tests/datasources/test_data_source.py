@@ -1,3 +1,5 @@
+from unittest import mock
+
 import pandas as pd
 
 from datasources.data_source import DataSource
@@ -14,3 +16,20 @@ def testCleanFrameColumnNames():
     ds.clean_frame_column_names(df)
     assert set(df.columns) == set(['upp3rcase', 'special_char', 'thiseqthat',
                                    'pctcount', 'with_spaces'])
+
+
+@mock.patch('ingestion.gcs_to_bq_util.add_dataframe_chunks_to_bq')
+@mock.patch('ingestion.gcs_to_bq_util.load_csv_as_dataframe')
+def testWriteToBqTable(mock_csv: mock.MagicMock, mock_bq: mock.MagicMock):
+    mock_csv.return_value = iter([pd.DataFrame({'Col A': [1]}),
+                                  pd.DataFrame({'Col A': [2]})])
+    mock_bq.side_effect = lambda chunks, *args, **kwargs: loaded.extend(
+        chunks)
+    loaded = []
+
+    DataSource().write_to_bq_table('dataset', 'gcs_bucket', 'file.csv',
+                                   'table')
+    mock_csv.assert_called_once_with('gcs_bucket', 'file.csv', chunksize=1000)
+    mock_bq.assert_called_once()
+    assert mock_bq.call_args.args[1:] == ('dataset', 'table')
+    assert [list(chunk.columns) for chunk in loaded] == [['col_a'], ['col_a']]
@@ -1,7 +1,7 @@
 import unittest
 from unittest.mock import Mock, patch
 import google.cloud.exceptions
-from ingestion import url_file_to_gcs
+from ingestion import gcs_to_bq_util, url_file_to_gcs
 
 
 class MockResponse:
@@ -38,9 +38,15 @@ def intialize_mocks(mock_storage_client, mock_requests_get, response_data, gcs_d
 
 
 class URLFileToGCSTest(unittest.TestCase):
+    def setUp(self):
+        gcs_to_bq_util.reset_clients()
+
+    def tearDown(self):
+        gcs_to_bq_util.reset_clients()
+
     def testDownloadFirstUrlToGcs_SameFile(self):
         test_data = b'fake data'
-        with patch('ingestion.url_file_to_gcs.storage.Client') as mock_storage_client, \
+        with patch('ingestion.gcs_to_bq_util.storage.Client') as mock_storage_client, \
                 patch('requests.get') as mock_requests_get:
             intialize_mocks(mock_storage_client,
                             mock_requests_get, test_data, test_data)
@@ -51,7 +57,7 @@ class URLFileToGCSTest(unittest.TestCase):
             self.assertFalse(result)
 
     def testDownloadFirstUrlToGcs_DiffFile(self):
-        with patch('ingestion.url_file_to_gcs.storage.Client') as mock_storage_client, \
+        with patch('ingestion.gcs_to_bq_util.storage.Client') as mock_storage_client, \
                 patch('requests.get') as mock_requests_get:
             intialize_mocks(mock_storage_client,
                             mock_requests_get, b'data from url', b'gcs data')
@@ -62,7 +68,7 @@ class URLFileToGCSTest(unittest.TestCase):
             self.assertTrue(result)
 
     def testDownloadFirstUrlToGcs_NoGCSFile(self):
-        with patch('ingestion.url_file_to_gcs.storage.Client') as mock_storage_client, \
+        with patch('ingestion.gcs_to_bq_util.storage.Client') as mock_storage_client, \
                 patch('requests.get') as mock_requests_get:
             intialize_mocks(mock_storage_client,
                             mock_requests_get, b'data from url', b'gcs data',
@@ -1,10 +1,14 @@
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from textwrap import dedent
 from unittest import TestCase
 from unittest.mock import MagicMock, Mock, patch
 
 import numpy as np
+import pandas
+import pyarrow.parquet
 from freezegun import freeze_time
 from pandas import DataFrame
 from pandas.testing import assert_frame_equal
@@ -18,6 +22,14 @@ class GcsToBqTest(TestCase):
                   ["valuea", "valueb", "valuec"],
                   ["valued", "valuee", "valuef"]]
 
+    def setUp(self):
+        # Tests patch bigquery.Client and storage.Client, so clients shared
+        # by earlier tests mustn't be reused.
+        gcs_to_bq_util.reset_clients()
+
+    def tearDown(self):
+        gcs_to_bq_util.reset_clients()
+
     def testLoadValuesBlobAsDataframe(self):
         """Tests that data in json list format is loaded into a
            pandas.DataFrame object using the first row as a header."""
@@ -130,6 +142,232 @@ class GcsToBqTest(TestCase):
             self.assertListEqual([field.mode for field in job_config.schema],
                                  expected_modes)
 
+    @freeze_time("2020-01-01")
+    def testAddDataframeToBq_Parquet(self):
+        """Tests that frames whose columns all convert cleanly to their
+           BigQuery types are loaded as Parquet."""
+        test_frame = DataFrame(
+            {'county_fips': ['01001', None], 'population': [10, 20],
+             'pct': [0.5, np.nan], 'flag': [True, False]}, index=[1, 2])
+
+        with patch('ingestion.gcs_to_bq_util.bigquery.Client') as mock_client:
+            mock_instance = mock_client.return_value
+            column_types = {'county_fips': 'STRING', 'population': 'INT64',
+                            'pct': 'FLOAT', 'flag': 'BOOL'}
+            gcs_to_bq_util.add_dataframe_to_bq(
+                test_frame, 'test-dataset', 'table',
+                column_types=column_types,
+                col_modes={'population': 'REQUIRED'})
+
+            mock_instance.load_table_from_json.assert_not_called()
+            call_args = mock_instance.load_table_from_file.call_args
+            job_config = call_args.kwargs['job_config']
+            self.assertEqual(job_config.source_format, 'PARQUET')
+            self.assertListEqual(
+                [field.field_type for field in job_config.schema],
+                ['STRING', 'INT64', 'FLOAT', 'BOOL', 'TIMESTAMP'])
+
+            table = pyarrow.parquet.read_table(call_args.args[0])
+            self.assertDictEqual(table.to_pydict(), {
+                'county_fips': ['01001', None], 'population': [10, 20],
+                'pct': [0.5, None], 'flag': [True, False],
+                'ingestion_ts': [
+                    datetime(2020, 1, 1, tzinfo=timezone.utc)] * 2})
+            self.assertFalse(table.schema.field('population').nullable)
+
+    def testAddDataframeToBq_ParquetFallsBackToJson(self):
+        """Tests that frames that can't be loaded as Parquet as-is are loaded
+           as json."""
+        frames = [
+            # Numbers in a STRING column.
+            (DataFrame({'county_fips': [1001, 1003]}),
+             {'county_fips': 'STRING'}, None),
+            # Fractional values in an INT64 column.
+            (DataFrame({'population': [1.5, 2.0]}),
+             {'population': 'INT64'}, None),
+            # Unsupported types.
+            (DataFrame({'day': ['2020-01-01']}), {'day': 'DATE'}, None),
+            # Lists in a REPEATED column.
+            (DataFrame({'neighbor_geoids': [['01001', '01003']]}),
+             {'neighbor_geoids': 'STRING'}, {'neighbor_geoids': 'REPEATED'}),
+        ]
+        for frame, column_types, col_modes in frames:
+            gcs_to_bq_util.reset_clients()
+            with patch('ingestion.gcs_to_bq_util.bigquery.Client') as \
+                    mock_client:
+                mock_instance = mock_client.return_value
+                gcs_to_bq_util.add_dataframe_to_bq(
+                    frame, 'test-dataset', 'table',
+                    column_types=dict(column_types), col_modes=col_modes)
+
+                mock_instance.load_table_from_file.assert_not_called()
+                mock_instance.load_table_from_json.assert_called()
+
+    def testAddDataframeToBq_MismatchedColumnTypes(self):
+        """Tests that column types that don't match the frame's columns are
+           reported by get_schema rather than failing the Parquet path."""
+        frame = DataFrame({'county_fips': ['01001'], 'population': [10]})
+        with patch('ingestion.gcs_to_bq_util.bigquery.Client') as mock_client:
+            with self.assertRaisesRegex(
+                    Exception, 'Column types did not match frame columns'):
+                gcs_to_bq_util.add_dataframe_to_bq(
+                    frame, 'test-dataset', 'table',
+                    column_types={'county_fips': 'STRING'})
+            mock_client.return_value.load_table_from_file.assert_not_called()
+
+    # Values of every kind of column manual uploads can have, including nulls
+    # and floats that to_json rounds.
+    _str_values_frame = DataFrame({
+        'ints': [1, -20, 300],
+        'floats': [0.1, np.nan, 1 / 3],
+        'big_floats': [1e20, 123456789.123456789, 2.5e-12],
+        'whole_floats': [1.0, 2.0, None],
+        'bools': [True, False, True],
+        'strings': ['a', 'None', 'é "quoted"'],
+        'strings_with_nulls': ['a', None, np.nan],
+        'mixed': ['a', 2, 3.5],
+        'nulls': [None, None, None],
+        'dates': pandas.to_datetime(['2020-01-01', None, '2021-06-30']),
+    }, index=[5, 3, 5])
+
+    @staticmethod
+    def _str_values_before_vectorizing(frame):
+        """How add_dataframe_to_bq_as_str_values converted values to
+           strings before it worked column by column."""
+        json_data = json.loads(frame.to_json(orient='records'))
+        for sub in json_data:
+            for key in sub:
+                sub[key] = str(sub[key])
+        return json_data
+
+    @freeze_time("2020-01-01")
+    def testAddDataframeToBqAsStrValues(self):
+        """Tests that values are converted to the same strings as the json
+           round trip gives."""
+        expected = self._str_values_before_vectorizing(
+            self._str_values_frame.assign(ingestion_ts=datetime(
+                2020, 1, 1, tzinfo=timezone.utc).strftime(
+                    "%Y-%m-%d %H:%M:%S.%f %Z")))
+
+        with patch('ingestion.gcs_to_bq_util.bigquery.Client') as mock_client:
+            mock_instance = mock_client.return_value
+            gcs_to_bq_util.add_dataframe_to_bq_as_str_values(
+                self._str_values_frame.copy(deep=True), 'test-dataset',
+                'table')
+
+            call_args = mock_instance.load_table_from_file.call_args
+            job_config = call_args.kwargs['job_config']
+            self.assertEqual(job_config.source_format,
+                             'NEWLINE_DELIMITED_JSON')
+            self.assertTrue(job_config.autodetect)
+            rows = [json.loads(line)
+                    for line in call_args.args[0].getvalue().splitlines()]
+            self.assertListEqual(rows, expected)
+
+        self.assertEqual(expected[0]['floats'], '0.1')
+        self.assertEqual(expected[1]['floats'], 'None')
+        self.assertEqual(expected[2]['floats'], '0.3333333333')
+        self.assertEqual(expected[2]['whole_floats'], 'None')
+        self.assertEqual(expected[1]['strings_with_nulls'], 'None')
+        self.assertEqual(expected[2]['strings_with_nulls'], 'None')
+        self.assertEqual(expected[0]['bools'], 'True')
+        self.assertEqual(expected[0]['dates'], '1577836800000')
+        self.assertEqual(expected[1]['dates'], 'None')
+
+    @freeze_time("2020-01-01")
+    def testAddDataframeChunksToBq(self):
+        """Tests that every chunk is loaded in a single job that overwrites
+           the table."""
+        chunks = [
+            DataFrame(data=self._test_data[1:2], columns=self._test_data[0]),
+            DataFrame(columns=self._test_data[0]),
+            DataFrame(data=self._test_data[2:], columns=self._test_data[0]),
+        ]
+        loaded = []
+
+        with patch('ingestion.gcs_to_bq_util.bigquery.Client') as mock_client:
+            mock_instance = mock_client.return_value
+            mock_instance.load_table_from_file.side_effect = (
+                lambda file, *args, **kwargs: loaded.append(file.read()) or
+                MagicMock())
+
+            gcs_to_bq_util.add_dataframe_chunks_to_bq(
+                iter(chunks), 'test-dataset', 'table')
+
+            mock_instance.load_table_from_file.assert_called_once()
+            job_config = mock_instance.load_table_from_file.call_args.kwargs[
+                'job_config']
+            self.assertEqual(job_config.source_format,
+                             'NEWLINE_DELIMITED_JSON')
+            self.assertEqual(job_config.write_disposition, 'WRITE_TRUNCATE')
+            self.assertTrue(job_config.autodetect)
+
+        rows = [json.loads(line) for line in loaded[0].splitlines()]
+        ingestion_ts = datetime(2020, 1, 1, tzinfo=timezone.utc).strftime(
+            '%Y-%m-%d %H:%M:%S.%f %Z')
+        self.assertListEqual(rows, [
+            dict(zip(self._test_data[0] + ['ingestion_ts'],
+                     values + [ingestion_ts]))
+            for values in self._test_data[1:]])
+
+    def testAddDataframeChunksToBq_ValuesAsStr(self):
+        """Tests that values are converted to strings as
+           add_dataframe_to_bq_as_str_values does."""
+        chunk = DataFrame({'count': [1, None], 'name': ['a', 'b']})
+        loaded = []
+
+        with patch('ingestion.gcs_to_bq_util.bigquery.Client') as mock_client:
+            mock_instance = mock_client.return_value
+            mock_instance.load_table_from_file.side_effect = (
+                lambda file, *args, **kwargs: loaded.append(file.read()) or
+                MagicMock())
+            gcs_to_bq_util.add_dataframe_chunks_to_bq(
+                [chunk], 'test-dataset', 'table', values_as_str=True)
+
+        rows = [json.loads(line) for line in loaded[0].splitlines()]
+        self.assertListEqual([(row['count'], row['name']) for row in rows],
+                             [('1.0', 'a'), ('None', 'b')])
+
+    def testAddDataframeChunksToBq_ValuesAsStrParity(self):
+        """Tests that the staged strings match the json round trip."""
+        loaded = []
+
+        with patch('ingestion.gcs_to_bq_util.bigquery.Client') as mock_client:
+            mock_instance = mock_client.return_value
+            mock_instance.load_table_from_file.side_effect = (
+                lambda file, *args, **kwargs: loaded.append(file.read()) or
+                MagicMock())
+            gcs_to_bq_util.add_dataframe_chunks_to_bq(
+                [self._str_values_frame.copy(deep=True)], 'test-dataset',
+                'table', values_as_str=True)
+
+        rows = [json.loads(line) for line in loaded[0].splitlines()]
+        expected = self._str_values_before_vectorizing(
+            self._str_values_frame)
+        self.assertListEqual(
+            [{key: value for key, value in row.items()
+              if key != 'ingestion_ts'} for row in rows], expected)
+
+    def testAddDataframeChunksToBq_FailedChunk(self):
+        """Tests that the table is left as-is if a chunk fails to load."""
+        def chunks():
+            yield DataFrame(data=self._test_data[1:],
+                            columns=self._test_data[0])
+            raise ValueError('Bad chunk')
+
+        with patch('ingestion.gcs_to_bq_util.bigquery.Client') as mock_client:
+            with self.assertRaises(ValueError):
+                gcs_to_bq_util.add_dataframe_chunks_to_bq(
+                    chunks(), 'test-dataset', 'table')
+            mock_client.return_value.load_table_from_file.assert_not_called()
+
+    def testAddDataframeChunksToBq_NoRows(self):
+        with patch('ingestion.gcs_to_bq_util.bigquery.Client') as mock_client:
+            gcs_to_bq_util.add_dataframe_chunks_to_bq(
+                [DataFrame(columns=self._test_data[0])], 'test-dataset',
+                'table')
+            mock_client.return_value.load_table_from_file.assert_not_called()
+
     @patch('ingestion.gcs_to_bq_util.storage.Client')
     def testLoadCsvAsDataFrame_ParseTypes(self, mock_bq: MagicMock):
         # Write data to an temporary file
@@ -164,3 +402,197 @@ class GcsToBqTest(TestCase):
                           'col3': np.object, 'col4': np.object}
         for col in df.columns:
             self.assertEqual(df[col].dtype, expected_types[col])
+
+
+class ClientRegistryTest(TestCase):
+
+    def setUp(self):
+        gcs_to_bq_util.reset_clients()
+
+    def tearDown(self):
+        gcs_to_bq_util.reset_clients()
+
+    @patch('ingestion.gcs_to_bq_util.bigquery.Client')
+    def testBigQueryClientReusedPerProject(self, mock_client: MagicMock):
+        mock_client.side_effect = lambda *args: MagicMock()
+        client = gcs_to_bq_util.get_bigquery_client('project-a')
+
+        self.assertIs(gcs_to_bq_util.get_bigquery_client('project-a'), client)
+        self.assertIsNot(gcs_to_bq_util.get_bigquery_client('project-b'),
+                         client)
+        self.assertIsNot(gcs_to_bq_util.get_bigquery_client(), client)
+        self.assertEqual(mock_client.call_count, 3)
+
+    @patch('ingestion.gcs_to_bq_util.bigquery.Client')
+    def testAddDataframeToBq_ReusesClient(self, mock_client: MagicMock):
+        frame = DataFrame({'label1': ['a']})
+        for _ in range(3):
+            gcs_to_bq_util.add_dataframe_to_bq(frame.copy(), 'test-dataset',
+                                               'table', project='project')
+
+        mock_client.assert_called_once_with('project')
+        mock_client.return_value.dataset.assert_called_once_with(
+            'test-dataset')
+        self.assertEqual(
+            mock_client.return_value.load_table_from_json.call_count, 3)
+
+    @patch('ingestion.gcs_to_bq_util.storage.Client')
+    def testBucketFetchedOnce(self, mock_client: MagicMock):
+        mock_bucket = mock_client.return_value.get_bucket.return_value
+        mock_bucket.list_blobs.return_value = [Mock(), Mock()]
+        mock_bucket.blob.return_value.download_as_bytes.return_value = b'[]'
+
+        gcs_to_bq_util.list_bucket_files('gcs_bucket')
+        gcs_to_bq_util.load_values_as_json('gcs_bucket', 'file.json')
+        gcs_to_bq_util.load_values_as_json('other_bucket', 'file.json')
+
+        mock_client.assert_called_once_with()
+        self.assertListEqual(
+            mock_client.return_value.get_bucket.call_args_list,
+            [(('gcs_bucket',),), (('other_bucket',),)])
+
+    @patch('ingestion.gcs_to_bq_util.storage.Client')
+    def testResetClients(self, mock_client: MagicMock):
+        mock_client.side_effect = lambda *args: MagicMock()
+        client = gcs_to_bq_util.get_storage_client()
+        bucket = gcs_to_bq_util.get_bucket('gcs_bucket')
+
+        gcs_to_bq_util.reset_clients()
+
+        self.assertIsNot(gcs_to_bq_util.get_storage_client(), client)
+        self.assertIsNot(gcs_to_bq_util.get_bucket('gcs_bucket'), bucket)
+        self.assertEqual(mock_client.call_count, 2)
+
+    @patch('ingestion.gcs_to_bq_util.bigquery.Client')
+    def testSetClient(self, mock_client: MagicMock):
+        fake_client = MagicMock()
+        gcs_to_bq_util.set_bigquery_client(fake_client, 'project')
+
+        gcs_to_bq_util.add_dataframe_to_bq(
+            DataFrame({'label1': ['a']}), 'test-dataset', 'table',
+            project='project')
+
+        mock_client.assert_not_called()
+        fake_client.load_table_from_json.assert_called_once()
+
+        gcs_to_bq_util.reset_clients()
+        self.assertIs(gcs_to_bq_util.get_bigquery_client('project'),
+                      mock_client.return_value)
+
+    @patch('ingestion.gcs_to_bq_util.bigquery.Client')
+    def testClientCreatedOnceAcrossThreads(self, mock_client: MagicMock):
+        def make_client(*args):
+            time.sleep(0.01)
+            return MagicMock()
+        mock_client.side_effect = make_client
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(executor.map(
+                lambda _: gcs_to_bq_util.get_bigquery_client('project'),
+                range(16)))
+
+        self.assertEqual(mock_client.call_count, 1)
+        self.assertTrue(all(client is clients[0] for client in clients))
+
+
+class ConcurrentLoadsTest(TestCase):
+
+    def setUp(self):
+        gcs_to_bq_util.reset_clients()
+        self.events = []
+        self.failing_tables = set()
+        patcher = patch('ingestion.gcs_to_bq_util.bigquery.Client')
+        mock_client = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(gcs_to_bq_util.reset_clients)
+        mock_instance = mock_client.return_value
+        mock_instance.dataset.side_effect = lambda dataset: Mock(
+            table=lambda table_name: table_name)
+        mock_instance.load_table_from_json.side_effect = self._start_job
+
+    def _start_job(self, json_data, table_name, job_config):
+        self.events.append(('start', table_name))
+
+        def result():
+            self.events.append(('result', table_name))
+            if table_name in self.failing_tables:
+                raise ValueError('Bad data')
+        return Mock(result=result)
+
+    def _load(self, table_name):
+        gcs_to_bq_util.add_dataframe_to_bq(
+            DataFrame({'label1': ['a']}), 'test-dataset', table_name)
+
+    def testWaitsForJobsTogether(self):
+        with gcs_to_bq_util.concurrent_loads():
+            for table_name in ['a', 'b', 'c']:
+                self._load(table_name)
+            self.assertListEqual(
+                self.events, [('start', 'a'), ('start', 'b'), ('start', 'c')])
+
+        self.assertListEqual(self.events[3:], [
+            ('result', 'a'), ('result', 'b'), ('result', 'c')])
+
+    def testWaitsOutsideBlock(self):
+        self._load('a')
+        self._load('b')
+
+        self.assertListEqual(self.events, [
+            ('start', 'a'), ('result', 'a'), ('start', 'b'), ('result', 'b')])
+
+    def testBoundsConcurrency(self):
+        with gcs_to_bq_util.concurrent_loads(max_concurrency=2):
+            for table_name in ['a', 'b', 'c', 'd']:
+                self._load(table_name)
+
+        self.assertListEqual(self.events, [
+            ('start', 'a'), ('start', 'b'), ('result', 'a'), ('start', 'c'),
+            ('result', 'b'), ('start', 'd'), ('result', 'c'),
+            ('result', 'd')])
+
+    def testLoadsToSameTableInOrder(self):
+        with gcs_to_bq_util.concurrent_loads():
+            self._load('a')
+            self._load('b')
+            self._load('a')
+
+        self.assertListEqual(self.events, [
+            ('start', 'a'), ('start', 'b'), ('result', 'a'), ('start', 'a'),
+            ('result', 'b'), ('result', 'a')])
+
+    def testReportsEveryFailure(self):
+        self.failing_tables = {'a', 'c'}
+
+        with self.assertRaises(gcs_to_bq_util.LoadJobsError) as context:
+            with gcs_to_bq_util.concurrent_loads():
+                for table_name in ['a', 'b', 'c']:
+                    self._load(table_name)
+
+        self.assertListEqual(
+            [table for table, _ in context.exception.errors],
+            ['test-dataset.a', 'test-dataset.c'])
+        self.assertIn('test-dataset.a: Bad data', str(context.exception))
+        self.assertIn(('result', 'b'), self.events)
+
+    def testNestedBlocksShareJobs(self):
+        with gcs_to_bq_util.concurrent_loads():
+            with gcs_to_bq_util.concurrent_loads():
+                self._load('a')
+            self._load('b')
+            self.assertNotIn(('result', 'a'), self.events)
+
+        self.assertListEqual(self.events[2:],
+                             [('result', 'a'), ('result', 'b')])
+
+    def testErrorInBlockWaitsForStartedJobs(self):
+        self.failing_tables = {'a'}
+
+        with self.assertRaises(RuntimeError):
+            with gcs_to_bq_util.concurrent_loads():
+                self._load('a')
+                raise RuntimeError('Bad frame')
+
+        self.assertListEqual(self.events, [('start', 'a'), ('result', 'a')])
+        self._load('b')
+        self.assertListEqual(self.events[2:],
+                             [('start', 'b'), ('result', 'b')])